@@ -1,28 +1,115 @@
+import sys
+
+from marketplace import DEFAULT_MARKETPLACE, public_base_url
+
+
 class AmazonProduct:
-    def __init__(self, asin: str):
+    __slots__ = (
+        "asin",
+        "marketplace",
+        "name",
+        "overall_rating",
+        "total_rating_count",
+        "total_reviews_count",
+        "star_percentages",
+        "review_list",
+        "review_index",
+        "failed_urls",
+    )
+
+    def __init__(self, asin: str, marketplace: str = DEFAULT_MARKETPLACE):
         self.asin = asin
+        # The store the reviews were collected from, e.g. "com" or "ca"
+        self.marketplace = marketplace
         self.name = ""
         self.overall_rating = 0.0
         self.total_rating_count = 0
         self.total_reviews_count = 0
+        # Histogram percentage keyed by star count, e.g. {5: 64, 4: 20}
+        self.star_percentages = {}
         self.review_list = []
+        # Review id -> review, for constant time dedup across filters
+        self.review_index = {}
         self.failed_urls = []
 
+    @property
+    def base_url(self) -> str:
+        return public_base_url(self.marketplace)
+
     def __setitem__(self, key, value):
         setattr(self, key, value)
 
     def __getitem__(self, key):
         return getattr(self, key)
 
-    def to_dict(self):
+    def merge_page(self, page, found_under: int) -> None:
+        """Merge the product info and reviews of a ParsedPage found under the given filter bit"""
+        # Update product info if not already set
+        if self.name == "" and page.product_name:
+            self.name = page.product_name
+
+        if self.overall_rating == 0 and page.overall_rating:
+            self.overall_rating = page.overall_rating
+
+        if (page.total_rating_count or 0) > self.total_rating_count:
+            self.total_rating_count = page.total_rating_count
+
+        if (page.total_reviews_count or 0) > self.total_reviews_count:
+            self.total_reviews_count = page.total_reviews_count
+
+        if not self.star_percentages and page.star_percentages:
+            self.star_percentages = dict(page.star_percentages)
+
+        for review in page.reviews:
+            self.add_review(review, found_under)
+
+    def add_review(self, review, found_under: int) -> None:
+        existing_review = self.review_index.get(review.id)
+        if existing_review:
+            existing_review.add_found_under(found_under)
+        else:
+            # Reviews arrive unpickled from the parser workers, so intern the
+            # country, which repeats across reviews, here where they are kept.
+            # Usernames are nearly all unique, interned they would never be freed
+            review.country = sys.intern(review.country)
+            review.add_found_under(found_under)
+            self.review_index[review.id] = review
+            self.review_list.append(review)
+
+    def merge_reviews(self, reviews) -> None:
+        """Add reviews that already carry their found under masks"""
+        for review in reviews:
+            existing_review = self.review_index.get(review.id)
+            if existing_review:
+                existing_review.found_under_mask |= review.found_under_mask
+            else:
+                self.review_index[review.id] = review
+                self.review_list.append(review)
+
+    def merge_product(self, other: "AmazonProduct") -> None:
+        """Fold a later crawl of the same product into this one, its counts win"""
+        self.name = other.name or self.name
+        self.overall_rating = other.overall_rating or self.overall_rating
+        self.total_rating_count = other.total_rating_count or self.total_rating_count
+        self.total_reviews_count = other.total_reviews_count or self.total_reviews_count
+        self.star_percentages = other.star_percentages or self.star_percentages
+        self.merge_reviews(other.review_list)
+        self.failed_urls += [
+            url for url in other.failed_urls if url not in self.failed_urls
+        ]
+
+    def to_dict(self, expand_found_under: bool = True):
         return {
             "asin": self.asin,
+            "marketplace": self.marketplace,
             "name": self.name,
             "overall_rating": self.overall_rating,
             "total_rating_count": self.total_rating_count,
             "total_reviews_count": self.total_reviews_count,
+            "star_percentages": self.star_percentages,
             "review_list": [
-                review.to_dict() for review in self.review_list
+                review.to_dict(self.asin, expand_found_under, self.base_url)
+                for review in self.review_list
             ],  # Convert reviews to dicts
             "failed_urls": self.failed_urls,
         }
@@ -40,13 +127,17 @@ class AmazonProduct:
         """
         # Extract the 'asin' field
         asin = json_data.get("asin", "")
-        product = AmazonProduct(asin)
+        product = AmazonProduct(asin, json_data.get("marketplace", DEFAULT_MARKETPLACE))
 
         # Map JSON fields to class attributes
         product.name = json_data.get("name", "")
         product.overall_rating = json_data.get("overall_rating", 0.0)
         product.total_rating_count = json_data.get("total_rating_count", 0)
         product.total_reviews_count = json_data.get("total_reviews_count", 0)
+        product.star_percentages = {
+            int(star): percentage
+            for star, percentage in json_data.get("star_percentages", {}).items()
+        }
         product.review_list = json_data.get("review_list", [])
         product.failed_urls = json_data.get("failed_urls", [])
 
@@ -1,4 +1,34 @@
+from datetime import datetime
+
+from helpers import (
+    AMAZON_BASE_URL,
+    build_review_url,
+    decode_found_under,
+    encode_found_under,
+    iter_mask_bits,
+    parse_review_url,
+)
+
+
 class AmazonReview:
+    # Reviews are the bulk of a product's memory, so no per instance __dict__
+    __slots__ = (
+        "id",
+        "rating",
+        "title",
+        "href",
+        "country",
+        "date",
+        "body",
+        "verified_purchase",
+        "found_helpful",
+        "username",
+        "username_url",
+        "images",
+        "videos",
+        "found_under_mask",
+    )
+
     def __init__(self):
         self.id = ""
         self.rating = 0
@@ -14,9 +44,24 @@ class AmazonReview:
         self.username_url = ""
         self.images = []
         self.videos = []
-        self.found_under = []
+        # One bit per filter combination and page, see helpers.encode_found_under
+        self.found_under_mask = 0
 
-    def to_dict(self):
+    def add_found_under(self, bit: int) -> None:
+        self.found_under_mask |= 1 << bit
+
+    def found_under_urls(self, asin: str, base_url: str = AMAZON_BASE_URL) -> list[str]:
+        return [
+            build_review_url(asin, *decode_found_under(bit), base_url)
+            for bit in iter_mask_bits(self.found_under_mask)
+        ]
+
+    def to_dict(
+        self,
+        asin: str = "",
+        expand_found_under: bool = True,
+        base_url: str = AMAZON_BASE_URL,
+    ):
         return {
             "id": self.id,
             "rating": self.rating,
@@ -34,5 +79,35 @@ class AmazonReview:
             "username_url": self.username_url,
             "images": self.images,
             "videos": self.videos,
-            "found_under": self.found_under,
+            "found_under": (
+                self.found_under_urls(asin, base_url)
+                if expand_found_under
+                else list(iter_mask_bits(self.found_under_mask))
+            ),
         }
+
+    @staticmethod
+    def from_dict(data: dict) -> "AmazonReview":
+        """Inverse of to_dict, found under urls are folded back into the mask"""
+        review = AmazonReview()
+        review.id = data.get("id", "")
+        review.rating = data.get("rating", 0)
+        review.title = data.get("title", "")
+        review.href = data.get("href", "")
+        review.country = data.get("country", "")
+        review.date = datetime.fromisoformat(data["date"]) if data.get("date") else None
+        review.body = data.get("body", "")
+        review.verified_purchase = data.get("verified_purchase", False)
+        review.found_helpful = data.get("found_helpful", 0)
+        review.username = data.get("username", "")
+        review.username_url = data.get("username_url", "")
+        review.images = data.get("images") or []
+        review.videos = data.get("videos") or []
+        for found_under in data.get("found_under") or []:
+            if isinstance(found_under, int):
+                review.add_found_under(found_under)
+                continue
+            parsed = parse_review_url(found_under)
+            if parsed is not None:
+                review.add_found_under(encode_found_under(*parsed[2:]))
+        return review
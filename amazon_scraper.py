@@ -1,292 +1,793 @@
-import json
-import os
-from bs4 import BeautifulSoup
 import asyncio
-from typing import Optional, Dict, List
-
-import pandas as pd
-from helpers import (
-    AmazonFilterFormatType,
-    AmazonFilterMediaType,
-    AmazonFilterSortBy,
-    AmazonFilterStarRating,
-    extract_float_from_phrase,
-    extract_integer,
-    parse_review_date_and_country,
-    parse_reviews_count,
-)
+from dataclasses import replace
+from typing import AsyncIterable, Iterable, Optional, Dict, List, Set, Union
+
 from amazon_product import AmazonProduct
-from amazon_review import AmazonReview
+from asin_scheduler import AsinScheduler
+from background_io import BackgroundIO
+from helpers import STAR_RATING_VALUES, AmazonFilterSortBy, in_date_window
+from marketplace import configured_marketplaces
+from metrics import METRICS, MetricsReporter
+from connection_pool import SharedTransport
+from page_parser import PageOutcome, ParsedPage
+from progress_store import ProgressStore, Watermarks
+from request_planner import FilterPlan, RequestPlanner
+from result_writer import create_result_writer
+from retry_queue import RetryItem, RetryQueue
+from review_store import SeenReviewStore
 from scraping_config import ScrapingConfig
 from http_methods import HttpMethods
+from work_queue import STATUS_DONE, STATUS_FAILED, WorkQueue, WorkerLeases
 from tqdm import tqdm
 
 
 class AmazonScraper:
-    def __init__(self, config: Optional[ScrapingConfig] = None):
+    def __init__(
+        self,
+        config: Optional[ScrapingConfig] = None,
+        transport: Optional[SharedTransport] = None,
+    ):
         self.config = config or ScrapingConfig()
-        self.http_methods = HttpMethods(config=self.config)
+        # Cache, journal and seen review writes share one writer thread
+        self.io = BackgroundIO(config=self.config)
+        self.http_methods = HttpMethods(
+            config=self.config, transport=transport, io=self.io
+        )
+        self.marketplaces = configured_marketplaces(self.config)
+        # Every store gets its own urls, seen review ids and retry queue
+        self.planners = {
+            marketplace.name: RequestPlanner(
+                config=self.config, base_url=marketplace.base_url
+            )
+            for marketplace in self.marketplaces
+        }
+        self.seen_reviews = {
+            marketplace.name: SeenReviewStore(
+                config=self.config, marketplace=marketplace.name
+            )
+            for marketplace in self.marketplaces
+        }
+        self.progress_store = ProgressStore(config=self.config)
+        self.retry_queues = {
+            marketplace.name: RetryQueue(config=self.config)
+            for marketplace in self.marketplaces
+        }
+        self.result_writer = create_result_writer(
+            config=self.config, on_written=self.__record_written
+        )
+        # (marketplace, ASIN) -> [product, failed pages still in the retry queue]
+        self.__parked = {}
+        # (marketplace, ASIN) -> newest review per branch, journaled once written
+        self.__watermarks: Dict[tuple, Watermarks] = {}
+        # (marketplace, ASIN) refreshed into a writer that only gets the new reviews
+        self.__refreshed: Set[tuple] = set()
+        # Set while crawling from a shared work queue
+        self.leases: Optional[WorkerLeases] = None
+
+    @property
+    def pages_per_asin(self) -> int:
+        """Upper bound of pages requested for one product"""
+        planner = next(iter(self.planners.values()))
+        return sum(plan.max_pages for plan in planner.full_matrix())
 
     async def __aenter__(self):
         return self
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.result_writer.close()
         if self.http_methods:
-            await self.http_methods.session.close()
+            await self.http_methods.close()
+        # Flushes the journal updates queued by the result writer callbacks
+        await self.io.close()
+        self.progress_store.close()
 
-    def __parse_review(self, review_element: BeautifulSoup) -> Optional[AmazonReview]:
-        """Parse a single review"""
+    async def __process_page(
+        self,
+        url: str,
+        asin: str,
+        semaphore: asyncio.Semaphore,
+        fresh: bool = False,
+    ) -> tuple[str, ParsedPage]:
+        """Process a single page with semaphore control"""
+        async with METRICS.async_timer("semaphore_wait_seconds"):
+            await semaphore.acquire()
         try:
-            review = AmazonReview()
+            page = await self.http_methods.get_and_parse_url(url, fresh)
+            return url, page
+        finally:
+            semaphore.release()
+
+    def __in_date_window(self, review) -> bool:
+        return in_date_window(
+            review.date, self.config.review_start_date, self.config.review_end_date
+        )
 
-            # Get review ID
-            review.id = review_element.get("id")
-            if not review.id:
-                return None
+    def __reached_start_date(self, plan: FilterPlan, page: ParsedPage) -> bool:
+        """Whether a most recent first branch has paged past the start of the window"""
+        if (
+            plan.sort_by != AmazonFilterSortBy.RECENT
+            or not self.config.review_start_date
+        ):
+            return False
+        dates = [review.date for review in page.reviews if review.date]
+        return bool(dates) and min(dates) < self.config.review_start_date
+
+    def __note_watermark(
+        self, product: AmazonProduct, plan: FilterPlan, page: ParsedPage
+    ) -> None:
+        """
+        Remember the newest review a most recent first branch kept, from the
+        first of its pages, in order, that kept one. Called before merging.
+        """
+        if plan.sort_by != AmazonFilterSortBy.RECENT:
+            return
+        watermarks = self.__watermarks.setdefault(
+            (product.marketplace, product.asin), {}
+        )
+        if plan.branch_key in watermarks:
+            return
+        # Never past reviews the date window dropped, newer ones included. A
+        # refresh has no end date and picks those up from the top of the branch
+        kept = [review for review in page.reviews if self.__in_date_window(review)]
+        if kept:
+            watermarks[plan.branch_key] = (kept[0].id, kept[0].date)
 
-            # Get review title and rating
-            rating_element = review_element.find(
-                "i", {"data-hook": "review-star-rating"}
-            )
-            if not rating_element:
-                rating_element = review_element.find(
-                    "i", {"data-hook": "cmps-review-star-rating"}
-                )
-            if rating_element:
-                review.rating = extract_float_from_phrase(rating_element.get_text())
-
-            # Get title
-            title_element = review_element.find("a", {"data-hook": "review-title"})
-            if not title_element:
-                title_element = review_element.find(
-                    "span", {"data-hook": "review-title"}
+    def __merge_page(
+        self,
+        product: AmazonProduct,
+        page: ParsedPage,
+        plan: FilterPlan,
+        page_number: int,
+    ) -> None:
+        if self.config.review_start_date or self.config.review_end_date:
+            page.reviews = [
+                review for review in page.reviews if self.__in_date_window(review)
+            ]
+        if self.config.skip_seen_reviews:
+            # Parser workers only know about earlier runs, this also covers this one
+            page.reviews = [
+                review
+                for review in page.reviews
+                if review.id not in self.seen_reviews[product.marketplace]
+            ]
+        product.merge_page(page, plan.found_under_bit(page_number))
+
+    def __is_retryable(self, page: ParsedPage) -> bool:
+        # Captchas, login walls, 403s and server errors are usually temporary
+        return page.outcome not in [
+            PageOutcome.OK,
+            PageOutcome.NO_REVIEWS,
+            PageOutcome.NOT_FOUND,
+        ]
+
+    async def __scrape_filter_branch(
+        self,
+        product: AmazonProduct,
+        plan: FilterPlan,
+        semaphore: asyncio.Semaphore,
+        progress_bar: Optional[tqdm] = None,
+        start_page: int = 1,
+    ) -> Optional[RetryItem]:
+        """
+        Walk the pages of a single filter combination in order. Page N+1 is only
+        requested when page N came back full, so the branch stops at the first
+        short, empty or failed page. Returns the failed page if it is worth retrying.
+        """
+        retry_item = None
+        page_number = start_page - 1
+        for page_number in range(start_page, plan.max_pages + 1):
+            url = plan.url(product.asin, page_number)
+            _, page = await self.__process_page(url, product.asin, semaphore)
+            if progress_bar is not None:
+                progress_bar.update(1)
+
+            if page.outcome != PageOutcome.OK:
+                if page.outcome != PageOutcome.NO_REVIEWS:
+                    product.failed_urls.append(url)
+                if self.__is_retryable(page):
+                    retry_item = RetryItem(
+                        product.asin,
+                        url,
+                        plan,
+                        page_number,
+                        marketplace=product.marketplace,
+                    )
+                break
+
+            self.__note_watermark(product, plan, page)
+            # Checked before merging, which drops the reviews outside the window
+            reached_start_date = self.__reached_start_date(plan, page)
+            self.__merge_page(product, page, plan, page_number)
+            if page.review_count < self.config.reviews_per_page:
+                break
+            if reached_start_date:
+                break
+
+        # Account for the pages we never had to request
+        if progress_bar is not None:
+            progress_bar.update(plan.max_pages - page_number)
+        return retry_item
+
+    async def __plan_product(
+        self,
+        product: AmazonProduct,
+        semaphore: asyncio.Semaphore,
+        retry_items: List[RetryItem],
+        progress_bar: Optional[tqdm] = None,
+    ) -> list[tuple[FilterPlan, int]]:
+        """
+        Fetch the probe page of a product and let the planner pick the branches
+        to crawl from the counts on it. Returns each branch with its first page.
+        """
+        planner = self.planners[product.marketplace]
+        probe = planner.probe()
+        url = probe.url(product.asin, 1)
+        _, page = await self.__process_page(url, product.asin, semaphore)
+        if progress_bar is not None:
+            progress_bar.update(1)
+
+        if page.outcome == PageOutcome.NO_REVIEWS:
+            return []
+
+        if page.outcome == PageOutcome.NOT_FOUND:
+            # A delisted ASIN 404s under every filter as well
+            product.failed_urls.append(url)
+            return []
+
+        if page.outcome != PageOutcome.OK:
+            # Without the counts we cannot do better than the full matrix
+            product.failed_urls.append(url)
+            if self.__is_retryable(page):
+                retry_items.append(
+                    RetryItem(
+                        product.asin, url, probe, 1, marketplace=product.marketplace
+                    )
                 )
-            if title_element:
-                review.href = title_element.get("href")
-                if review.href:
-                    spans = title_element.find_all("span")
-                    if spans and len(spans) >= 3:
-                        review.title = spans[2].get_text().strip()
-                else:
-                    review.title = title_element.get_text().strip()
-
-            # Get review date and country
-            date_element = review_element.find("span", {"data-hook": "review-date"})
-            if date_element:
-                date_info = parse_review_date_and_country(date_element.get_text())
-                if date_info:
-                    review.country = date_info["country"]
-                    review.date = date_info["date"]
-
-            # Get review body
-            body_element = review_element.find("span", {"data-hook": "review-body"})
-            if body_element:
-                review.body = body_element.get_text().strip()
-
-            # Check if verified purchase
-            verified_element = review_element.find("span", {"data-hook": "avp-badge"})
-            review.verified_purchase = bool(verified_element)
-
-            # Get helpful votes
-            helpful_element = review_element.find(
-                "span", {"data-hook": "helpful-vote-statement"}
+            return [(plan, 1) for plan in planner.full_matrix()]
+
+        self.__note_watermark(product, probe, page)
+        # Checked before merging, which drops the reviews outside the window
+        reached_start_date = self.__reached_start_date(probe, page)
+        self.__merge_page(product, page, probe, 1)
+        review_count = page.review_count
+        # Ratings bound the reviews from above when the review count is missing
+        total_count = product.total_reviews_count or product.total_rating_count
+        if not total_count and review_count >= self.config.reviews_per_page:
+            # A full probe page but no counts to size the product by
+            plans = planner.full_matrix()
+        else:
+            plans = planner.plan(
+                max(total_count, review_count), product.star_percentages
             )
-            if helpful_element:
-                text = helpful_element.get_text()
-                if "One" in text:
-                    review.found_helpful = 1
-                else:
-                    review.found_helpful = (
-                        extract_integer(helpful_element.get_text()) or 0
-                    )
 
-            # Get username
-            username_element = review_element.find("span", {"class": "a-profile-name"})
-            if username_element:
-                review.username = username_element.get_text()
-                username_url = username_element.find_parent("a")
-                if username_url:
-                    review.username_url = username_url.get("href")
-
-            # Get images
-            image_elements = review_element.find_all(
-                "img", {"data-hook": "review-image-tile"}
-            )
-            if image_elements:
-                for element in image_elements:
-                    src = element.get("src")
-                    if src:
-                        review.images.append(src)
-
-            other_countries_images_elements = review_element.find_all(
-                "img", {"data-hook": "cmps-review-image-tile"}
+        branches = []
+        for plan in plans:
+            if plan.same_filter(probe):
+                # The probe already is page 1 of this branch
+                if review_count < self.config.reviews_per_page or reached_start_date:
+                    continue
+                branches.append((plan, 2))
+            else:
+                branches.append((plan, 1))
+        return branches
+
+    async def __refresh_branch(
+        self,
+        product: AmazonProduct,
+        plan: FilterPlan,
+        known: tuple,
+        semaphore: asyncio.Semaphore,
+        progress_bar: Optional[tqdm] = None,
+    ) -> int:
+        """
+        Walk a most recent first branch from fresh pages until it reaches the
+        newest review recorded for it. Returns the number of pages requested.
+
+        The new watermark of the branch is only kept once the branch caught up
+        with the old one, otherwise the reviews in between would be skipped
+        for good. The branch then starts over from the old one next time.
+        """
+        known_id, known_date = known
+        caught_up = False
+        page_number = 0
+        for page_number in range(1, plan.max_pages + 1):
+            url = plan.url(product.asin, page_number)
+            _, page = await self.__process_page(
+                url, product.asin, semaphore, fresh=True
             )
-            if other_countries_images_elements:
-                for element in other_countries_images_elements:
-                    src = element.get("src")
-                    if src:
-                        review.images.append(src)
-
-            # Get videos
-            if body_element:
-                video_elements = body_element.find_all(
-                    "div", {"data-review-id": review.id}
-                )
-                if video_elements:
-                    for element in video_elements:
-                        src = element.get("data-video-url")
-                        if src:
-                            review.videos.append(src)
+            if progress_bar is not None:
+                progress_bar.update(1)
 
-            return review
+            if page.outcome != PageOutcome.OK:
+                # Not retried, the branch keeps its old watermark instead
+                if page.outcome != PageOutcome.NO_REVIEWS:
+                    product.failed_urls.append(url)
+                caught_up = page.outcome == PageOutcome.NO_REVIEWS
+                break
+
+            self.__note_watermark(product, plan, page)
+            review_ids = [review.id for review in page.reviews]
+            if known_id in review_ids:
+                page.reviews = page.reviews[: review_ids.index(known_id)]
+                reached_known = True
+            else:
+                # The known review may be gone, its date still bounds the branch
+                reached_known = known_date is not None and any(
+                    review.date and review.date < known_date for review in page.reviews
+                )
+                if known_date is not None:
+                    page.reviews = [
+                        review
+                        for review in page.reviews
+                        if not review.date or review.date >= known_date
+                    ]
+            self.__merge_page(product, page, plan, page_number)
+            if reached_known or page.review_count < self.config.reviews_per_page:
+                caught_up = True
+                break
+
+        if not caught_up:
+            self.__watermarks.get((product.marketplace, product.asin), {}).pop(
+                plan.branch_key, None
+            )
+        return page_number
 
-        except Exception as e:
-            print(f"Error parsing review: {e}")
+    async def __refresh_product(
+        self,
+        asin: str,
+        marketplace: str,
+        semaphore: asyncio.Semaphore,
+        progress_bar: Optional[tqdm] = None,
+    ) -> Optional[AmazonProduct]:
+        """
+        Fetch only the reviews newer than the ones recorded for a product that
+        was crawled before and merge them into it. Returns None when there is
+        nothing to refresh from.
+        """
+        known = await self.io.read(self.progress_store.watermarks, asin, marketplace)
+        stored = None
+        if known and self.result_writer.keeps_whole_products:
+            stored = await self.io.read(self.result_writer.load, asin, marketplace)
+            if stored is None:
+                return None
+        branches = [
+            plan
+            for plan in self.planners[marketplace].refresh_branches()
+            if plan.branch_key in known
+        ]
+        if not branches:
             return None
 
-    async def __process_page(
-        self, url: str, asin: str, semaphore: asyncio.Semaphore
-    ) -> tuple[str, Optional[str]]:
-        """Process a single page with semaphore control"""
-        async with semaphore:
-            content = await self.http_methods.get_and_download_url(url)
-            return url, content
+        product = AmazonProduct(asin=asin, marketplace=marketplace)
+        # New reviews always surface on the unfiltered branch first
+        unfiltered = [plan for plan in branches if plan.star_rating is None]
+        pages = 0
+        for plan in unfiltered:
+            pages += await self.__refresh_branch(
+                product, plan, known[plan.branch_key], semaphore, progress_bar
+            )
+        # Star branches only move for the ratings the new reviews came in with
+        ratings = {round(review.rating or 0) for review in product.review_list}
+        starred = [
+            plan
+            for plan in branches
+            if plan.star_rating is not None
+            and (not unfiltered or STAR_RATING_VALUES[plan.star_rating] in ratings)
+        ]
+        pages += sum(
+            await asyncio.gather(
+                *[
+                    self.__refresh_branch(
+                        product, plan, known[plan.branch_key], semaphore, progress_bar
+                    )
+                    for plan in starred
+                ]
+            )
+        )
+
+        if progress_bar is not None and progress_bar.total is not None:
+            progress_bar.total += pages - self.pages_per_asin
+            progress_bar.refresh()
+
+        if not product.review_list:
+            print(f"No new reviews for ASIN {asin} on {marketplace}")
+            key = (marketplace, asin)
+            await self.io.write(
+                self.progress_store.record_watermarks,
+                asin,
+                marketplace,
+                self.__watermarks.pop(key, {}),
+            )
+            if self.leases:
+                status = STATUS_FAILED if product.failed_urls else STATUS_DONE
+                await self.leases.finish([key], status)
+            return product
+
+        print(f"Refreshed ASIN {asin} on {marketplace} from {pages} pages")
+        if stored is not None:
+            stored.merge_product(product)
+            product = stored
+        else:
+            # Only the new reviews are written, the journal adds them up
+            self.__refreshed.add((marketplace, asin))
+        await self.__mark_complete(product=product)
+        return product
 
     async def __scrape_product_reviews(
         self,
         asin: str,
+        marketplace: str,
         semaphore: asyncio.Semaphore,
-        target_df: pd.DataFrame,
         progress_bar: Optional[tqdm] = None,
     ) -> AmazonProduct:
-        tasks = []
+        if self.config.incremental_refresh:
+            product = await self.__refresh_product(
+                asin, marketplace, semaphore, progress_bar
+            )
+            if product is not None:
+                return product
+            # Crawled before watermarks were kept, or never, so crawl it in full
+
+        product = AmazonProduct(asin=asin, marketplace=marketplace)
+        retry_items = []
+
+        if self.config.plan_requests:
+            branches = await self.__plan_product(
+                product, semaphore, retry_items, progress_bar
+            )
+        else:
+            branches = [(plan, 1) for plan in self.planners[marketplace].full_matrix()]
+
+        if progress_bar is not None and progress_bar.total is not None:
+            # The bar starts out sized for the full matrix of every product
+            planned_pages = sum(plan.max_pages - start + 1 for plan, start in branches)
+            if self.config.plan_requests:
+                planned_pages += 1
+            progress_bar.total += planned_pages - self.pages_per_asin
+            progress_bar.refresh()
+
+        if self.config.adaptive_pagination:
+            # Filter branches run concurrently, pages within a branch sequentially
+            branch_retry_items = await asyncio.gather(
+                *[
+                    self.__scrape_filter_branch(
+                        product, plan, semaphore, progress_bar, start_page
+                    )
+                    for plan, start_page in branches
+                ]
+            )
+            retry_items.extend(item for item in branch_retry_items if item)
+            await self.__finish_product(product, retry_items)
+            return product
 
         # Generate all URLs first
-        for sort_by in AmazonFilterSortBy:
-            for star_rating in AmazonFilterStarRating:
-                for format_type in AmazonFilterFormatType:
-                    for media_type in AmazonFilterMediaType:
-                        for page_number in range(1, self.config.max_pages + 1):
-                            url = f"https://www.amazon.com/product-reviews/{asin}?sortBy={sort_by.value}&pageNumber={page_number}&filterByStar={star_rating.value}&formatType={format_type.value}&mediaType={media_type.value}"
-                            tasks.append(self.__process_page(url, asin, semaphore))
+        pages = [
+            (plan, page_number)
+            for plan, start_page in branches
+            for page_number in range(start_page, plan.max_pages + 1)
+        ]
+        tasks = [
+            self.__process_page(plan.url(asin, page_number), asin, semaphore)
+            for plan, page_number in pages
+        ]
 
         # Process all pages concurrently
         results = await asyncio.gather(*tasks)
 
-        product = AmazonProduct(asin=asin)
-
         # Process results
-        for url, page_content in results:
-            if progress_bar:
+        for (plan, page_number), (url, page) in zip(pages, results):
+            if progress_bar is not None:
                 progress_bar.update(1)
 
-            if not page_content:
-                product.failed_urls.append(url)
+            if page.outcome != PageOutcome.OK:
+                if page.outcome != PageOutcome.NO_REVIEWS:
+                    product.failed_urls.append(url)
+                if self.__is_retryable(page):
+                    # Retry just this page, not the rest of its branch
+                    single_page = replace(plan, max_pages=page_number)
+                    retry_items.append(
+                        RetryItem(
+                            asin,
+                            url,
+                            single_page,
+                            page_number,
+                            marketplace=marketplace,
+                        )
+                    )
                 continue
 
-            soup = BeautifulSoup(page_content, "html.parser")
+            self.__note_watermark(product, plan, page)
+            self.__merge_page(product, page, plan, page_number)
 
-            # Update product info if not already set
-            if product.name == "":
-                product_element = soup.find("a", {"data-hook": "product-link"})
-                if product_element:
-                    product.name = product_element.get_text().strip()
+        await self.__finish_product(product, retry_items)
+        return product
 
-            if product.overall_rating == 0:
-                rating_element = soup.find("span", {"data-hook": "rating-out-of-text"})
-                if rating_element:
-                    product.overall_rating = extract_float_from_phrase(
-                        rating_element.get_text()
-                    )
+    async def __finish_product(
+        self, product: AmazonProduct, retry_items: List[RetryItem]
+    ) -> None:
+        if self.config.retry_stage and retry_items:
+            # Hold the product back until the retry stage had a go at its pages
+            self.__parked[(product.marketplace, product.asin)] = [
+                product,
+                len(retry_items),
+            ]
+            for retry_item in retry_items:
+                self.retry_queues[product.marketplace].push(retry_item)
+            return
+        await self.__mark_complete(product=product)
+
+    async def __retry_page(
+        self,
+        item: RetryItem,
+        semaphore: asyncio.Semaphore,
+        progress_bar: Optional[tqdm] = None,
+    ) -> None:
+        key = (item.marketplace, item.asin)
+        product = self.__parked[key][0]
+        retry_item = None
+        try:
+            # Wait for the host to calm down instead of feeding it more blocks
+            governor = self.http_methods.governor.for_host(item.url)
+            while not governor.is_calm(self.config.retry_stage_quiet_period):
+                await asyncio.sleep(1)
+
+            if item.url in product.failed_urls:
+                product.failed_urls.remove(item.url)
+            # A cached captcha would otherwise fail the retry right away
+            await self.http_methods.forget_negative(item.url)
+            if progress_bar is not None and progress_bar.total is not None:
+                progress_bar.total += item.plan.max_pages - item.page_number + 1
+                progress_bar.refresh()
+            # Picks the branch up again from the failed page
+            retry_item = await self.__scrape_filter_branch(
+                product, item.plan, semaphore, progress_bar, item.page_number
+            )
+        except Exception as e:
+            print(f"Error retrying {item.url}: {repr(e)}")
+
+        if retry_item and item.attempts + 1 < self.config.retry_stage_attempts:
+            retry_item.attempts = item.attempts + 1
+            self.retry_queues[item.marketplace].push(retry_item)
+            return
 
-            rating_count_element = soup.find("div", {"data-hook": "total-review-count"})
-            if rating_count_element:
-                count = extract_integer(rating_count_element.get_text())
-                if count > product.total_rating_count:
-                    product.total_rating_count = count
+        self.__parked[key][1] -= 1
+        if self.__parked[key][1] == 0:
+            del self.__parked[key]
+            await self.__mark_complete(product=product)
 
-            total_reviews_count_element = soup.find(
-                "div", {"data-hook": "cr-filter-info-review-rating-count"}
+    async def __run_retry_stage(
+        self,
+        marketplace: str,
+        semaphore: asyncio.Semaphore,
+        progress_bar: Optional[tqdm] = None,
+    ) -> None:
+        """Retry failed pages of a store after its main crawl and complete their products"""
+        retry_queue = self.retry_queues[marketplace]
+        parked = sum(1 for key in self.__parked if key[0] == marketplace)
+        if parked:
+            print(
+                f"Retrying {len(retry_queue)} failed pages "
+                f"of {parked} products on {marketplace}"
             )
-            if total_reviews_count_element:
-                count = parse_reviews_count(total_reviews_count_element.get_text())
-                if count > product.total_reviews_count:
-                    product.total_reviews_count = count
-
-            # Parse reviews
-            review_elements = soup.find_all("div", {"data-hook": "review"})
-            for review_element in review_elements:
-                review = self.__parse_review(review_element)
-                if review:
-                    review.found_under.append(url)
-                    existing_review = next(
-                        (r for r in product.review_list if r.id == review.id), None
-                    )
-                    if existing_review:
-                        if url not in existing_review.found_under:
-                            existing_review.found_under.append(url)
-                    else:
-                        product.review_list.append(review)
 
-        self.__mark_complete(df=target_df, product=product)
-        return product
+        tasks = set()
+        while len(retry_queue) or tasks:
+            if not len(retry_queue):
+                # Running retries may still queue up another attempt
+                _, tasks = await asyncio.wait(
+                    tasks, return_when=asyncio.FIRST_COMPLETED
+                )
+                continue
+            item = await retry_queue.pop()
+            tasks.add(
+                asyncio.create_task(self.__retry_page(item, semaphore, progress_bar))
+            )
 
-    def __mark_complete(self, df: pd.DataFrame, product: AmazonProduct):
+    async def __mark_complete(self, product: AmazonProduct):
         print(
-            f"Found {len(product.review_list)} unique reviews for ASIN {product.asin}"
+            f"Found {len(product.review_list)} unique reviews "
+            f"for ASIN {product.asin} on {product.marketplace}"
         )
-        # Ensure the directory exists
-        output_dir = "./data/pfw/results/"
-        os.makedirs(output_dir, exist_ok=True)
-
-        # Write product data to a JSON file
-        file_path = os.path.join(output_dir, f"{product['asin']}.json")
-        with open(file_path, "w") as json_file:
-            json.dump(product.to_dict(), json_file, indent=4)
-            print(f"File successfully created: {file_path}")
-
-        if len(product.review_list) == 0:
-            print(f"no reviews found for: {product.asin}")
-            return
+        await self.result_writer.write(product)
+
+    def __journal_written(
+        self,
+        products: List[AmazonProduct],
+        watermarks: Dict[tuple, Watermarks],
+        refreshed: Set[tuple],
+    ) -> None:
+        """Runs on the writer thread"""
+        for product in products:
+            key = (product.marketplace, product.asin)
+            if watermarks.get(key):
+                self.progress_store.record_watermarks(
+                    product.asin, product.marketplace, watermarks[key]
+                )
+            # Only record ids once they are safely written out
+            self.seen_reviews[product.marketplace].add_many(
+                review.id for review in product.review_list
+            )
+
+            if len(product.review_list) == 0:
+                print(f"no reviews found for: {product.asin} on {product.marketplace}")
+                self.progress_store.mark_failed(
+                    product.asin,
+                    failed_url_count=len(product.failed_urls),
+                    marketplace=product.marketplace,
+                )
+                continue
+
+            if key in refreshed:
+                self.progress_store.mark_refreshed(
+                    product.asin,
+                    len(product.review_list),
+                    len(product.failed_urls),
+                    marketplace=product.marketplace,
+                )
+                continue
+            self.progress_store.mark_complete(
+                product.asin,
+                len(product.review_list),
+                len(product.failed_urls),
+                marketplace=product.marketplace,
+            )
+        print(f"Marked {len(products)} as complete.")
+
+    async def __record_written(self, products: List[AmazonProduct]) -> None:
+        """Journal products once the result writer has them safely on disk"""
+        watermarks = {
+            (product.marketplace, product.asin): self.__watermarks.pop(
+                (product.marketplace, product.asin), {}
+            )
+            for product in products
+        }
+        refreshed = {key for key in watermarks if key in self.__refreshed}
+        self.__refreshed.difference_update(refreshed)
+        await self.io.write(self.__journal_written, products, watermarks, refreshed)
+        if self.leases:
+            await self.leases.finish(
+                [(product.marketplace, product.asin) for product in products]
+            )
+
+    async def __scrape_asin(
+        self,
+        asin: str,
+        marketplace: str,
+        semaphore: asyncio.Semaphore,
+        progress_bar: Optional[tqdm] = None,
+    ) -> Optional[AmazonProduct]:
+        """Scrape one ASIN, recording it as failed instead of raising"""
+        try:
+            return await self.__scrape_product_reviews(
+                asin, marketplace, semaphore, progress_bar
+            )
+        except Exception as e:
+            print(f"Error scraping ASIN {asin} on {marketplace}: {repr(e)}")
+            self.__watermarks.pop((marketplace, asin), None)
+            self.__refreshed.discard((marketplace, asin))
+            await self.io.write(
+                self.progress_store.mark_failed, asin, 0, 0, marketplace
+            )
+            if self.leases:
+                await self.leases.finish([(marketplace, asin)], STATUS_FAILED)
+            return None
+
+    async def __release_held(
+        self,
+        marketplace: str,
+        semaphore: asyncio.Semaphore,
+        progress_bar: Optional[tqdm] = None,
+    ) -> None:
+        """
+        Finish the leased products that would otherwise wait for the end of the
+        crawl, once the shared queue runs dry. Products parked for retries and
+        products sitting in a writer batch keep their leases, and other workers
+        wait for those leases just like this one waits for theirs.
+        """
+        await self.__run_retry_stage(marketplace, semaphore, progress_bar)
+        await self.result_writer.drain()
+
+    async def __crawl_marketplace(
+        self,
+        marketplace: str,
+        asins: Union[Iterable[str], AsyncIterable[str], WorkerLeases],
+        progress_bar: Optional[tqdm] = None,
+    ) -> None:
+        """Crawl one store with its own request limit, then retry its failed pages"""
+        # Per store, so a store that blocks never eats the other's slots
+        semaphore = asyncio.Semaphore(self.config.max_concurrent_requests)
+        if isinstance(asins, WorkerLeases):
+            asins = asins.asins(
+                marketplace,
+                on_idle=lambda: self.__release_held(
+                    marketplace, semaphore, progress_bar
+                ),
+            )
 
-        # Update the `review_complete` column for the current chunk
-        asin_index = df.index[df["asin"] == product.asin]
-        df.loc[asin_index, "review_complete"] = 1
-
-        # Save updated DataFrame to a file (e.g., a checkpoint)
-        df.to_pickle("./data/pfw/04_extract_reviews.pkl")
-        df.to_csv("./data/pfw/04_extract_reviews.csv")
-        print("Marked as complete and saved to disk.")
-
-    async def scrape_asins(self, asins: List[str], target_df: pd.DataFrame):
-        # Calculate total pages across all ASINs
-        pages_per_asin = (
-            len(AmazonFilterSortBy)
-            * len(AmazonFilterStarRating)
-            * len(AmazonFilterFormatType)
-            * len(AmazonFilterMediaType)
-            * self.config.max_pages
+        # Stream ASINs through a fixed number of product workers
+        scheduler = AsinScheduler(
+            handler=lambda asin: self.__scrape_asin(
+                asin, marketplace, semaphore, progress_bar
+            ),
+            max_in_flight=self.config.max_concurrent_products,
         )
-        total_pages = len(asins) * pages_per_asin
+        await scheduler.run(asins)
+        await self.__run_retry_stage(marketplace, semaphore, progress_bar)
 
+    async def __crawl(
+        self,
+        sources: Dict[str, Union[Iterable[str], AsyncIterable[str], WorkerLeases]],
+        total_pages: Optional[int] = None,
+    ) -> None:
+        """Crawl every store concurrently, each from its own ASIN source"""
         # Create progress bar
         progress_bar = tqdm(
             total=total_pages, desc="Scraping Progress", position=0, leave=True
         )
 
-        # Create semaphore for controlling concurrent requests
-        semaphore = asyncio.Semaphore(self.config.max_concurrent_requests)
-
-        # Process all ASINs concurrently
-        tasks = [
-            self.__scrape_product_reviews(asin, semaphore, target_df, progress_bar)
-            for asin in asins
-        ]
-        # products = await asyncio.gather(*tasks)
-        await asyncio.gather(*tasks)
+        reporter = MetricsReporter(config=self.config)
+        await reporter.start()
+        try:
+            await asyncio.gather(
+                *[
+                    self.__crawl_marketplace(marketplace, asins, progress_bar)
+                    for marketplace, asins in sources.items()
+                ]
+            )
+            # Batched writers may still hold the last products
+            await self.result_writer.drain()
+        finally:
+            await reporter.stop()
 
         progress_bar.close()
-        # return [product.to_dict() for product in products if product]
+
+    async def scrape_asins(
+        self,
+        asins: Union[Iterable[str], AsyncIterable[str], Dict[str, List[str]]],
+    ):
+        """Crawl the same ASINs on every store, or each store's own ASINs from a dict"""
+        if isinstance(asins, dict):
+            sources = {
+                marketplace.name: asins.get(marketplace.name, [])
+                for marketplace in self.marketplaces
+            }
+            total_pages = (
+                sum(len(store_asins) for store_asins in sources.values())
+                * self.pages_per_asin
+            )
+            await self.__crawl(sources, total_pages)
+            return
+
+        if len(self.marketplaces) > 1 and not hasattr(asins, "__len__"):
+            if hasattr(asins, "__aiter__"):
+                raise ValueError("Several marketplaces need a list of ASINs")
+            # Every store walks the same ASINs
+            asins = list(asins)
+
+        # Calculate total pages across all ASINs, products shrink it once planned
+        total_pages = (
+            len(asins) * len(self.marketplaces) * self.pages_per_asin
+            if hasattr(asins, "__len__")
+            else None
+        )
+        await self.__crawl(
+            {marketplace.name: asins for marketplace in self.marketplaces},
+            total_pages,
+        )
+
+    async def scrape_queue(self, work_queue: WorkQueue):
+        """Crawl ASINs leased from a queue shared with other workers until it runs dry"""
+        self.leases = WorkerLeases(work_queue, self.io, config=self.config)
+        print(
+            f"Worker {self.leases.worker_id} leasing from {self.config.work_queue_path}"
+        )
+        try:
+            await self.__crawl(
+                {marketplace.name: self.leases for marketplace in self.marketplaces}
+            )
+        finally:
+            await self.leases.close()
+            self.leases = None
 
     def scrape_asins_concurrently(self, asins: List[str]) -> List[Dict]:
         """Synchronous wrapper for backwards compatibility"""
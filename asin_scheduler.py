@@ -0,0 +1,56 @@
+import asyncio
+from typing import AsyncIterable, Awaitable, Callable, Iterable, Optional, Union
+
+
+class AsinScheduler:
+    """
+    Streams ASINs through a bounded queue to a fixed pool of product workers.
+
+    A worker picks up the next ASIN as soon as its previous one finishes, so a
+    single slow product never holds back a batch, and the number of products
+    in flight stays at `max_in_flight` until the source runs dry.
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[str], Awaitable],
+        max_in_flight: int,
+        queue_size: Optional[int] = None,
+    ):
+        self.handler = handler
+        self.max_in_flight = max_in_flight
+        self.queue_size = queue_size or max_in_flight
+        self.in_flight = 0
+        self.finished = 0
+
+    async def __worker(self, queue: asyncio.Queue) -> None:
+        while True:
+            asin = await queue.get()
+            self.in_flight += 1
+            try:
+                await self.handler(asin)
+            except Exception as e:
+                print(f"Error handling ASIN {asin}: {repr(e)}")
+            finally:
+                self.in_flight -= 1
+                self.finished += 1
+                queue.task_done()
+
+    async def run(self, asins: Union[Iterable[str], AsyncIterable[str]]) -> None:
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        workers = [
+            asyncio.create_task(self.__worker(queue)) for _ in range(self.max_in_flight)
+        ]
+        try:
+            # Putting blocks while the queue is full, which is our backpressure
+            if hasattr(asins, "__aiter__"):
+                async for asin in asins:
+                    await queue.put(asin)
+            else:
+                for asin in asins:
+                    await queue.put(asin)
+            await queue.join()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
@@ -0,0 +1,60 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional, Set
+
+from metrics import METRICS
+from scraping_config import ScrapingConfig
+
+
+class BackgroundIO:
+    """
+    Keeps blocking disk and SQLite work off the event loop.
+
+    Reads run on a small thread pool and are awaited. Writes go to a single
+    writer thread, so they apply in the order they were queued. Callers do not
+    wait for a write unless they ask to, only for room in the queue once
+    `io_write_queue_size` writes are pending, which is the backpressure on
+    slow disks. `flush` waits for every queued write.
+    """
+
+    def __init__(self, config: Optional[ScrapingConfig] = None):
+        self.config = config or ScrapingConfig()
+        self.readers = ThreadPoolExecutor(
+            max_workers=self.config.io_read_threads, thread_name_prefix="io-read"
+        )
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="io-write")
+        self.write_slots = asyncio.Semaphore(self.config.io_write_queue_size)
+        self.pending: Set[asyncio.Future] = set()
+
+    async def read(self, fn: Callable, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.readers, fn, *args)
+
+    async def write(self, fn: Callable, *args, wait: bool = False):
+        """Queue fn(*args) on the writer thread, with wait=True its result is returned"""
+        start_time = time.perf_counter()
+        await self.write_slots.acquire()
+        METRICS.observe("io_write_queue_wait_seconds", time.perf_counter() - start_time)
+
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self.writer, fn, *args)
+        self.pending.add(future)
+        future.add_done_callback(self.__write_done)
+        if wait:
+            return await future
+
+    def __write_done(self, future: asyncio.Future) -> None:
+        self.pending.discard(future)
+        self.write_slots.release()
+        if not future.cancelled() and future.exception():
+            print(f"Background write failed: {repr(future.exception())}")
+
+    async def flush(self) -> None:
+        while self.pending:
+            await asyncio.gather(*self.pending, return_exceptions=True)
+
+    async def close(self) -> None:
+        await self.flush()
+        self.readers.shutdown(wait=True)
+        self.writer.shutdown(wait=True)
@@ -0,0 +1,274 @@
+"""
+Local stand-in for the Amazon review pages.
+
+Serves `/product-reviews/<asin>` from the recorded pages in `data/pfw/pages`
+when one exists for the requested url, and synthetic review html otherwise.
+Latency, captcha, no-reviews and 5xx rates are configurable, as are reviews
+posted since a first crawl and pages that always fail, and every
+random choice comes from a seeded generator so runs are repeatable.
+
+Usage:
+    python benchmarks/mock_amazon.py --port 8765 --latency-ms 50 --captcha-rate 0.01
+"""
+
+import argparse
+import asyncio
+import base64
+import hashlib
+import math
+import random
+from dataclasses import dataclass
+from datetime import date, timedelta
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs
+
+from aiohttp import web
+
+# Recorded pages are named after the real url they were fetched from
+RECORDED_BASE_URL = "https://www.amazon.com"
+
+STAR_FILTERS = {
+    "five_star": 5,
+    "four_star": 4,
+    "three_star": 3,
+    "two_star": 2,
+    "one_star": 1,
+}
+CAPTCHA_HTML = (
+    "<html><body><h4>Enter the characters you see below</h4>"
+    "<form action='/errors/validateCaptcha'></form></body></html>"
+)
+NO_REVIEWS_HTML = (
+    "<html><body><span>Sorry, no reviews match your current selections.</span>"
+    "</body></html>"
+)
+
+
+@dataclass
+class MockServerConfig:
+    host: str = "127.0.0.1"
+    port: int = 8765
+    # Response latency is lognormal around the median, jitter is its sigma
+    latency_ms: float = 50.0
+    latency_jitter: float = 0.5
+    captcha_rate: float = 0.0
+    server_error_rate: float = 0.0
+    # Share of products that have no reviews at all
+    no_reviews_rate: float = 0.0
+    # Review count of a synthetic product is drawn between these
+    min_reviews: int = 0
+    max_reviews: int = 120
+    reviews_per_page: int = 10
+    # Reviews posted since, newer than every other review of a product
+    new_reviews: int = 0
+    # Page numbers that always answer with a 503, e.g. to break a refresh
+    failing_pages: Tuple[int, ...] = ()
+    pages_dir: Optional[str] = "./data/pfw/pages"
+    seed: int = 0
+
+
+def product_seed(asin: str, seed: int) -> int:
+    return int.from_bytes(hashlib.blake2b(f"{seed}:{asin}".encode()).digest()[:8])
+
+
+def review_html(review_id: str, stars: int, review_date: date, helpful: int) -> str:
+    day = review_date.strftime("%B %d, %Y").replace(" 0", " ")
+    return f"""<div id="{review_id}" data-hook="review">
+<span class="a-profile-name">user {review_id}</span>
+<i data-hook="review-star-rating"><span>{stars}.0 out of 5 stars</span></i>
+<a data-hook="review-title" href="/gp/customer-reviews/{review_id}">
+<span>{stars}.0 out of 5 stars</span><span></span><span>Title {review_id}</span></a>
+<span data-hook="review-date">Reviewed in the United States on {day}</span>
+<span data-hook="avp-badge">Verified Purchase</span>
+<span data-hook="review-body"><span>Review body of {review_id}. {"Lorem ipsum dolor sit amet. " * (helpful % 7 + 1)}</span></span>
+<span data-hook="helpful-vote-statement">{helpful} people found this helpful</span>
+</div>"""
+
+
+class SyntheticCatalog:
+    """Deterministic fake reviews for any ASIN"""
+
+    def __init__(self, config: MockServerConfig):
+        self.config = config
+        self.products: Dict[str, List[Tuple[str, int, date, int]]] = {}
+
+    def reviews(self, asin: str) -> List[Tuple[str, int, date, int]]:
+        if asin not in self.products:
+            rng = random.Random(product_seed(asin, self.config.seed))
+            count = 0
+            if rng.random() >= self.config.no_reviews_rate:
+                count = rng.randint(self.config.min_reviews, self.config.max_reviews)
+            newest = date(2024, 12, 31)
+            self.products[asin] = [
+                (
+                    f"R{asin}{i:05d}",
+                    rng.choices([5, 4, 3, 2, 1], weights=[50, 20, 10, 7, 13])[0],
+                    newest - timedelta(days=i // 3),
+                    rng.randint(0, 40),
+                )
+                for i in range(count)
+            ]
+            if self.config.new_reviews:
+                # Drawn separately, the older reviews stay exactly as they were
+                rng = random.Random(product_seed(asin + ":new", self.config.seed))
+                self.products[asin][:0] = [
+                    (
+                        f"N{asin}{i:05d}",
+                        rng.choices([5, 4, 3, 2, 1], weights=[50, 20, 10, 7, 13])[0],
+                        newest + timedelta(days=1 + (self.config.new_reviews - i) // 3),
+                        rng.randint(0, 40),
+                    )
+                    for i in range(self.config.new_reviews)
+                ]
+        return self.products[asin]
+
+    def page(self, asin: str, query: Dict[str, List[str]]) -> str:
+        reviews = self.reviews(asin)
+        star = STAR_FILTERS.get(query.get("filterByStar", [""])[0])
+        page_number = int(query.get("pageNumber", ["1"])[0])
+        matching = [review for review in reviews if star in (None, review[1])]
+        per_page = self.config.reviews_per_page
+        page_reviews = matching[(page_number - 1) * per_page : page_number * per_page]
+        if not page_reviews:
+            return NO_REVIEWS_HTML
+
+        histogram = "".join(
+            f'<tr aria-label="{round(100 * sum(r[1] == stars for r in reviews) / len(reviews))}'
+            f' percent of reviews have {stars} stars"></tr>'
+            for stars in range(5, 0, -1)
+        )
+        average = sum(review[1] for review in reviews) / len(reviews)
+        ratings = math.ceil(len(reviews) * 1.7)
+        body = "".join(review_html(*review) for review in page_reviews)
+        return f"""<html><body>
+<a data-hook="product-link">Product {asin}</a>
+<span data-hook="rating-out-of-text">{average:.1f} out of 5</span>
+<div data-hook="total-review-count">{ratings:,} global ratings</div>
+<div data-hook="cr-filter-info-review-rating-count">{ratings:,} total ratings, {len(matching):,} with reviews</div>
+<table id="histogramTable">{histogram}</table>
+{body}
+</body></html>"""
+
+
+class MockAmazonServer:
+    def __init__(self, config: Optional[MockServerConfig] = None):
+        self.config = config or MockServerConfig()
+        self.catalog = SyntheticCatalog(self.config)
+        self.rng = random.Random(self.config.seed)
+        self.pages_dir = Path(self.config.pages_dir) if self.config.pages_dir else None
+        self.stats = {"requests": 0, "recorded": 0, "captcha": 0, "server_error": 0}
+
+    def __recorded_page(self, request: web.Request) -> Optional[str]:
+        if not self.pages_dir:
+            return None
+        url = RECORDED_BASE_URL + request.path_qs
+        filename = base64.urlsafe_b64encode(url.encode()).decode()
+        if len(filename) > 255:
+            return None
+        file_path = (self.pages_dir / filename).with_suffix(".html")
+        if file_path.exists():
+            return file_path.read_text()
+        return None
+
+    async def __delay(self) -> None:
+        if self.config.latency_ms <= 0:
+            return
+        latency = self.config.latency_ms * math.exp(
+            self.rng.gauss(0, self.config.latency_jitter)
+        )
+        await asyncio.sleep(latency / 1000)
+
+    async def handle_reviews(self, request: web.Request) -> web.Response:
+        self.stats["requests"] += 1
+        await self.__delay()
+
+        roll = self.rng.random()
+        page_number = int(request.query.get("pageNumber", "1"))
+        if page_number in self.config.failing_pages:
+            self.stats["server_error"] += 1
+            return web.Response(status=503)
+        if roll < self.config.server_error_rate:
+            self.stats["server_error"] += 1
+            return web.Response(status=503)
+        if roll < self.config.server_error_rate + self.config.captcha_rate:
+            self.stats["captcha"] += 1
+            return web.Response(text=CAPTCHA_HTML, content_type="text/html")
+
+        if html := self.__recorded_page(request):
+            self.stats["recorded"] += 1
+            return web.Response(text=html, content_type="text/html")
+
+        query = parse_qs(request.query_string)
+        html = self.catalog.page(request.match_info["asin"], query)
+        return web.Response(text=html, content_type="text/html")
+
+    async def handle_stats(self, request: web.Request) -> web.Response:
+        return web.json_response(self.stats)
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/product-reviews/{asin}", self.handle_reviews)
+        app.router.add_get("/_stats", self.handle_stats)
+        return app
+
+    def run(self) -> None:
+        web.run_app(
+            self.app(),
+            host=self.config.host,
+            port=self.config.port,
+            print=None,
+            access_log=None,
+        )
+
+
+def run_server(config: MockServerConfig) -> None:
+    """Process entry point"""
+    MockAmazonServer(config).run()
+
+
+def add_server_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency-ms", type=float, default=50.0)
+    parser.add_argument("--latency-jitter", type=float, default=0.5)
+    parser.add_argument("--captcha-rate", type=float, default=0.0)
+    parser.add_argument("--server-error-rate", type=float, default=0.0)
+    parser.add_argument("--no-reviews-rate", type=float, default=0.0)
+    parser.add_argument("--min-reviews", type=int, default=0)
+    parser.add_argument("--max-reviews", type=int, default=120)
+    parser.add_argument("--new-reviews", type=int, default=0)
+    parser.add_argument("--failing-pages", type=int, nargs="*", default=[])
+    parser.add_argument("--pages-dir", default="./data/pfw/pages")
+    parser.add_argument("--seed", type=int, default=0)
+
+
+def server_config_from_args(args: argparse.Namespace) -> MockServerConfig:
+    return MockServerConfig(
+        host=args.host,
+        port=args.port,
+        latency_ms=args.latency_ms,
+        latency_jitter=args.latency_jitter,
+        captcha_rate=args.captcha_rate,
+        server_error_rate=args.server_error_rate,
+        no_reviews_rate=args.no_reviews_rate,
+        min_reviews=args.min_reviews,
+        max_reviews=args.max_reviews,
+        new_reviews=args.new_reviews,
+        failing_pages=tuple(args.failing_pages),
+        pages_dir=args.pages_dir or None,
+        seed=args.seed,
+    )
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    add_server_arguments(parser)
+    args = parser.parse_args(argv)
+    config = server_config_from_args(args)
+    print(f"Serving mock Amazon on http://{config.host}:{config.port}")
+    run_server(config)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,262 @@
+"""
+Per page parse time of the single pass data-hook index against the find
+based extraction it replaced, for every installed html backend.
+
+Pages come from the recorded pages in `data/pfw/pages` when there are any,
+plus synthetic pages from the mock server. Every backend's results are
+checked against the reference extraction before timing.
+
+Usage:
+    python benchmarks/parser_benchmark.py --synthetic 200 --repeat 3
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+from typing import Callable, List, Optional
+
+from bs4 import BeautifulSoup, Tag
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import page_parser  # noqa: E402
+from amazon_review import AmazonReview  # noqa: E402
+from helpers import (  # noqa: E402
+    extract_float_from_phrase,
+    extract_integer,
+    parse_review_date_and_country,
+    parse_reviews_count,
+    parse_star_percentage,
+)
+from mock_amazon import MockServerConfig, SyntheticCatalog  # noqa: E402
+from page_index import available_backends, get_backend  # noqa: E402
+from page_parser import PageOutcome, ParsedPage  # noqa: E402
+
+# The find based extraction, kept as the reference and the baseline
+
+
+def legacy_parse_review(review_element: Tag) -> Optional[AmazonReview]:
+    try:
+        review = AmazonReview()
+
+        # Get review ID
+        review.id = review_element.get("id")
+        if not review.id:
+            return None
+
+        # Get review title and rating
+        rating_element = review_element.find("i", {"data-hook": "review-star-rating"})
+        if not rating_element:
+            rating_element = review_element.find(
+                "i", {"data-hook": "cmps-review-star-rating"}
+            )
+        if rating_element:
+            review.rating = extract_float_from_phrase(rating_element.get_text())
+
+        # Get title
+        title_element = review_element.find("a", {"data-hook": "review-title"})
+        if not title_element:
+            title_element = review_element.find("span", {"data-hook": "review-title"})
+        if title_element:
+            review.href = title_element.get("href")
+            if review.href:
+                spans = title_element.find_all("span")
+                if spans and len(spans) >= 3:
+                    review.title = spans[2].get_text().strip()
+            else:
+                review.title = title_element.get_text().strip()
+
+        # Get review date and country
+        date_element = review_element.find("span", {"data-hook": "review-date"})
+        if date_element:
+            date_info = parse_review_date_and_country(date_element.get_text())
+            if date_info:
+                review.country = date_info["country"]
+                review.date = date_info["date"]
+
+        # Get review body
+        body_element = review_element.find("span", {"data-hook": "review-body"})
+        if body_element:
+            review.body = body_element.get_text().strip()
+
+        # Check if verified purchase
+        verified_element = review_element.find("span", {"data-hook": "avp-badge"})
+        review.verified_purchase = bool(verified_element)
+
+        # Get helpful votes
+        helpful_element = review_element.find(
+            "span", {"data-hook": "helpful-vote-statement"}
+        )
+        if helpful_element:
+            text = helpful_element.get_text()
+            if "One" in text:
+                review.found_helpful = 1
+            else:
+                review.found_helpful = extract_integer(helpful_element.get_text()) or 0
+
+        # Get username
+        username_element = review_element.find("span", {"class": "a-profile-name"})
+        if username_element:
+            review.username = username_element.get_text()
+            username_url = username_element.find_parent("a")
+            if username_url:
+                review.username_url = username_url.get("href")
+
+        # Get images
+        image_elements = review_element.find_all(
+            "img", {"data-hook": "review-image-tile"}
+        )
+        if image_elements:
+            for element in image_elements:
+                src = element.get("src")
+                if src:
+                    review.images.append(src)
+
+        other_countries_images_elements = review_element.find_all(
+            "img", {"data-hook": "cmps-review-image-tile"}
+        )
+        if other_countries_images_elements:
+            for element in other_countries_images_elements:
+                src = element.get("src")
+                if src:
+                    review.images.append(src)
+
+        # Get videos
+        if body_element:
+            video_elements = body_element.find_all("div", {"data-review-id": review.id})
+            if video_elements:
+                for element in video_elements:
+                    src = element.get("data-video-url")
+                    if src:
+                        review.videos.append(src)
+
+        return review
+
+    except Exception as e:
+        print(f"Error parsing review: {e}")
+        return None
+
+
+def legacy_classify_page(soup: BeautifulSoup) -> PageOutcome:
+    if soup.find(string="Enter the characters you see below"):
+        return PageOutcome.CAPTCHA
+    if soup.find(attrs={"name": "signIn"}):
+        return PageOutcome.LOGIN
+    if soup.find(string="Sorry, no reviews match your current selections."):
+        return PageOutcome.NO_REVIEWS
+    return PageOutcome.OK
+
+
+def legacy_extract_page(html: str) -> ParsedPage:
+    soup = BeautifulSoup(html, "html.parser")
+
+    outcome = legacy_classify_page(soup)
+    page = ParsedPage(outcome=outcome)
+    if outcome != PageOutcome.OK:
+        return page
+
+    product_element = soup.find("a", {"data-hook": "product-link"})
+    if product_element:
+        page.product_name = product_element.get_text().strip()
+
+    rating_element = soup.find("span", {"data-hook": "rating-out-of-text"})
+    if rating_element:
+        page.overall_rating = extract_float_from_phrase(rating_element.get_text())
+
+    rating_count_element = soup.find("div", {"data-hook": "total-review-count"})
+    if rating_count_element:
+        page.total_rating_count = extract_integer(rating_count_element.get_text())
+
+    total_reviews_count_element = soup.find(
+        "div", {"data-hook": "cr-filter-info-review-rating-count"}
+    )
+    if total_reviews_count_element:
+        page.total_reviews_count = parse_reviews_count(
+            total_reviews_count_element.get_text()
+        )
+
+    histogram_element = soup.find(id="histogramTable")
+    if histogram_element:
+        for row_element in histogram_element.find_all(attrs={"aria-label": True}):
+            star_percentage = parse_star_percentage(row_element["aria-label"])
+            if star_percentage:
+                star, percentage = star_percentage
+                page.star_percentages[star] = percentage
+
+    review_elements = soup.find_all("div", {"data-hook": "review"})
+    page.review_count = len(review_elements)
+    for review_element in review_elements:
+        review = legacy_parse_review(review_element)
+        if review:
+            page.reviews.append(review)
+
+    return page
+
+
+def load_pages(pages_dir: Optional[str], synthetic: int) -> List[str]:
+    pages = []
+    if pages_dir and Path(pages_dir).is_dir():
+        pages.extend(
+            path.read_text() for path in sorted(Path(pages_dir).glob("*.html"))
+        )
+    catalog = SyntheticCatalog(MockServerConfig(min_reviews=10, max_reviews=200))
+    for i in range(synthetic):
+        pages.append(catalog.page(f"B{i:09d}", {"pageNumber": [str(i % 5 + 1)]}))
+    return pages
+
+
+def page_summary(page: ParsedPage) -> tuple:
+    return (
+        page.outcome,
+        page.product_name,
+        page.overall_rating,
+        page.total_rating_count,
+        page.total_reviews_count,
+        page.star_percentages,
+        page.review_count,
+        [review.to_dict(expand_found_under=False) for review in page.reviews],
+    )
+
+
+def time_per_page(extract: Callable[[str], ParsedPage], pages: List[str], repeat: int):
+    best = float("inf")
+    for _ in range(repeat):
+        start_time = time.process_time()
+        for html in pages:
+            extract(html)
+        best = min(best, time.process_time() - start_time)
+    return best / len(pages)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--pages-dir", default="./data/pfw/pages")
+    parser.add_argument("--synthetic", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args(argv)
+
+    pages = load_pages(args.pages_dir, args.synthetic)
+    if not pages:
+        print("No pages to parse")
+        return
+    reference = [page_summary(legacy_extract_page(html)) for html in pages]
+    baseline = time_per_page(legacy_extract_page, pages, args.repeat)
+    print(f"{len(pages)} pages")
+    print(f"  {'find based (html.parser)':<28} {baseline * 1000:>8.2f} ms/page")
+
+    for name in available_backends():
+        page_parser._backend = get_backend(name)
+        mismatches = sum(
+            page_summary(page_parser.extract_page(html)) != expected
+            for html, expected in zip(pages, reference)
+        )
+        seconds = time_per_page(page_parser.extract_page, pages, args.repeat)
+        print(
+            f"  {'data-hook index (' + name + ')':<28} {seconds * 1000:>8.2f} ms/page"
+            f"  {baseline / seconds:>5.2f}x  {mismatches} mismatching pages"
+        )
+
+
+if __name__ == "__main__":
+    main()
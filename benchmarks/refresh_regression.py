@@ -0,0 +1,181 @@
+"""
+Checks that an incremental refresh never loses reviews, against the local mock
+Amazon server.
+
+A first crawl with a review window that drops the whole first page of every
+branch has to leave a watermark behind for each ASIN. A refresh whose second
+pages all fail then must not move the watermarks, so that a second refresh
+still finds every review posted since the crawl, together with the ones past
+the end of the window. Runs once with a writer that keeps whole products and
+once with one that only gets the new reviews, whose review counts in the
+progress journal have to add up. Exits non-zero on the first failed check.
+
+Usage:
+    python benchmarks/refresh_regression.py --asins 5
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import sqlite3
+import sys
+import tempfile
+from dataclasses import replace
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from amazon_scraper import AmazonScraper  # noqa: E402
+from mock_amazon import MockServerConfig, SyntheticCatalog, run_server  # noqa: E402
+from replay_benchmark import wait_for_port  # noqa: E402
+from result_writer import create_result_writer  # noqa: E402
+from scraping_config import ScrapingConfig  # noqa: E402
+
+# The synthetic reviews go back from 2024-12-31, three per day, so this
+# window drops the first page of every branch
+REVIEW_START_DATE = datetime(2024, 12, 1)
+REVIEW_END_DATE = datetime(2024, 12, 25)
+
+
+def scraping_config(args: argparse.Namespace, work_dir: str, writer: str):
+    return ScrapingConfig(
+        marketplace_base_urls={"com": f"http://{args.host}:{args.port}"},
+        max_workers=2,
+        cache_dir=str(Path(work_dir, "page_cache")),
+        progress_db_path=str(Path(work_dir, "progress.sqlite")),
+        seen_reviews_path=str(Path(work_dir, "seen_reviews.bin")),
+        results_dir=str(Path(work_dir, "results")),
+        result_writer=writer,
+        metrics_log_path=str(Path(work_dir, "metrics.log")),
+        review_start_date=REVIEW_START_DATE,
+        review_end_date=REVIEW_END_DATE,
+        # A writer that only gets new reviews relies on the seen ids to dedup
+        skip_seen_reviews=writer != "json",
+        retry_attempts=1,
+        retry_stage_base_delay=0.5,
+        retry_stage_max_delay=5.0,
+        retry_stage_quiet_period=1.0,
+    )
+
+
+def server_config(args: argparse.Namespace, **server_options) -> MockServerConfig:
+    return MockServerConfig(
+        host=args.host,
+        port=args.port,
+        latency_ms=1,
+        min_reviews=100,
+        max_reviews=200,
+        pages_dir=None,
+        **server_options,
+    )
+
+
+def serve(args: argparse.Namespace, **server_options) -> multiprocessing.Process:
+    server = multiprocessing.Process(
+        target=run_server, args=(server_config(args, **server_options),), daemon=True
+    )
+    server.start()
+    wait_for_port(args.host, args.port)
+    return server
+
+
+def crawl(config: ScrapingConfig, asins: List[str]) -> None:
+    async def run():
+        async with AmazonScraper(config=config) as scraper:
+            await scraper.scrape_asins(asins)
+
+    asyncio.run(run())
+
+
+def crawl_with(
+    args: argparse.Namespace,
+    config: ScrapingConfig,
+    asins: List[str],
+    **server_options,
+) -> None:
+    server = serve(args, **server_options)
+    try:
+        crawl(config, asins)
+    finally:
+        server.terminate()
+        server.join()
+
+
+def review_counts(config: ScrapingConfig) -> Dict[str, int]:
+    with sqlite3.connect(config.progress_db_path) as db:
+        return dict(db.execute("SELECT asin, review_count FROM progress").fetchall())
+
+
+def check(condition: bool, message: str) -> None:
+    print(f"{'ok' if condition else 'FAILED'}: {message}")
+    if not condition:
+        sys.exit(1)
+
+
+def run_check(args: argparse.Namespace, writer: str) -> None:
+    asins = [f"B{i:09d}" for i in range(args.asins)]
+    with tempfile.TemporaryDirectory() as work_dir:
+        config = scraping_config(args, work_dir, writer)
+        crawl_with(args, config, asins)
+        with sqlite3.connect(config.progress_db_path) as db:
+            watermarked = {
+                asin
+                for (asin,) in db.execute(
+                    "SELECT asin FROM watermarks WHERE branch LIKE 'recent:%'"
+                )
+            }
+        check(
+            watermarked == set(asins),
+            f"{writer}: the crawl left a watermark for every ASIN",
+        )
+        crawled = review_counts(config)
+
+        # Like main.py, a refresh has no end date
+        refresh_config = replace(config, review_end_date=None, incremental_refresh=True)
+        crawl_with(
+            args,
+            refresh_config,
+            asins,
+            new_reviews=args.new_reviews,
+            failing_pages=(2,),
+        )
+        crawl_with(args, refresh_config, asins, new_reviews=args.new_reviews)
+
+        # Every review after the window is new to the results
+        catalog = SyntheticCatalog(server_config(args, new_reviews=args.new_reviews))
+        refreshed = review_counts(config)
+        result_writer = create_result_writer(config=config)
+        for asin in asins:
+            new = sum(
+                review_date > REVIEW_END_DATE.date()
+                for _, _, review_date, _ in catalog.reviews(asin)
+            )
+            expected = crawled[asin] + new
+            if result_writer.keeps_whole_products:
+                found = len(result_writer.load(asin, "com").review_list)
+            else:
+                found = refreshed[asin]
+            check(
+                found == expected,
+                f"{writer}: {asin} has {found} reviews, "
+                f"{crawled[asin]} crawled and {new} new",
+            )
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--asins", type=int, default=5)
+    # More than a page, so that the failing second page holds some of them
+    parser.add_argument("--new-reviews", type=int, default=25)
+    args = parser.parse_args(argv)
+
+    for writer in ["json", "jsonl"]:
+        run_check(args, writer)
+
+
+if __name__ == "__main__":
+    main()
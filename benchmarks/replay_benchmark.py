@@ -0,0 +1,267 @@
+"""
+Replays a crawl against the local mock Amazon server and reports throughput.
+
+The mock server runs in its own process, so its CPU does not count against
+the scraper. Page cache, progress journal and results go to a temporary
+directory, so every run starts cold. The report covers pages/s, reviews/s,
+p50/p95/p99 fetch latency, CPU time of the main and parser processes and
+peak RSS. It is saved as JSON under `--output` together with the git commit,
+and compared with the last saved run of the same scenario.
+
+Usage:
+    python benchmarks/replay_benchmark.py --asins 50 --latency-ms 50 --captcha-rate 0.01
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import resource
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import aiohttp
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from amazon_scraper import AmazonScraper  # noqa: E402
+from connection_pool import SharedTransport  # noqa: E402
+from metrics import METRICS  # noqa: E402
+from mock_amazon import (  # noqa: E402
+    add_server_arguments,
+    run_server,
+    server_config_from_args,
+)
+from scraping_config import ScrapingConfig  # noqa: E402
+
+# Numbers compared against the previous run of the same scenario
+HEADLINE_METRICS = ["pages_per_second", "reviews_per_second", "latency_p95_ms"]
+
+
+class LatencyTrace:
+    """aiohttp trace hooks recording the latency of every request"""
+
+    def __init__(self):
+        self.latencies: List[float] = []
+        self.config = aiohttp.TraceConfig()
+        self.config.on_request_start.append(self.__on_request_start)
+        self.config.on_request_end.append(self.__on_request_end)
+
+    async def __on_request_start(self, session, context, params) -> None:
+        context.start = time.perf_counter()
+
+    async def __on_request_end(self, session, context, params) -> None:
+        self.latencies.append(time.perf_counter() - context.start)
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def wait_for_port(host: str, port: int, timeout: float = 10.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection((host, port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise TimeoutError(f"Mock server did not come up on {host}:{port}")
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=Path(__file__).resolve().parent,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def crawl(config: ScrapingConfig, asins: List[str], trace: LatencyTrace):
+    transport = SharedTransport(config, trace_configs=[trace.config])
+    try:
+        async with AmazonScraper(config=config, transport=transport) as scraper:
+            await scraper.scrape_asins(asins)
+    finally:
+        await transport.close()
+
+
+def scraping_config(args: argparse.Namespace, work_dir: str) -> ScrapingConfig:
+    return ScrapingConfig(
+        marketplace_base_urls={"com": f"http://{args.host}:{args.port}"},
+        max_workers=args.parser_workers,
+        max_concurrent_products=args.concurrent_products,
+        cache_dir=os.path.join(work_dir, "page_cache"),
+        progress_db_path=os.path.join(work_dir, "progress.sqlite"),
+        seen_reviews_path=os.path.join(work_dir, "seen_reviews.bin"),
+        results_dir=os.path.join(work_dir, "results"),
+        sqlite_results_path=os.path.join(work_dir, "results.sqlite"),
+        result_writer=args.result_writer,
+        metrics_log_path=os.path.join(work_dir, "metrics.log"),
+        governor_initial_rate=args.rate,
+        governor_max_rate=max(args.rate, ScrapingConfig.governor_max_rate),
+        governor_burst=args.rate,
+        # Waiting minutes for a mock server to calm down measures nothing
+        retry_stage_base_delay=0.5,
+        retry_stage_max_delay=5.0,
+        retry_stage_quiet_period=1.0,
+    )
+
+
+def run_benchmark(args: argparse.Namespace) -> Dict:
+    server_config = server_config_from_args(args)
+    server = multiprocessing.Process(
+        target=run_server, args=(server_config,), daemon=True
+    )
+    server.start()
+    try:
+        wait_for_port(args.host, args.port)
+        asins = [f"B{i:09d}" for i in range(args.asins)]
+        trace = LatencyTrace()
+
+        with tempfile.TemporaryDirectory() as work_dir:
+            config = scraping_config(args, work_dir)
+            self_before = resource.getrusage(resource.RUSAGE_SELF)
+            children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+            start_time = time.perf_counter()
+            asyncio.run(crawl(config, asins, trace))
+            seconds = time.perf_counter() - start_time
+            # Parser workers are joined by now, the server is still running
+            self_after = resource.getrusage(resource.RUSAGE_SELF)
+            children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+            with sqlite3.connect(config.progress_db_path) as db:
+                completed, reviews = db.execute(
+                    "SELECT COUNT(*), COALESCE(SUM(review_count), 0) FROM progress "
+                    "WHERE status = 'complete'"
+                ).fetchone()
+
+        stats_url = f"http://{args.host}:{args.port}/_stats"
+        with urllib.request.urlopen(stats_url) as response:
+            server_stats = json.load(response)
+    finally:
+        server.terminate()
+        server.join()
+
+    pages = len(trace.latencies)
+    return {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "scenario": {
+            "asins": args.asins,
+            "latency_ms": args.latency_ms,
+            "latency_jitter": args.latency_jitter,
+            "captcha_rate": args.captcha_rate,
+            "server_error_rate": args.server_error_rate,
+            "no_reviews_rate": args.no_reviews_rate,
+            "min_reviews": args.min_reviews,
+            "max_reviews": args.max_reviews,
+            "seed": args.seed,
+            "rate": args.rate,
+            "concurrent_products": args.concurrent_products,
+            "parser_workers": args.parser_workers,
+            "result_writer": args.result_writer,
+        },
+        "seconds": seconds,
+        "pages": pages,
+        "completed_asins": completed,
+        "reviews": reviews,
+        "pages_per_second": pages / seconds,
+        "reviews_per_second": reviews / seconds,
+        "latency_p50_ms": percentile(trace.latencies, 0.50) * 1000,
+        "latency_p95_ms": percentile(trace.latencies, 0.95) * 1000,
+        "latency_p99_ms": percentile(trace.latencies, 0.99) * 1000,
+        "main_cpu_seconds": (self_after.ru_utime + self_after.ru_stime)
+        - (self_before.ru_utime + self_before.ru_stime),
+        "parse_cpu_seconds": (children_after.ru_utime + children_after.ru_stime)
+        - (children_before.ru_utime + children_before.ru_stime),
+        # ru_maxrss is in KiB on Linux
+        "peak_rss_mb": self_after.ru_maxrss / 1024,
+        "parser_peak_rss_mb": children_after.ru_maxrss / 1024,
+        "server": server_stats,
+        # Per stage breakdown of where the time went
+        "metrics": METRICS.snapshot(),
+    }
+
+
+def previous_result(output_dir: Path, scenario: Dict) -> Optional[Dict]:
+    for path in sorted(output_dir.glob("*.json"), reverse=True):
+        with open(path) as f:
+            result = json.load(f)
+        if result.get("scenario") == scenario:
+            return result
+    return None
+
+
+def save_result(result: Dict, output_dir: Path) -> Path:
+    output_dir.mkdir(parents=True, exist_ok=True)
+    name = result["timestamp"].replace(":", "")
+    file_path = output_dir / f"{name}-{result['commit'] or 'unknown'}.json"
+    with open(file_path, "w") as f:
+        json.dump(result, f, indent=4)
+    return file_path
+
+
+def print_report(result: Dict, previous: Optional[Dict]) -> None:
+    print(
+        f"{result['pages']} pages, {result['reviews']} reviews, "
+        f"{result['completed_asins']} ASINs in {result['seconds']:.1f}s"
+    )
+    for metric in [
+        "pages_per_second",
+        "reviews_per_second",
+        "latency_p50_ms",
+        "latency_p95_ms",
+        "latency_p99_ms",
+        "main_cpu_seconds",
+        "parse_cpu_seconds",
+        "peak_rss_mb",
+        "parser_peak_rss_mb",
+    ]:
+        line = f"  {metric:<20} {result[metric]:>10.2f}"
+        if previous and metric in HEADLINE_METRICS and previous[metric]:
+            change = result[metric] / previous[metric] - 1
+            line += f"  ({change:+.1%} vs {previous['commit']})"
+        print(line)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    add_server_arguments(parser)
+    parser.add_argument("--asins", type=int, default=50)
+    # Requests per second the governor starts at, the defaults target Amazon
+    parser.add_argument("--rate", type=float, default=200.0)
+    parser.add_argument("--concurrent-products", type=int, default=10)
+    parser.add_argument("--parser-workers", type=int, default=5)
+    parser.add_argument("--result-writer", default="jsonl")
+    parser.add_argument(
+        "--output", default=str(Path(__file__).resolve().parent / "results")
+    )
+    args = parser.parse_args(argv)
+
+    output_dir = Path(args.output)
+    result = run_benchmark(args)
+    previous = previous_result(output_dir, result["scenario"])
+    print_report(result, previous)
+    print(f"Saved to {save_result(result, output_dir)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+import ssl
+import time
+from typing import Dict, List, Optional
+
+import aiohttp
+
+from scraping_config import ScrapingConfig
+
+try:
+    import brotli  # noqa: F401
+
+    BROTLI_AVAILABLE = True
+except ImportError:
+    try:
+        import brotlicffi  # noqa: F401
+
+        BROTLI_AVAILABLE = True
+    except ImportError:
+        BROTLI_AVAILABLE = False
+
+
+class SharedTransport:
+    """
+    One pooled aiohttp session for the whole crawl process.
+
+    Connections are kept alive and shared by every scraper, so TLS handshakes
+    and DNS lookups are paid once per host instead of once per scraper. Pool
+    statistics are collected through aiohttp trace hooks.
+    """
+
+    def __init__(
+        self,
+        config: Optional[ScrapingConfig] = None,
+        trace_configs: Optional[List[aiohttp.TraceConfig]] = None,
+    ):
+        self.config = config or ScrapingConfig()
+        # Extra aiohttp trace hooks, e.g. for request latency in benchmarks
+        self.trace_configs = trace_configs or []
+        self.connections_created = 0
+        self.connections_reused = 0
+        self.connection_queued_time = 0.0
+        self.dns_cache_hits = 0
+        self.dns_cache_misses = 0
+        self.__queued_at = {}
+        self.__setup_session()
+
+    def __setup_session(self) -> None:
+        ssl_context = ssl.create_default_context()
+        ssl_context.check_hostname = False
+        ssl_context.verify_mode = ssl.CERT_NONE
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_connection_create_end.append(self.__on_connection_create)
+        trace_config.on_connection_reuseconn.append(self.__on_connection_reuse)
+        trace_config.on_connection_queued_start.append(self.__on_queued_start)
+        trace_config.on_connection_queued_end.append(self.__on_queued_end)
+        trace_config.on_dns_cache_hit.append(self.__on_dns_cache_hit)
+        trace_config.on_dns_cache_miss.append(self.__on_dns_cache_miss)
+
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                ssl=ssl_context,
+                limit=self.config.pool_limit,
+                limit_per_host=self.config.pool_limit_per_host,
+                keepalive_timeout=self.config.pool_keepalive_timeout,
+                use_dns_cache=True,
+                ttl_dns_cache=self.config.pool_dns_cache_ttl,
+                enable_cleanup_closed=True,
+            ),
+            headers={"Accept-Encoding": self.accept_encoding},
+            trace_configs=[trace_config, *self.trace_configs],
+        )
+
+    @property
+    def accept_encoding(self) -> str:
+        # aiohttp can only decode brotli when one of its packages is installed
+        return "gzip, deflate, br" if BROTLI_AVAILABLE else "gzip, deflate"
+
+    async def __on_connection_create(self, session, context, params) -> None:
+        self.connections_created += 1
+
+    async def __on_connection_reuse(self, session, context, params) -> None:
+        self.connections_reused += 1
+
+    async def __on_queued_start(self, session, context, params) -> None:
+        self.__queued_at[id(context)] = time.monotonic()
+
+    async def __on_queued_end(self, session, context, params) -> None:
+        queued_at = self.__queued_at.pop(id(context), None)
+        if queued_at is not None:
+            self.connection_queued_time += time.monotonic() - queued_at
+
+    async def __on_dns_cache_hit(self, session, context, params) -> None:
+        self.dns_cache_hits += 1
+
+    async def __on_dns_cache_miss(self, session, context, params) -> None:
+        self.dns_cache_misses += 1
+
+    def stats(self) -> Dict:
+        connections = self.connections_created + self.connections_reused
+        return {
+            # Every created connection paid a TCP (and for https a TLS) handshake
+            "connections_created": self.connections_created,
+            "connections_reused": self.connections_reused,
+            "reuse_ratio": (
+                self.connections_reused / connections if connections else 0.0
+            ),
+            "connection_queued_seconds": self.connection_queued_time,
+            "dns_cache_hits": self.dns_cache_hits,
+            "dns_cache_misses": self.dns_cache_misses,
+        }
+
+    async def close(self) -> None:
+        await self.session.close()
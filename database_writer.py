@@ -0,0 +1,352 @@
+import asyncio
+import json
+import sqlite3
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+from amazon_product import AmazonProduct
+from result_writer import BatchedResultWriter, OnWritten
+from scraping_config import ScrapingConfig
+
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+
+PRODUCT_COLUMNS = (
+    "asin",
+    "marketplace",
+    "name",
+    "overall_rating",
+    "total_rating_count",
+    "total_reviews_count",
+    "star_percentages",
+    "scraped_at",
+)
+REVIEW_COLUMNS = (
+    "id",
+    "asin",
+    "marketplace",
+    "rating",
+    "title",
+    "url",
+    "username",
+    "username_url",
+    "body",
+    "verified_purchase",
+    "found_helpful",
+    "country",
+    "date",
+    "found_under",
+    "created_at",
+)
+MEDIA_COLUMNS = ("review_id", "marketplace", "media_type", "url")
+ERROR_COLUMNS = ("asin", "marketplace", "url", "error_message", "created_at")
+
+# table: (key, columns, columns an upsert overwrites). None means append only
+TABLES = {
+    "products": ("asin, marketplace", PRODUCT_COLUMNS, PRODUCT_COLUMNS[2:]),
+    # A review id can show up in several stores, each keeps its own row.
+    # created_at keeps the time we first saw the review
+    "reviews": (
+        "id, marketplace",
+        REVIEW_COLUMNS,
+        REVIEW_COLUMNS[1:2] + REVIEW_COLUMNS[3:-1],
+    ),
+    "review_media": ("review_id, marketplace, url", MEDIA_COLUMNS, ()),
+    "error_logs": (None, ERROR_COLUMNS, ()),
+}
+
+POSTGRES_SCHEMA = """
+CREATE TABLE IF NOT EXISTS products (
+    id BIGSERIAL PRIMARY KEY,
+    asin TEXT NOT NULL,
+    marketplace TEXT NOT NULL,
+    name TEXT,
+    overall_rating REAL,
+    total_rating_count INTEGER,
+    total_reviews_count INTEGER,
+    star_percentages JSONB,
+    scraped_at TIMESTAMPTZ NOT NULL,
+    UNIQUE (asin, marketplace)
+);
+CREATE TABLE IF NOT EXISTS reviews (
+    id TEXT NOT NULL,
+    asin TEXT NOT NULL,
+    marketplace TEXT NOT NULL,
+    rating REAL,
+    title TEXT,
+    url TEXT,
+    username TEXT,
+    username_url TEXT,
+    body TEXT,
+    verified_purchase BOOLEAN,
+    found_helpful INTEGER,
+    country TEXT,
+    date TIMESTAMP,
+    found_under TEXT[],
+    created_at TIMESTAMPTZ NOT NULL,
+    PRIMARY KEY (id, marketplace)
+);
+CREATE INDEX IF NOT EXISTS reviews_asin ON reviews (asin, marketplace);
+CREATE TABLE IF NOT EXISTS review_media (
+    review_id TEXT NOT NULL,
+    marketplace TEXT NOT NULL,
+    media_type TEXT NOT NULL,
+    url TEXT NOT NULL,
+    PRIMARY KEY (review_id, marketplace, url),
+    FOREIGN KEY (review_id, marketplace) REFERENCES reviews (id, marketplace)
+);
+CREATE TABLE IF NOT EXISTS error_logs (
+    id BIGSERIAL PRIMARY KEY,
+    asin TEXT NOT NULL,
+    marketplace TEXT NOT NULL,
+    url TEXT,
+    error_message TEXT NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL
+);
+"""
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS products (
+    id INTEGER PRIMARY KEY,
+    asin TEXT NOT NULL,
+    marketplace TEXT NOT NULL,
+    name TEXT,
+    overall_rating REAL,
+    total_rating_count INTEGER,
+    total_reviews_count INTEGER,
+    star_percentages TEXT,
+    scraped_at TEXT NOT NULL,
+    UNIQUE (asin, marketplace)
+);
+CREATE TABLE IF NOT EXISTS reviews (
+    id TEXT NOT NULL,
+    asin TEXT NOT NULL,
+    marketplace TEXT NOT NULL,
+    rating REAL,
+    title TEXT,
+    url TEXT,
+    username TEXT,
+    username_url TEXT,
+    body TEXT,
+    verified_purchase INTEGER,
+    found_helpful INTEGER,
+    country TEXT,
+    date TEXT,
+    found_under TEXT,
+    created_at TEXT NOT NULL,
+    PRIMARY KEY (id, marketplace)
+);
+CREATE INDEX IF NOT EXISTS reviews_asin ON reviews (asin, marketplace);
+CREATE TABLE IF NOT EXISTS review_media (
+    review_id TEXT NOT NULL,
+    marketplace TEXT NOT NULL,
+    media_type TEXT NOT NULL,
+    url TEXT NOT NULL,
+    PRIMARY KEY (review_id, marketplace, url),
+    FOREIGN KEY (review_id, marketplace) REFERENCES reviews (id, marketplace)
+);
+CREATE TABLE IF NOT EXISTS error_logs (
+    id INTEGER PRIMARY KEY,
+    asin TEXT NOT NULL,
+    marketplace TEXT NOT NULL,
+    url TEXT,
+    error_message TEXT NOT NULL,
+    created_at TEXT NOT NULL
+);
+"""
+
+
+def upsert_sql(table: str, source: str) -> str:
+    """INSERT of the table's columns from `source`, a VALUES list or a SELECT"""
+    key, columns, update_columns = TABLES[table]
+    sql = f"INSERT INTO {table} ({', '.join(columns)}) {source}"
+    if key is None:
+        return sql
+    if not update_columns:
+        return f"{sql} ON CONFLICT ({key}) DO NOTHING"
+    updates = ", ".join(f"{column} = excluded.{column}" for column in update_columns)
+    return f"{sql} ON CONFLICT ({key}) DO UPDATE SET {updates}"
+
+
+def product_rows(products: List[AmazonProduct]) -> dict:
+    """Rows of every table for a batch of products, in column order"""
+    now = datetime.now(timezone.utc)
+    rows = {table: [] for table in TABLES}
+    for product in products:
+        rows["products"].append(
+            (
+                product.asin,
+                product.marketplace,
+                product.name,
+                product.overall_rating,
+                product.total_rating_count,
+                product.total_reviews_count,
+                json.dumps(product.star_percentages),
+                now,
+            )
+        )
+        for review in product.review_list:
+            rows["reviews"].append(
+                (
+                    review.id,
+                    product.asin,
+                    product.marketplace,
+                    review.rating,
+                    review.title,
+                    review.href,
+                    review.username,
+                    review.username_url,
+                    review.body,
+                    review.verified_purchase,
+                    review.found_helpful,
+                    review.country,
+                    review.date,
+                    review.found_under_urls(product.asin, product.base_url),
+                    now,
+                )
+            )
+            for media_type, urls in [
+                ("image", review.images),
+                ("video", review.videos),
+            ]:
+                for url in urls:
+                    rows["review_media"].append(
+                        (review.id, product.marketplace, media_type, url)
+                    )
+        for url in product.failed_urls:
+            rows["error_logs"].append(
+                (
+                    product.asin,
+                    product.marketplace,
+                    url,
+                    "Review page could not be scraped",
+                    now,
+                )
+            )
+    return rows
+
+
+class PostgresResultWriter(BatchedResultWriter):
+    """
+    Loads finished products into PostgreSQL while the crawl is running.
+
+    Every batch is bulk loaded with COPY into temporary staging tables and
+    upserted from there in one transaction, keyed on ASIN and marketplace for
+    products and on the Amazon review id and marketplace for reviews. Failed
+    pages go to error_logs.
+    """
+
+    def __init__(
+        self,
+        config: Optional[ScrapingConfig] = None,
+        on_written: Optional[OnWritten] = None,
+    ):
+        super().__init__(config, on_written)
+        self.pool = None
+        self.pool_lock = asyncio.Lock()
+
+    async def __get_pool(self):
+        async with self.pool_lock:
+            if self.pool is None:
+                self.pool = await asyncpg.create_pool(
+                    self.config.database_url,
+                    min_size=1,
+                    max_size=self.config.database_pool_size,
+                )
+                async with self.pool.acquire() as connection:
+                    await connection.execute(POSTGRES_SCHEMA)
+        return self.pool
+
+    async def _store_batch(self, products: List[AmazonProduct], part_name: str):
+        rows = product_rows(products)
+        pool = await self.__get_pool()
+        async with pool.acquire() as connection:
+            async with connection.transaction():
+                for table, (key, columns, _) in TABLES.items():
+                    if not rows[table]:
+                        continue
+                    if key is None:
+                        await connection.copy_records_to_table(
+                            table, records=rows[table], columns=columns
+                        )
+                        continue
+                    staging = f"{table}_staging"
+                    column_list = ", ".join(columns)
+                    await connection.execute(
+                        f"CREATE TEMP TABLE {staging} ON COMMIT DROP AS "
+                        f"SELECT {column_list} FROM {table} WITH NO DATA"
+                    )
+                    await connection.copy_records_to_table(
+                        staging, records=rows[table], columns=columns
+                    )
+                    # A review can show up under several products of one batch
+                    await connection.execute(
+                        upsert_sql(
+                            table,
+                            f"SELECT DISTINCT ON ({key}) {column_list} FROM {staging}",
+                        )
+                    )
+
+    async def close(self) -> None:
+        await super().close()
+        if self.pool is not None:
+            await self.pool.close()
+
+
+class SqliteResultWriter(BatchedResultWriter):
+    """Same tables as PostgresResultWriter in a local SQLite file"""
+
+    def __init__(
+        self,
+        config: Optional[ScrapingConfig] = None,
+        on_written: Optional[OnWritten] = None,
+    ):
+        super().__init__(config, on_written)
+        path = Path(self.config.sqlite_results_path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Only ever used from the single writer thread
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SQLITE_SCHEMA)
+
+    def __to_sqlite(self, row: Tuple) -> Tuple:
+        return tuple(
+            (
+                value.isoformat()
+                if isinstance(value, datetime)
+                else json.dumps(value) if isinstance(value, list) else value
+            )
+            for value in row
+        )
+
+    def _write_batch(self, products: List[AmazonProduct], part_name: str) -> None:
+        rows = product_rows(products)
+        with self.db:
+            for table, (_, columns, _) in TABLES.items():
+                placeholders = ", ".join("?" for _ in columns)
+                self.db.executemany(
+                    upsert_sql(table, f"VALUES ({placeholders})"),
+                    [self.__to_sqlite(row) for row in rows[table]],
+                )
+
+    async def close(self) -> None:
+        await super().close()
+        self.db.close()
+
+
+def create_database_writer(
+    config: ScrapingConfig, on_written: Optional[OnWritten] = None
+) -> BatchedResultWriter:
+    """PostgreSQL when asyncpg and a database_url are there, else SQLite"""
+    if config.result_writer == "postgres":
+        if asyncpg is not None and config.database_url:
+            return PostgresResultWriter(config, on_written)
+        print(
+            "asyncpg or database_url missing, writing results to "
+            f"{config.sqlite_results_path} instead"
+        )
+    return SqliteResultWriter(config, on_written)
@@ -1,6 +1,8 @@
 from datetime import datetime
 import re
 from enum import Enum
+from typing import Optional
+from urllib.parse import parse_qs, urlparse
 
 
 def extract_integer(s):
@@ -67,6 +69,84 @@ def parse_reviews_count(phrase: str) -> int:
     return 0
 
 
+def parse_star_percentage(phrase: str) -> Optional[tuple[int, int]]:
+    """
+    Parses a histogram row label into its star rating and percentage.
+
+    Args:
+        phrase (str): The input phrase, e.g., "64 percent of reviews have 5 stars".
+
+    Returns:
+        tuple[int, int]: The star rating and the percentage, or None if not found.
+    """
+    match = re.search(r"(\d+)\s*(?:percent|%).*?(\d) stars?", phrase)
+    if match:
+        return int(match.group(2)), int(match.group(1))
+    return None
+
+
+# Value of the filterByStar parameter that does not filter on the rating
+ALL_STARS = "all_stars"
+AMAZON_BASE_URL = "https://www.amazon.com"
+
+
+def build_review_url(
+    asin: str,
+    sort_by: "AmazonFilterSortBy",
+    star_rating: Optional["AmazonFilterStarRating"],
+    format_type: "AmazonFilterFormatType",
+    media_type: "AmazonFilterMediaType",
+    page_number: int,
+    base_url: str = AMAZON_BASE_URL,
+) -> str:
+    filter_by_star = star_rating.value if star_rating else ALL_STARS
+    return f"{base_url}/product-reviews/{asin}?sortBy={sort_by.value}&pageNumber={page_number}&filterByStar={filter_by_star}&formatType={format_type.value}&mediaType={media_type.value}"
+
+
+def parse_review_url(url: str) -> Optional[tuple]:
+    """
+    Inverse of build_review_url.
+
+    Returns:
+        Optional[tuple]: (base_url, asin, sort_by, star_rating, format_type,
+        media_type, page_number), or None for urls that are not review pages.
+    """
+    parsed = urlparse(url)
+    match = re.fullmatch(r"/product-reviews/([^/]+)", parsed.path)
+    if not match:
+        return None
+    query = parse_qs(parsed.query)
+    try:
+        star = query.get("filterByStar", [ALL_STARS])[0]
+        return (
+            f"{parsed.scheme}://{parsed.netloc}",
+            match.group(1),
+            AmazonFilterSortBy(query["sortBy"][0]),
+            None if star == ALL_STARS else AmazonFilterStarRating(star),
+            AmazonFilterFormatType(query["formatType"][0]),
+            AmazonFilterMediaType(query["mediaType"][0]),
+            int(query["pageNumber"][0]),
+        )
+    except (KeyError, ValueError):
+        return None
+
+
+def in_date_window(
+    date: Optional[datetime],
+    start_date: Optional[datetime],
+    end_date: Optional[datetime],
+) -> bool:
+    """Inclusive window check, open ends and undated reviews always pass"""
+    if date is None:
+        # Keep what we cannot place rather than silently losing it
+        return True
+    if start_date and date < start_date:
+        return False
+    if end_date and date > end_date:
+        return False
+    return True
+
+
 class AmazonFilterMediaType(Enum):
     # MEDIA_REVIEWS_ONLY = "media_reviews_only"
     ALL_CONTENTS = "all_contents"
@@ -91,3 +171,63 @@ class AmazonFilterStarRating(Enum):
 class AmazonFilterFormatType(Enum):
     ALL_FORMATS = "all_formats"
     CURRENT_FORMAT = "current_format"
+
+
+# Star count shown in the review histogram for each star filter
+STAR_RATING_VALUES = {
+    AmazonFilterStarRating.FIVE_STAR: 5,
+    AmazonFilterStarRating.FOUR_STAR: 4,
+    AmazonFilterStarRating.THREE_STAR: 3,
+    AmazonFilterStarRating.TWO_STAR: 2,
+    AmazonFilterStarRating.ONE_STAR: 1,
+}
+
+
+# Every filter combination and page maps to one bit of a review's found_under
+# mask. The order only has to be stable within a run, masks are expanded back
+# into urls before anything is written out.
+FOUND_UNDER_PAGE_SLOTS = 32
+_FOUND_UNDER_SORTS = list(AmazonFilterSortBy)
+_FOUND_UNDER_STARS = [None] + list(AmazonFilterStarRating)
+_FOUND_UNDER_FORMATS = list(AmazonFilterFormatType)
+_FOUND_UNDER_MEDIA = list(AmazonFilterMediaType)
+
+
+def encode_found_under(
+    sort_by: AmazonFilterSortBy,
+    star_rating: Optional[AmazonFilterStarRating],
+    format_type: AmazonFilterFormatType,
+    media_type: AmazonFilterMediaType,
+    page_number: int,
+) -> int:
+    """Bit index of a filter combination and page"""
+    if not 1 <= page_number <= FOUND_UNDER_PAGE_SLOTS:
+        raise ValueError(f"page number out of range: {page_number}")
+    index = _FOUND_UNDER_SORTS.index(sort_by)
+    index = index * len(_FOUND_UNDER_STARS) + _FOUND_UNDER_STARS.index(star_rating)
+    index = index * len(_FOUND_UNDER_FORMATS) + _FOUND_UNDER_FORMATS.index(format_type)
+    index = index * len(_FOUND_UNDER_MEDIA) + _FOUND_UNDER_MEDIA.index(media_type)
+    return index * FOUND_UNDER_PAGE_SLOTS + page_number - 1
+
+
+def decode_found_under(bit: int) -> tuple:
+    """The (sort_by, star_rating, format_type, media_type, page_number) of a bit index"""
+    index, page_slot = divmod(bit, FOUND_UNDER_PAGE_SLOTS)
+    index, media_index = divmod(index, len(_FOUND_UNDER_MEDIA))
+    index, format_index = divmod(index, len(_FOUND_UNDER_FORMATS))
+    sort_index, star_index = divmod(index, len(_FOUND_UNDER_STARS))
+    return (
+        _FOUND_UNDER_SORTS[sort_index],
+        _FOUND_UNDER_STARS[star_index],
+        _FOUND_UNDER_FORMATS[format_index],
+        _FOUND_UNDER_MEDIA[media_index],
+        page_slot + 1,
+    )
+
+
+def iter_mask_bits(mask: int):
+    """Indices of the set bits of a mask, lowest first"""
+    while mask:
+        lowest = mask & -mask
+        yield lowest.bit_length() - 1
+        mask ^= lowest
@@ -2,37 +2,99 @@ import asyncio
 import base64
 import os
 from pathlib import Path
-import ssl
-from typing import Optional
+from typing import Dict, Optional
 from urllib.parse import urlparse
 import aiohttp
-from bs4 import BeautifulSoup
+from background_io import BackgroundIO
+from connection_pool import SharedTransport
+from marketplace import DEFAULT_MARKETPLACE, Marketplace, configured_marketplaces
+from metrics import COUNT_BUCKETS, METRICS
+from page_cache import PageCache
+from page_parser import BLOCK_MARKERS, PageOutcome, PageParser, ParsedPage
+from request_governor import RequestGovernor
+from retry_queue import backoff_delay
 from scraping_config import ScrapingConfig
 
 
 class HttpMethods:
-    def __init__(self, config: Optional[ScrapingConfig] = None):
+    def __init__(
+        self,
+        config: Optional[ScrapingConfig] = None,
+        transport: Optional[SharedTransport] = None,
+        io: Optional[BackgroundIO] = None,
+    ):
         self.config = config or ScrapingConfig()
-        self.__setup_session()
+        # Requests go to the marketplace of their host
+        self.marketplaces = {
+            marketplace.host: marketplace
+            for marketplace in configured_marketplaces(self.config)
+        }
+        self.__setup_sessions(transport)
+        # Like the pool, only flush and close the I/O threads when they are ours
+        self.__owns_io = io is None
+        self.io = io or BackgroundIO(config=self.config)
         self.__setup_headers_and_cookies()
-        self._pages_dir = Path("./data/pfw/pages")
-        self._pages_dir.mkdir(parents=True, exist_ok=True)
-
-    def __setup_session(self) -> None:
-        ssl_context = ssl.create_default_context()
-        ssl_context.check_hostname = False
-        ssl_context.verify_mode = ssl.CERT_NONE
-        self.session = aiohttp.ClientSession(
-            connector=aiohttp.TCPConnector(ssl=ssl_context),
-        )
+        self._pages_dir = Path(self.config.legacy_pages_dir)
+        self.page_cache = PageCache(config=self.config)
+        # Pages queued on the writer thread, so a lookup never misses one
+        self.__pending_pages: Dict[str, str] = {}
+        self.governor = RequestGovernor(config=self.config)
+        self.page_parser = PageParser(config=self.config)
+
+    def __setup_sessions(self, transport: Optional[SharedTransport]) -> None:
+        # Only close the pools on exit when nobody else handed one to us. A
+        # transport handed in is shared by every marketplace, otherwise each
+        # gets a pool of its own
+        self.__owns_transport = transport is None
+        self.transports = {
+            marketplace.name: transport or SharedTransport(config=self.config)
+            for marketplace in self.marketplaces.values()
+        }
+
+    def __marketplace_for(self, url: str) -> Marketplace:
+        host = urlparse(url).netloc
+        if host in self.marketplaces:
+            return self.marketplaces[host]
+        return next(iter(self.marketplaces.values()))
+
+    def transport_stats(self) -> Dict[str, Dict]:
+        return {name: transport.stats() for name, transport in self.transports.items()}
+
+    def __session_env(self, name: str, marketplace: Marketplace) -> Optional[str]:
+        # Other stores sign in with their own session, e.g. AMAZON_TOKEN_CA
+        if marketplace.name != DEFAULT_MARKETPLACE:
+            name = f"{name}_{marketplace.name.upper()}"
+        # Every shard signs in with its own session when one is configured
+        if self.config.session_shard is not None:
+            if value := os.getenv(f"{name}_{self.config.session_shard}"):
+                return value
+        return os.getenv(name)
 
     def __setup_headers_and_cookies(self) -> None:
         self.headers = {
             "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/18.1.1 Safari/605.1.15",
         }
+        # Every marketplace keeps its own cookie set
         self.cookies = {
-            "session-id": os.getenv("AMAZON_SESSION_ID"),
-            "session-token": os.getenv("AMAZON_TOKEN"),
+            marketplace.name: self.__cookies_for(marketplace)
+            for marketplace in self.marketplaces.values()
+        }
+
+    def __cookies_for(self, marketplace: Marketplace) -> Dict[str, Optional[str]]:
+        if marketplace.name != DEFAULT_MARKETPLACE:
+            # The amazon.com account cookies below mean nothing to other stores
+            suffix = marketplace.cookie_suffix
+            return {
+                "session-id": self.__session_env("AMAZON_SESSION_ID", marketplace),
+                "session-token": self.__session_env("AMAZON_TOKEN", marketplace),
+                "session-id-time": "2082787201l",
+                "i18n-prefs": marketplace.currency,
+                "skin": "noskin",
+                f"lc-{suffix}": marketplace.locale,
+            }
+        return {
+            "session-id": self.__session_env("AMAZON_SESSION_ID", marketplace),
+            "session-token": self.__session_env("AMAZON_TOKEN", marketplace),
             "session-id-time": "2082787201l",
             "csm-hit": "tb:s-XVTZMTMC0MQH2SD94GZA|1733432567463&t:1733432567569&adb:adblk_no",
             "i18n-prefs": "USD",
@@ -61,35 +123,58 @@ class HttpMethods:
         return self
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
-        await self.session.close()
+        await self.close()
 
-    def __encode_url_to_base64_filename(self, url: str) -> str:
+    async def close(self) -> None:
+        if self.__owns_transport:
+            for transport in self.transports.values():
+                await transport.close()
+        self.page_parser.close()
+        # Queued cache writes have to land before the index is closed
+        await self.io.flush()
+        self.page_cache.close()
+        if self.__owns_io:
+            await self.io.close()
+
+    def __encode_url_to_base64_filename(self, url: str) -> Optional[str]:
         # Encode the URL to Base64
         base64_encoded = base64.urlsafe_b64encode(url.encode()).decode()
-        # Truncate or adjust to avoid overly long filenames
-        return base64_encoded[:255]
+        # Truncated legacy filenames could belong to another url
+        if len(base64_encoded) > 255:
+            return None
+        return base64_encoded
 
-    def __get_cached_content(self, filename: str) -> Optional[str]:
+    def __read_cached_content(self, url: str) -> tuple[Optional[str], bool]:
+        """The cached page and whether it came from the legacy pages dir. Runs on the I/O threads."""
+        if content := self.page_cache.get(url):
+            return content, False
+
+        filename = self.__encode_url_to_base64_filename(url)
+        if not filename:
+            return None, False
         file_path = (self._pages_dir / filename).with_suffix(".html")
         if file_path.exists():
-            return file_path.read_text()
-        return None
+            return file_path.read_text(), True
+        return None, False
 
-    async def __handle_response(
-        self, response: aiohttp.ClientResponse, filename: str
-    ) -> Optional[str]:
-        if response.status == 200:
-            content = await response.text()
-            is_captcha = self.__is_captcha_page(content)
-            is_no_reviews_page = self.__is_no_reviews_page(content)
-            is_login_page = self.__is_login_page(content)
-
-            if is_captcha or is_no_reviews_page or is_login_page:
-                return None
-            file_path = (self._pages_dir / filename).with_suffix(".html")
-            file_path.write_text(content)
+    async def __get_cached_content(self, url: str) -> Optional[str]:
+        if content := self.__pending_pages.get(url):
             return content
-        return None
+
+        content, legacy = await self.io.read(self.__read_cached_content, url)
+        if legacy:
+            # Move legacy pages into the page cache on first use
+            await self.__cache_page(url, content)
+        return content
+
+    def __put_page(self, url: str, content: str) -> None:
+        with METRICS.timer("cache_write_seconds"):
+            self.page_cache.put(url, content)
+        self.__pending_pages.pop(url, None)
+
+    async def __cache_page(self, url: str, content: str) -> None:
+        self.__pending_pages[url] = content
+        await self.io.write(self.__put_page, url, content)
 
     def __validate_url(self, url: str) -> bool:
         try:
@@ -99,52 +184,143 @@ class HttpMethods:
             print(f"URL parsing error: {repr(e)}")
             return False
 
-    async def __fetch_and_cache_url(self, url: str, filename: str) -> Optional[str]:
+    def __sniff_block(self, head: bytes) -> Optional[PageOutcome]:
+        for outcome, marker in BLOCK_MARKERS.items():
+            if marker in head:
+                return outcome
+        return None
+
+    async def __read_body(
+        self, url: str, response: aiohttp.ClientResponse
+    ) -> tuple[Optional[str], Optional[PageOutcome]]:
+        """
+        Streams the body of a 200, giving up on block pages as soon as a marker
+        shows up and on bodies over max_body_bytes. Returns the decoded body, or
+        None and the outcome it was abandoned with.
+        """
+        if (response.content_length or 0) > self.config.max_body_bytes:
+            response.close()
+            METRICS.inc("stream_aborts_total", reason="too_large")
+            print(f"Body of {url} is over {self.config.max_body_bytes} bytes")
+            return None, PageOutcome.FAILED
+
+        chunks = []
+        size = 0
+        # Markers are searched in the raw head, which may split them across chunks
+        head = b""
+        async for chunk in response.content.iter_chunked(self.config.stream_chunk_size):
+            chunks.append(chunk)
+            size += len(chunk)
+            if size > self.config.max_body_bytes:
+                outcome, reason = PageOutcome.FAILED, "too_large"
+                print(f"Body of {url} is over {self.config.max_body_bytes} bytes")
+            elif len(head) < self.config.stream_sniff_bytes:
+                head = (head + chunk)[: self.config.stream_sniff_bytes]
+                outcome = self.__sniff_block(head)
+                reason = outcome.value if outcome else None
+            else:
+                outcome = None
+            if outcome:
+                # Closing instead of releasing drops the rest of the transfer
+                response.close()
+                METRICS.inc("bytes_downloaded_total", size)
+                METRICS.inc("stream_aborts_total", reason=reason)
+                return None, outcome
+
+        METRICS.inc("bytes_downloaded_total", size)
+        body = b"".join(chunks)
+        try:
+            return body.decode(response.charset or "utf-8", errors="replace"), None
+        except LookupError:
+            return body.decode("utf-8", errors="replace"), None
+
+    async def __fetch_url(
+        self, url: str
+    ) -> tuple[int, Optional[str], Optional[PageOutcome]]:
+        """
+        Returns the last response status (0 on network errors), the body of a
+        200 and the block outcome when the body was abandoned while streaming.
+        """
+        status = 0
+        marketplace = self.__marketplace_for(url)
+        session = self.transports[marketplace.name].session
         for attempt in range(self.config.retry_attempts):
             try:
-                async with self.session.get(
-                    url=url,
-                    headers=self.headers,
-                    cookies=self.cookies,
-                    timeout=self.config.request_timeout,
-                ) as response:
-                    if response.status == 200:
-                        return await self.__handle_response(response, filename)
-                    elif response.status in [403, 404]:
-                        return None
-                    elif response.status in [500, 502, 503, 504]:
-                        await self.__handle_retry(attempt)
-                        continue
+                async with self.governor.slot(url), METRICS.async_timer(
+                    "fetch_seconds"
+                ):
+                    async with session.get(
+                        url=url,
+                        headers=self.headers,
+                        cookies=self.cookies[marketplace.name],
+                        timeout=self.config.request_timeout,
+                    ) as response:
+                        status = response.status
+                        METRICS.inc("responses_total", status=status)
+                        if response.status == 200:
+                            # Recorded once the page has been classified
+                            return (status, *await self.__read_body(url, response))
+                        elif response.status in [403, 404]:
+                            self.governor.record(url, blocked=response.status == 403)
+                            return status, None, None
+                        elif response.status == 429:
+                            self.governor.record(url, blocked=True)
+                        elif response.status in [500, 502, 503, 504]:
+                            self.governor.record(url, server_error=True)
             except (aiohttp.ClientError, asyncio.TimeoutError) as e:
                 print(f"Network/timeout error {url}: {repr(e)}")
-                await self.__handle_retry(attempt)
-                continue
+                METRICS.inc("network_errors_total", error=type(e).__name__)
+                self.governor.record(url, server_error=True)
             except Exception as e:
                 print(f"Unexpected error at url {url}: {repr(e)}")
-                return None
-        return None
+                return status, None, None
+            # Wait outside of the request slot so it can go to another request
+            METRICS.inc("fetch_retries_total")
+            await self.__handle_retry(attempt)
+        return status, None, None
 
-    async def __handle_retry(self, attempt: int) -> None:
-        if attempt < self.config.retry_attempts - 1:
-            wait_time = self.config.retry_delay * (attempt + 1)
-            await asyncio.sleep(wait_time)
-
-    def __is_captcha_page(self, html: str) -> bool:
-        soup = BeautifulSoup(html, "html.parser")
-        return bool(soup.findAll(text="Enter the characters you see below"))
+    async def __fetch_and_cache_url(self, url: str) -> tuple[Optional[str], ParsedPage]:
+        status, content, aborted = await self.__fetch_url(url)
+        if aborted:
+            # Never parsed, the markers alone decide the outcome
+            self.governor.record(
+                url, blocked=aborted in [PageOutcome.CAPTCHA, PageOutcome.LOGIN]
+            )
+            await self.__cache_negative(url, aborted)
+            return None, ParsedPage(outcome=aborted)
+        if content is None:
+            outcome = PageOutcome.NOT_FOUND if status == 404 else PageOutcome.FAILED
+            await self.__cache_negative(url, outcome)
+            return None, ParsedPage(outcome=outcome)
 
-    def __is_no_reviews_page(self, html: str) -> bool:
-        # Check if no reviews match current filtered selection
-        soup = BeautifulSoup(html, "html.parser")
-        rtn = bool(
-            soup.findAll(text="Sorry, no reviews match your current selections.")
+        # Classification and extraction happen in the same pass
+        page = await self.page_parser.parse(content, self.__marketplace_for(url).name)
+        self.governor.record(
+            url, blocked=page.outcome in [PageOutcome.CAPTCHA, PageOutcome.LOGIN]
         )
-        return rtn
+        if page.outcome != PageOutcome.OK:
+            await self.__cache_negative(url, page.outcome)
+            return None, page
+
+        await self.__cache_page(url, content)
+        return content, page
 
-    def __is_login_page(self, html: str) -> bool:
-        soup = BeautifulSoup(html, "html.parser")
-        rtn = bool(soup.findAll(attrs={"name": "signIn"}))
-        return rtn
+    async def __cache_negative(self, url: str, outcome: PageOutcome) -> None:
+        ttl = self.config.negative_cache_ttls.get(outcome.value)
+        if ttl:
+            await self.io.write(self.page_cache.put_negative, url, outcome.value, ttl)
+
+    async def forget_negative(self, url: str) -> None:
+        """Drop a cached negative outcome so the next request goes to the network"""
+        # Queued behind any pending put of the same url
+        await self.io.write(self.page_cache.delete_negative, url, wait=True)
+
+    async def __handle_retry(self, attempt: int) -> None:
+        if attempt < self.config.retry_attempts - 1:
+            wait_time = backoff_delay(
+                attempt, self.config.retry_delay, self.config.retry_max_delay
+            )
+            await asyncio.sleep(wait_time)
 
     async def get_and_download_url(self, url: str) -> Optional[str]:
         """
@@ -155,8 +331,58 @@ class HttpMethods:
         if not self.__validate_url(url):
             return None
 
-        filename = self.__encode_url_to_base64_filename(url)
-        if cached_content := self.__get_cached_content(filename):
+        if cached_content := await self.__get_cached_content(url):
+            METRICS.inc("cache_lookups_total", result="hit")
             return cached_content
 
-        return await self.__fetch_and_cache_url(url, filename)
+        if await self.io.read(self.page_cache.get_negative, url):
+            METRICS.inc("cache_lookups_total", result="negative_hit")
+            return None
+
+        METRICS.inc("cache_lookups_total", result="miss")
+        content, page = await self.__fetch_and_cache_url(url)
+        self.__record_page(url, page, "network")
+        return content
+
+    async def get_and_parse_url(self, url: str, fresh: bool = False) -> ParsedPage:
+        """
+        Same as get_and_download_url, but hands back the parsed page instead of the html.
+        Parsing happens off the event loop in the parser worker processes. A fresh
+        page always comes from the network and replaces the cached one.
+        """
+
+        if not self.__validate_url(url):
+            return ParsedPage(outcome=PageOutcome.FAILED)
+
+        if fresh:
+            METRICS.inc("cache_lookups_total", result="bypass")
+            _, page = await self.__fetch_and_cache_url(url)
+            return self.__record_page(url, page, "network")
+
+        if cached_content := await self.__get_cached_content(url):
+            METRICS.inc("cache_lookups_total", result="hit")
+            page = await self.page_parser.parse(
+                cached_content, self.__marketplace_for(url).name
+            )
+            return self.__record_page(url, page, "cache")
+
+        if outcome := await self.io.read(self.page_cache.get_negative, url):
+            METRICS.inc("cache_lookups_total", result="negative_hit")
+            return self.__record_page(
+                url, ParsedPage(outcome=PageOutcome(outcome)), "cache"
+            )
+
+        METRICS.inc("cache_lookups_total", result="miss")
+        _, page = await self.__fetch_and_cache_url(url)
+        return self.__record_page(url, page, "network")
+
+    def __record_page(self, url: str, page: ParsedPage, source: str) -> ParsedPage:
+        METRICS.inc(
+            "page_outcomes_total",
+            outcome=page.outcome.value,
+            source=source,
+            marketplace=self.__marketplace_for(url).name,
+        )
+        if page.outcome == PageOutcome.OK:
+            METRICS.observe("reviews_per_page", page.review_count, COUNT_BUCKETS)
+        return page
@@ -0,0 +1,232 @@
+"""
+Converts the product results, per ASIN JSON files or gzip JSON Lines batches,
+into three Parquet tables.
+
+    review_votes: asin, marketplace, id, verified_purchase, found_helpful
+    review_media: asin, marketplace, id, videos, images
+    review_text:  asin, marketplace, id, title, body, date, rating, username,
+                  username_url
+
+These are Table 1, 2 and 3 of 05_process_json. Files are parsed in a pool of
+worker processes that hand back plain column lists, and the columns are
+written out in row groups of `batch_rows`, so memory stays flat no matter how
+many reviews there are.
+
+Usage:
+    python json_to_tables.py --input ./data/pfw/results --output ./data/pfw/tables
+"""
+
+import argparse
+import gzip
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from itertools import islice
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from amazon_product import AmazonProduct
+
+TABLE_SCHEMAS = {
+    "review_votes": pa.schema(
+        [
+            ("asin", pa.string()),
+            ("marketplace", pa.string()),
+            ("id", pa.string()),
+            ("verified_purchase", pa.bool_()),
+            ("found_helpful", pa.int32()),
+        ]
+    ),
+    "review_media": pa.schema(
+        [
+            ("asin", pa.string()),
+            ("marketplace", pa.string()),
+            ("id", pa.string()),
+            ("videos", pa.list_(pa.string())),
+            ("images", pa.list_(pa.string())),
+        ]
+    ),
+    "review_text": pa.schema(
+        [
+            ("asin", pa.string()),
+            ("marketplace", pa.string()),
+            ("id", pa.string()),
+            ("title", pa.string()),
+            ("body", pa.string()),
+            ("date", pa.timestamp("s")),
+            ("rating", pa.float32()),
+            ("username", pa.string()),
+            ("username_url", pa.string()),
+        ]
+    ),
+}
+
+Columns = Dict[str, Dict[str, list]]
+
+
+def empty_columns() -> Columns:
+    return {
+        table: {name: [] for name in schema.names}
+        for table, schema in TABLE_SCHEMAS.items()
+    }
+
+
+def parse_date(value: Optional[str]) -> Optional[datetime]:
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        return None
+
+
+PRODUCT_FILE_SUFFIXES = (".json", ".jsonl", ".jsonl.gz")
+
+
+def load_products(path: str) -> List[AmazonProduct]:
+    if path.endswith(".json"):
+        with open(path, "r") as f:
+            return [AmazonProduct.from_json(json.load(f))]
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt") as f:
+        return [AmazonProduct.from_json(json.loads(line)) for line in f if line.strip()]
+
+
+def extract_columns(path: str) -> Columns:
+    """Read one product file into column lists. Runs in the worker processes."""
+    columns = empty_columns()
+    try:
+        products = load_products(path)
+    except Exception as e:
+        print(f"Error processing file {path}: {e}")
+        return columns
+
+    for product in products:
+        append_product(columns, product)
+    return columns
+
+
+def append_product(columns: Columns, product: AmazonProduct) -> None:
+    votes = columns["review_votes"]
+    media = columns["review_media"]
+    text = columns["review_text"]
+    asin = product.asin
+    marketplace = product.marketplace
+    for review in product.review_list:
+        review_id = review.get("id")
+
+        votes["asin"].append(asin)
+        votes["marketplace"].append(marketplace)
+        votes["id"].append(review_id)
+        votes["verified_purchase"].append(review.get("verified_purchase"))
+        votes["found_helpful"].append(review.get("found_helpful"))
+
+        media["asin"].append(asin)
+        media["marketplace"].append(marketplace)
+        media["id"].append(review_id)
+        media["videos"].append(review.get("videos") or [])
+        media["images"].append(review.get("images") or [])
+
+        text["asin"].append(asin)
+        text["marketplace"].append(marketplace)
+        text["id"].append(review_id)
+        text["title"].append(review.get("title"))
+        text["body"].append(review.get("body"))
+        text["date"].append(parse_date(review.get("date")))
+        text["rating"].append(review.get("rating"))
+        text["username"].append(review.get("username"))
+        text["username_url"].append(review.get("username_url"))
+
+
+def iter_product_files(input_dir: str) -> Iterator[str]:
+    for root, _, files in os.walk(input_dir):
+        for file in files:
+            if file.endswith(PRODUCT_FILE_SUFFIXES):
+                yield os.path.join(root, file)
+
+
+class TableWriter:
+    """Buffers column lists and writes them as Parquet row groups"""
+
+    def __init__(self, output_dir: str, batch_rows: int):
+        self.batch_rows = batch_rows
+        Path(output_dir).mkdir(parents=True, exist_ok=True)
+        self.paths = {
+            table: os.path.join(output_dir, f"{table}.parquet")
+            for table in TABLE_SCHEMAS
+        }
+        self.writers = {
+            table: pq.ParquetWriter(self.paths[table], schema, compression="zstd")
+            for table, schema in TABLE_SCHEMAS.items()
+        }
+        self.columns = empty_columns()
+        self.rows = 0
+
+    def extend(self, columns: Columns) -> None:
+        for table, table_columns in columns.items():
+            for name, values in table_columns.items():
+                self.columns[table][name].extend(values)
+        self.rows += len(columns["review_votes"]["id"])
+        if self.rows >= self.batch_rows:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self.rows:
+            return
+        for table, schema in TABLE_SCHEMAS.items():
+            self.writers[table].write_table(
+                pa.Table.from_pydict(self.columns[table], schema=schema)
+            )
+        self.columns = empty_columns()
+        self.rows = 0
+
+    def close(self) -> None:
+        self.flush()
+        for writer in self.writers.values():
+            writer.close()
+
+
+def convert(
+    input_dir: str = "./data/pfw/results",
+    output_dir: str = "./data/pfw/tables",
+    max_workers: Optional[int] = None,
+    batch_rows: int = 100_000,
+) -> Dict[str, str]:
+    """
+    Convert every product file under input_dir.
+
+    Returns:
+        Dict[str, str]: The Parquet file path of every table.
+    """
+    writer = TableWriter(output_dir, batch_rows)
+    files = iter_product_files(input_dir)
+    files_done = 0
+    try:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            # Submit a window of files at a time so results never pile up
+            while window := list(islice(files, 1024)):
+                for columns in executor.map(extract_columns, window, chunksize=16):
+                    writer.extend(columns)
+                    files_done += 1
+    finally:
+        writer.close()
+    print(f"Converted {files_done} product files into {output_dir}")
+    return writer.paths
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--input", default="./data/pfw/results")
+    parser.add_argument("--output", default="./data/pfw/tables")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--batch-rows", type=int, default=100_000)
+    args = parser.parse_args(argv)
+    convert(args.input, args.output, args.workers, args.batch_rows)
+
+
+if __name__ == "__main__":
+    main()
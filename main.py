@@ -1,21 +1,32 @@
+import argparse
 import asyncio
 import time
+from typing import Optional
+from datetime import datetime
 import pandas as pd
 from amazon_scraper import AmazonScraper, ScrapingConfig
+from progress_store import ProgressStore
+from work_queue import WorkQueue
 
-chunk_size = 5
 max_pages = 10
 max_workers = 10
 request_timeout = 60
 retry_attempts = 3
+max_concurrent_products = 10
+# Study window for the reviews
+review_start_date = datetime(2024, 10, 1)
+review_end_date = datetime(2024, 11, 30)
+# The stores compared by the study, crawled side by side
+marketplaces = ["com", "ca"]
 
 
-# Function to split DataFrame into chunks
-def split_dataframe(df: pd.DataFrame, chunk_size: int) -> list[pd.DataFrame]:
-    return [df.iloc[i : i + chunk_size] for i in range(0, len(df), chunk_size)]
-
-
-async def main():
+async def main(
+    compact: bool = False,
+    worker: bool = False,
+    worker_id: Optional[str] = None,
+    shard: Optional[int] = None,
+    refresh: bool = False,
+):
 
     df = pd.read_pickle("./data/pfw/04_extract_reviews.pkl")
 
@@ -25,33 +36,108 @@ async def main():
     if "review_complete" not in df.columns:
         raise Exception("df does not contain a column called review_complete")
 
-    filtered_df = df[df["review_complete"] != 1]
-
-    if filtered_df.empty:
-        print("All ASINs have been scraped.")
-        return
-
     config = ScrapingConfig(
+        marketplaces=marketplaces,
         max_pages=max_pages,
         max_workers=max_workers,
         max_concurrent_requests=50,
+        max_concurrent_products=max_concurrent_products,
+        review_start_date=review_start_date,
+        # The window's end would drop every review a refresh is after
+        review_end_date=None if refresh else review_end_date,
         request_timeout=request_timeout,
         retry_attempts=retry_attempts,
+        worker_id=worker_id,
+        session_shard=shard,
+        incremental_refresh=refresh,
     )
-    # Split the DataFrame into chunks
-    chunks = split_dataframe(filtered_df, chunk_size)
+    if refresh:
+        # Every day's refresh gets its own queue, earlier queues have every ASIN done
+        config.work_queue_path = config.work_queue_path.replace(
+            ".sqlite", f".refresh-{datetime.now():%Y%m%d}.sqlite"
+        )
 
-    for chunk in chunks[:1]:
-        # asins = chunks[0]["asin"]
-        start_time = time.time()
+    progress_store = ProgressStore(config)
+    if compact:
+        # Fold the progress journal into the DataFrame on disk
+        progress_store.compact_into(df, marketplaces=config.marketplaces)
+        progress_store.close()
+        return
 
-        async with AmazonScraper(config) as scraper:
-            await scraper.scrape_asins(asins=chunk["asin"], target_df=df)
-        
-        end_time = time.time()
-        elapsed_time = end_time - start_time
+    # Resume from both the compacted DataFrame and the progress journal, per
+    # store, so an ASIN finished on one store is only crawled on the other
+    compacted = set(df.loc[df["review_complete"] == 1, "asin"])
+    pending = {}
+    for marketplace in config.marketplaces:
+        completed = progress_store.completed_asins([marketplace])
+        # A refresh only has something to go on for ASINs scraped before
+        pending[marketplace] = [
+            asin
+            for asin in df["asin"].tolist()
+            if (asin in compacted or asin in completed) == refresh
+        ]
+    progress_store.close()
 
-        print(f"time elapsed {elapsed_time}")
+    if not any(pending.values()):
+        print("No ASINs to refresh." if refresh else "All ASINs have been scraped.")
+        return
 
+    start_time = time.time()
 
-asyncio.run(main())
+    # Every marketplace gets its own connection pool, so one store blocking
+    # never holds up the connections of the other
+    async with AmazonScraper(config) as scraper:
+        if worker:
+            # Every worker offers the pending ASINs, the queue keeps the first copy
+            work_queue = WorkQueue(config)
+            for marketplace, asins in pending.items():
+                work_queue.enqueue(asins, [marketplace])
+            try:
+                await scraper.scrape_queue(work_queue)
+            finally:
+                print(f"work queue: {work_queue.counts()}")
+                work_queue.close()
+        else:
+            # A single scraper streams every pending ASIN through its work queue
+            await scraper.scrape_asins(asins=pending)
+        print(f"connection pools: {scraper.http_methods.transport_stats()}")
+
+    end_time = time.time()
+    elapsed_time = end_time - start_time
+
+    print(f"time elapsed {elapsed_time}")
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "--compact",
+    action="store_true",
+    help="write completed ASINs from the progress journal into 04_extract_reviews",
+)
+parser.add_argument(
+    "--worker",
+    action="store_true",
+    help="lease ASINs from the shared work queue, run one per process or node",
+)
+parser.add_argument("--worker-id", help="defaults to host and pid")
+parser.add_argument(
+    "--shard",
+    type=int,
+    help="use the AMAZON_SESSION_ID_<shard> and AMAZON_TOKEN_<shard> session",
+)
+parser.add_argument(
+    "--refresh",
+    action="store_true",
+    help="fetch only the reviews newer than the last crawl of every scraped ASIN",
+)
+args = parser.parse_args()
+
+asyncio.run(
+    main(
+        compact=args.compact,
+        worker=args.worker,
+        worker_id=args.worker_id,
+        shard=args.shard,
+        refresh=args.refresh,
+    )
+)
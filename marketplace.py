@@ -0,0 +1,66 @@
+from dataclasses import dataclass
+from typing import List, Optional
+from urllib.parse import urlparse
+
+from scraping_config import ScrapingConfig
+
+DEFAULT_MARKETPLACE = "com"
+
+
+@dataclass(frozen=True)
+class Marketplace:
+    name: str
+    base_url: str
+    currency: str
+    locale: str
+    # Amazon's suffix of the per store cookies, e.g. ubid-main or lc-acbca
+    cookie_suffix: str
+
+    @property
+    def host(self) -> str:
+        return urlparse(self.base_url).netloc
+
+
+MARKETPLACES = {
+    "com": Marketplace("com", "https://www.amazon.com", "USD", "en_US", "main"),
+    "ca": Marketplace("ca", "https://www.amazon.ca", "CAD", "en_CA", "acbca"),
+}
+
+
+def get_marketplace(name: str, config: Optional[ScrapingConfig] = None) -> Marketplace:
+    """A known marketplace, at the base url configured for it if there is one"""
+    if name not in MARKETPLACES:
+        raise ValueError(f"Unknown marketplace: {name}")
+    marketplace = MARKETPLACES[name]
+    base_url = (config.marketplace_base_urls if config else {}).get(name)
+    if base_url:
+        return Marketplace(
+            name,
+            base_url,
+            marketplace.currency,
+            marketplace.locale,
+            marketplace.cookie_suffix,
+        )
+    return marketplace
+
+
+def public_base_url(name: str) -> str:
+    """Store url of a marketplace for the urls kept with the results"""
+    if name in MARKETPLACES:
+        return MARKETPLACES[name].base_url
+    # Unknown stores are named after their host
+    return f"https://{name}"
+
+
+def configured_marketplaces(config: ScrapingConfig) -> List[Marketplace]:
+    return [get_marketplace(name, config) for name in config.marketplaces]
+
+
+def marketplace_for_base_url(
+    base_url: str, config: Optional[ScrapingConfig] = None
+) -> str:
+    """Name of the marketplace served from base_url, its host for unknown stores"""
+    for name in MARKETPLACES:
+        if get_marketplace(name, config).base_url == base_url:
+            return name
+    return urlparse(base_url).netloc
@@ -0,0 +1,256 @@
+import asyncio
+import bisect
+import json
+import logging
+import time
+from contextlib import asynccontextmanager, contextmanager
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+from aiohttp import web
+
+from scraping_config import ScrapingConfig
+
+try:
+    from pythonjsonlogger.json import JsonFormatter
+except ImportError:
+    try:
+        from pythonjsonlogger.jsonlogger import JsonFormatter
+    except ImportError:
+        JsonFormatter = None
+
+
+# Seconds, from a warm cache hit to a slow request with retries
+LATENCY_BUCKETS = (
+    0.001,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 1000)
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    """Cumulative bucket counts like a Prometheus histogram"""
+
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket the quantile falls in"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        # Past the last bucket, the largest value is the best bound we have
+        return self.max
+
+    def summary(self) -> Dict:
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+            "max": round(self.max, 6),
+        }
+
+
+def format_name(name: str, labels: LabelKey) -> str:
+    if not labels:
+        return name
+    label_text = ",".join(f'{key}="{value}"' for key, value in labels)
+    return f"{name}{{{label_text}}}"
+
+
+class Metrics:
+    """
+    Counters, gauges and histograms of every pipeline stage, keyed by name and
+    labels.
+
+    Everything runs on the event loop or in the writer threads, where a lost
+    increment only skews a statistic, so there is no locking.
+    """
+
+    def __init__(self):
+        self.counters: Dict[Tuple[str, LabelKey], float] = {}
+        self.gauges: Dict[Tuple[str, LabelKey], float] = {}
+        self.histograms: Dict[Tuple[str, LabelKey], Histogram] = {}
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name: str, value: float, **labels) -> None:
+        """Record the current value of something that goes up and down"""
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        self.gauges[key] = value
+
+    def observe(
+        self,
+        name: str,
+        value: float,
+        buckets: Tuple[float, ...] = LATENCY_BUCKETS,
+        **labels,
+    ) -> None:
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        if key not in self.histograms:
+            self.histograms[key] = Histogram(buckets)
+        self.histograms[key].observe(value)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start_time, **labels)
+
+    @asynccontextmanager
+    async def async_timer(self, name: str, **labels):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start_time, **labels)
+
+    def snapshot(self) -> Dict:
+        return {
+            "counters": {
+                format_name(name, labels): value
+                for (name, labels), value in sorted(self.counters.items())
+            },
+            "gauges": {
+                format_name(name, labels): value
+                for (name, labels), value in sorted(self.gauges.items())
+            },
+            "histograms": {
+                format_name(name, labels): histogram.summary()
+                for (name, labels), histogram in sorted(self.histograms.items())
+            },
+        }
+
+    def prometheus_text(self) -> str:
+        lines = []
+        for (name, labels), value in sorted(self.counters.items()):
+            lines.append(f"{format_name(name, labels)} {value}")
+        for (name, labels), value in sorted(self.gauges.items()):
+            lines.append(f"{format_name(name, labels)} {value}")
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            cumulative = 0
+            for bound, count in zip([*histogram.buckets, "+Inf"], histogram.counts):
+                cumulative += count
+                bucket_labels = tuple(sorted([*labels, ("le", str(bound))]))
+                lines.append(
+                    f"{format_name(name + '_bucket', bucket_labels)} {cumulative}"
+                )
+            lines.append(f"{format_name(name + '_sum', labels)} {histogram.sum}")
+            lines.append(f"{format_name(name + '_count', labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+# Shared by every component of the crawl process
+METRICS = Metrics()
+
+
+class MetricsReporter:
+    """
+    Logs a JSON snapshot of METRICS every `metrics_log_interval` seconds and,
+    when `metrics_port` is set, serves them in the Prometheus text format on
+    `/metrics`.
+    """
+
+    def __init__(
+        self, config: Optional[ScrapingConfig] = None, metrics: Metrics = METRICS
+    ):
+        self.config = config or ScrapingConfig()
+        self.metrics = metrics
+        self.logger = self.__setup_logger()
+        self.task: Optional[asyncio.Task] = None
+        self.runner: Optional[web.AppRunner] = None
+
+    def __setup_logger(self) -> logging.Logger:
+        logger = logging.getLogger("zon_crawler.metrics")
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+        if not logger.handlers:
+            if self.config.metrics_log_path:
+                path = Path(self.config.metrics_log_path)
+                path.parent.mkdir(parents=True, exist_ok=True)
+                handler = logging.FileHandler(path)
+            else:
+                handler = logging.StreamHandler()
+            if JsonFormatter is not None:
+                handler.setFormatter(JsonFormatter("%(asctime)s %(message)s"))
+            logger.addHandler(handler)
+        return logger
+
+    def log_snapshot(self) -> None:
+        snapshot = self.metrics.snapshot()
+        if JsonFormatter is not None:
+            self.logger.info("metrics", extra=snapshot)
+        else:
+            self.logger.info(json.dumps({"message": "metrics", **snapshot}))
+
+    async def __log_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.config.metrics_log_interval)
+            self.log_snapshot()
+
+    async def __handle_metrics(self, request: web.Request) -> web.Response:
+        return web.Response(
+            text=self.metrics.prometheus_text(), content_type="text/plain"
+        )
+
+    async def start(self) -> None:
+        if self.config.metrics_log_interval > 0:
+            self.task = asyncio.create_task(self.__log_periodically())
+        if self.config.metrics_port:
+            app = web.Application()
+            app.router.add_get("/metrics", self.__handle_metrics)
+            self.runner = web.AppRunner(app, access_log=None)
+            await self.runner.setup()
+            site = web.TCPSite(
+                self.runner, self.config.metrics_host, self.config.metrics_port
+            )
+            await site.start()
+            print(
+                "Serving metrics on "
+                f"http://{self.config.metrics_host}:{self.config.metrics_port}/metrics"
+            )
+
+    async def stop(self) -> None:
+        if self.task:
+            self.task.cancel()
+            self.task = None
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
+        # Always leave the final numbers of the run behind
+        self.log_snapshot()
@@ -0,0 +1,254 @@
+"""
+Rebuilds the per ASIN results from the page cache, without any network access.
+
+Every cached page is mapped back to its ASIN, filter combination and page
+number through its url, parsed again with the current parser in a pool of
+worker processes and merged with the same dedup and date window as a crawl.
+Failed pages recorded in the cache become the product's failed urls. Pages
+still in the legacy pages dir are read as well. Use it after a selector fix
+to refresh the results at CPU speed.
+
+A product whose cached pages now hold fewer reviews than its last crawl
+recorded, e.g. after the cache evicted some of them, is reported and its
+stored results are kept, unless --allow-shrink is given.
+
+Usage:
+    python offline_rebuild.py --workers 16 --result-writer jsonl
+"""
+
+import argparse
+import asyncio
+import base64
+import binascii
+import heapq
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from dataclasses import dataclass, field, replace
+from itertools import groupby
+from pathlib import Path
+from typing import Iterator, List, Optional
+
+from amazon_product import AmazonProduct
+from asin_scheduler import AsinScheduler
+from helpers import encode_found_under, in_date_window, parse_review_url
+from marketplace import marketplace_for_base_url
+from page_cache import PageCache, read_entry
+from page_parser import PageOutcome, parse_page
+from progress_store import ProgressStore
+from result_writer import create_result_writer
+from scraping_config import ScrapingConfig
+
+
+@dataclass
+class CachedProduct:
+    base_url: str
+    asin: str
+    # (sort_by, star_rating, format_type, media_type, page_number, url, key,
+    # compression) of every cached page, legacy pages have their path as key
+    pages: List[tuple] = field(default_factory=list, repr=False)
+    failed_urls: List[str] = field(default_factory=list, repr=False)
+
+
+# Compression of legacy pages, which are plain html files
+LEGACY_PAGE = "legacy"
+
+
+def legacy_entries(pages_dir: Path) -> List[tuple]:
+    """Pages in the legacy pages dir as cache entries, ordered by url"""
+    if not pages_dir.is_dir():
+        return []
+    entries = []
+    for path in pages_dir.glob("*.html"):
+        # Named after the urlsafe base64 of their url, like HttpMethods reads them
+        try:
+            url = base64.urlsafe_b64decode(path.stem).decode()
+        except (binascii.Error, UnicodeDecodeError):
+            continue
+        entries.append((url, str(path), LEGACY_PAGE, None))
+    return sorted(entries)
+
+
+def iter_cached_products(
+    page_cache: PageCache, pages_dir: Optional[Path] = None
+) -> Iterator[CachedProduct]:
+    """Cache entries grouped per product, the index is ordered by url"""
+    entries = page_cache.entries()
+    if pages_dir is not None:
+        # On equal urls the page cache comes first and wins
+        entries = heapq.merge(
+            entries, legacy_entries(pages_dir), key=lambda entry: entry[0]
+        )
+    parsed_entries = ((parse_review_url(entry[0]), entry) for entry in entries)
+    review_entries = (
+        (parsed, entry) for parsed, entry in parsed_entries if parsed is not None
+    )
+    for (base_url, asin), group in groupby(
+        review_entries, key=lambda item: item[0][:2]
+    ):
+        product = CachedProduct(base_url=base_url, asin=asin)
+        failed = []
+        cached_urls = set()
+        for parsed, (url, key, compression, outcome) in group:
+            if outcome is None:
+                if url in cached_urls:
+                    continue
+                cached_urls.add(url)
+                product.pages.append((*parsed[2:], url, key, compression))
+            elif outcome != PageOutcome.NO_REVIEWS.value:
+                failed.append(url)
+        # A page that failed once can still have been cached by a later retry
+        product.failed_urls = [url for url in failed if url not in cached_urls]
+        yield product
+
+
+def read_page(config: ScrapingConfig, key: str, compression: Optional[str]) -> str:
+    if compression == LEGACY_PAGE:
+        return Path(key).read_text()
+    return read_entry(Path(config.cache_dir), key, compression)
+
+
+def rebuild_product(
+    cached_product: CachedProduct, config: ScrapingConfig
+) -> AmazonProduct:
+    """Parse and merge the cached pages of one product. Runs in the worker processes."""
+    # Pages cached from a store's configured base url belong to that store
+    marketplace = marketplace_for_base_url(cached_product.base_url, config)
+    product = AmazonProduct(cached_product.asin, marketplace)
+    product.failed_urls = list(cached_product.failed_urls)
+    # Unfiltered pages first, like the probe page of a crawl
+    pages = sorted(
+        cached_product.pages, key=lambda page: (page[1] is not None, page[5])
+    )
+    for (
+        sort_by,
+        star,
+        format_type,
+        media_type,
+        page_number,
+        url,
+        key,
+        compression,
+    ) in pages:
+        try:
+            page = parse_page(read_page(config, key, compression), marketplace)
+        except (OSError, ValueError, EOFError) as e:
+            print(f"Cache entry error {url}: {repr(e)}")
+            product.failed_urls.append(url)
+            continue
+        if page.outcome != PageOutcome.OK:
+            if page.outcome != PageOutcome.NO_REVIEWS:
+                product.failed_urls.append(url)
+            continue
+
+        page.reviews = [
+            review
+            for review in page.reviews
+            if in_date_window(
+                review.date, config.review_start_date, config.review_end_date
+            )
+        ]
+        product.merge_page(
+            page,
+            encode_found_under(sort_by, star, format_type, media_type, page_number),
+        )
+    return product
+
+
+class OfflineRebuilder:
+    def __init__(
+        self,
+        config: Optional[ScrapingConfig] = None,
+        max_workers: Optional[int] = None,
+        allow_shrink: bool = False,
+    ):
+        # Seen reviews are for crawls, a rebuild has to keep every review
+        self.config = replace(config or ScrapingConfig(), skip_seen_reviews=False)
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.allow_shrink = allow_shrink
+        self.page_cache = PageCache(config=self.config)
+        self.progress_store = ProgressStore(config=self.config)
+        self.result_writer = create_result_writer(config=self.config)
+        self.products = 0
+        self.reviews = 0
+        # (asin, marketplace, rebuilt reviews, crawled reviews) kept as they were
+        self.shrunk: List[tuple] = []
+
+    async def __rebuild(
+        self, executor: ProcessPoolExecutor, cached_product: CachedProduct
+    ) -> None:
+        loop = asyncio.get_running_loop()
+        product = await loop.run_in_executor(
+            executor, rebuild_product, cached_product, self.config
+        )
+        crawled = self.progress_store.review_count(product.asin, product.marketplace)
+        if crawled and len(product.review_list) < crawled and not self.allow_shrink:
+            print(
+                f"Keeping {product.asin} ({product.marketplace}): the cache holds "
+                f"{len(product.review_list)} of its {crawled} crawled reviews"
+            )
+            self.shrunk.append(
+                (product.asin, product.marketplace, len(product.review_list), crawled)
+            )
+            return
+        await self.result_writer.write(product)
+        self.products += 1
+        self.reviews += len(product.review_list)
+
+    async def run(self) -> None:
+        with ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+            # Twice the workers in flight keeps every core busy while writing
+            scheduler = AsinScheduler(
+                handler=lambda cached_product: self.__rebuild(executor, cached_product),
+                max_in_flight=self.max_workers * 2,
+            )
+            try:
+                await scheduler.run(
+                    iter_cached_products(
+                        self.page_cache, Path(self.config.legacy_pages_dir)
+                    )
+                )
+            finally:
+                await self.result_writer.close()
+                self.page_cache.close()
+                self.progress_store.close()
+        print(f"Rebuilt {self.products} products with {self.reviews} reviews")
+        if self.shrunk:
+            print(
+                f"Kept {len(self.shrunk)} products whose cached pages no longer "
+                "cover their last crawl, rerun with --allow-shrink to overwrite them"
+            )
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--cache-dir", default=ScrapingConfig.cache_dir)
+    parser.add_argument("--results-dir", default=ScrapingConfig.results_dir)
+    parser.add_argument("--pages-dir", default=ScrapingConfig.legacy_pages_dir)
+    parser.add_argument("--progress-db", default=ScrapingConfig.progress_db_path)
+    parser.add_argument("--result-writer", default=ScrapingConfig.result_writer)
+    parser.add_argument("--workers", type=int, default=None)
+    # Same review window as the crawl, as YYYY-MM-DD
+    parser.add_argument("--start-date", type=datetime.fromisoformat, default=None)
+    parser.add_argument("--end-date", type=datetime.fromisoformat, default=None)
+    parser.add_argument(
+        "--allow-shrink",
+        action="store_true",
+        help="overwrite products even when the cache holds fewer reviews than crawled",
+    )
+    args = parser.parse_args(argv)
+
+    config = ScrapingConfig(
+        cache_dir=args.cache_dir,
+        legacy_pages_dir=args.pages_dir,
+        progress_db_path=args.progress_db,
+        results_dir=args.results_dir,
+        result_writer=args.result_writer,
+        review_start_date=args.start_date,
+        review_end_date=args.end_date,
+    )
+    asyncio.run(OfflineRebuilder(config, args.workers, args.allow_shrink).run())
+
+
+if __name__ == "__main__":
+    main()
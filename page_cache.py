@@ -0,0 +1,253 @@
+import gzip
+import hashlib
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Iterator, Optional, Tuple
+
+from scraping_config import ScrapingConfig
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+COMPRESSION_SUFFIXES = {"zstd": ".html.zst", "gzip": ".html.gz"}
+
+
+def entry_path(root: Path, key: str, compression: str) -> Path:
+    return root / key[:2] / key[2:4] / (key + COMPRESSION_SUFFIXES[compression])
+
+
+def decompress(data: bytes, compression: str) -> str:
+    if compression == "zstd":
+        if not zstandard:
+            raise ValueError("zstd cache entry requires the zstandard package")
+        return zstandard.ZstdDecompressor().decompress(data).decode()
+    return gzip.decompress(data).decode()
+
+
+def read_entry(root: Path, key: str, compression: str) -> str:
+    """Read a cache entry without the index, e.g. from another process"""
+    return decompress(entry_path(root, key, compression).read_bytes(), compression)
+
+
+class PageCache:
+    """
+    Content addressed html cache.
+
+    Entries are keyed by the sha256 of their url and stored compressed under
+    two levels of shard directories (`ab/cd/abcd....html.zst`), so neither long
+    urls nor millions of pages end up in a single flat directory. A SQLite
+    index records the url, fetch time, status and size of every entry, and the
+    least recently used entries are evicted once the cache grows past
+    `cache_max_bytes`.
+
+    Pages that did not yield reviews (no reviews, captcha, login, 404) are
+    kept as negative entries in the index only, each with its own expiry.
+    """
+
+    def __init__(self, config: Optional[ScrapingConfig] = None):
+        self.config = config or ScrapingConfig()
+        self.root = Path(self.config.cache_dir)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+        self.compression = self.config.cache_compression or (
+            "zstd" if zstandard else "gzip"
+        )
+        if self.compression not in COMPRESSION_SUFFIXES:
+            raise ValueError(f"Unknown cache compression: {self.compression}")
+        if self.compression == "zstd" and not zstandard:
+            raise ValueError("zstd cache compression requires the zstandard package")
+
+        # Used from the background I/O threads, every access holds the lock
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.root / "index.sqlite", check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS pages (
+                key TEXT PRIMARY KEY,
+                url TEXT NOT NULL,
+                fetched_at REAL NOT NULL,
+                last_access REAL NOT NULL,
+                status INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                compression TEXT NOT NULL
+            )
+            """)
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS pages_last_access ON pages (last_access)"
+        )
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS negatives (
+                key TEXT PRIMARY KEY,
+                url TEXT NOT NULL,
+                outcome TEXT NOT NULL,
+                fetched_at REAL NOT NULL,
+                expires_at REAL NOT NULL
+            )
+            """)
+        self.db.commit()
+        self.total_size = self.db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM pages"
+        ).fetchone()[0]
+
+    @staticmethod
+    def key_for(url: str) -> str:
+        return hashlib.sha256(url.encode()).hexdigest()
+
+    def __path_for(self, key: str, compression: str) -> Path:
+        return entry_path(self.root, key, compression)
+
+    def __compress(self, content: str) -> bytes:
+        data = content.encode()
+        if self.compression == "zstd":
+            return zstandard.ZstdCompressor(
+                level=self.config.cache_compression_level
+            ).compress(data)
+        return gzip.compress(data, compresslevel=self.config.cache_compression_level)
+
+    def get(self, url: str) -> Optional[str]:
+        key = self.key_for(url)
+        with self.lock:
+            row = self.db.execute(
+                "SELECT compression FROM pages WHERE key = ?", (key,)
+            ).fetchone()
+        if not row:
+            return None
+
+        (compression,) = row
+        try:
+            content = read_entry(self.root, key, compression)
+        except (OSError, ValueError, EOFError) as e:
+            # The file is gone or corrupt, drop the entry so it gets refetched
+            print(f"Cache entry error {url}: {repr(e)}")
+            with self.lock:
+                self.__delete(key, compression)
+                self.db.commit()
+            return None
+
+        with self.lock:
+            self.db.execute(
+                "UPDATE pages SET last_access = ? WHERE key = ?", (time.time(), key)
+            )
+            self.db.commit()
+        return content
+
+    def put(self, url: str, content: str, status: int = 200) -> None:
+        key = self.key_for(url)
+        data = self.__compress(content)
+
+        file_path = self.__path_for(key, self.compression)
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+        # Write to a temporary file first so readers never see a partial entry
+        tmp_path = file_path.with_name(file_path.name + ".tmp")
+        tmp_path.write_bytes(data)
+        tmp_path.replace(file_path)
+
+        with self.lock:
+            previous = self.db.execute(
+                "SELECT size, compression FROM pages WHERE key = ?", (key,)
+            ).fetchone()
+            if previous:
+                size, compression = previous
+                self.total_size -= size
+                if compression != self.compression:
+                    self.__path_for(key, compression).unlink(missing_ok=True)
+
+            now = time.time()
+            self.db.execute(
+                """
+                INSERT OR REPLACE INTO pages
+                    (key, url, fetched_at, last_access, status, size, compression)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                """,
+                (key, url, now, now, status, len(data), self.compression),
+            )
+            self.total_size += len(data)
+
+            if self.total_size > self.config.cache_max_bytes:
+                self.__evict()
+            self.db.commit()
+
+    def get_negative(self, url: str) -> Optional[str]:
+        """The outcome class recorded for a url that did not yield reviews, if still fresh"""
+        key = self.key_for(url)
+        with self.lock:
+            row = self.db.execute(
+                "SELECT outcome, expires_at FROM negatives WHERE key = ?", (key,)
+            ).fetchone()
+        if not row:
+            return None
+
+        outcome, expires_at = row
+        if expires_at <= time.time():
+            self.delete_negative(url)
+            return None
+        return outcome
+
+    def put_negative(self, url: str, outcome: str, ttl: float) -> None:
+        now = time.time()
+        with self.lock:
+            self.db.execute(
+                """
+                INSERT OR REPLACE INTO negatives
+                    (key, url, outcome, fetched_at, expires_at)
+                VALUES (?, ?, ?, ?, ?)
+                """,
+                (self.key_for(url), url, outcome, now, now + ttl),
+            )
+            self.db.commit()
+
+    def delete_negative(self, url: str) -> None:
+        with self.lock:
+            self.db.execute("DELETE FROM negatives WHERE key = ?", (self.key_for(url),))
+            self.db.commit()
+
+    def __delete(self, key: str, compression: str) -> None:
+        row = self.db.execute("SELECT size FROM pages WHERE key = ?", (key,)).fetchone()
+        if row:
+            self.total_size -= row[0]
+        self.db.execute("DELETE FROM pages WHERE key = ?", (key,))
+        self.__path_for(key, compression).unlink(missing_ok=True)
+
+    def evict(self) -> None:
+        """Drop least recently used entries until the cache is 90% of its budget"""
+        with self.lock:
+            self.__evict()
+
+    def __evict(self) -> None:
+        self.db.execute("DELETE FROM negatives WHERE expires_at <= ?", (time.time(),))
+        target_size = self.config.cache_max_bytes * 0.9
+        while self.total_size > target_size:
+            rows = self.db.execute(
+                "SELECT key, compression FROM pages ORDER BY last_access LIMIT 1000"
+            ).fetchall()
+            if not rows:
+                break
+            for key, compression in rows:
+                self.__delete(key, compression)
+                if self.total_size <= target_size:
+                    break
+        self.db.commit()
+
+    def entries(self) -> Iterator[Tuple[str, str, Optional[str], Optional[str]]]:
+        """
+        Every cached page and negative outcome ordered by url, as
+        (url, key, compression, outcome) with outcome None for pages.
+        Expired negatives are included, they still tell which pages failed.
+        """
+        yield from self.db.execute("""
+            SELECT url, key, compression, NULL FROM pages
+            UNION ALL
+            SELECT url, key, NULL, outcome FROM negatives
+            ORDER BY url
+            """)
+
+    def close(self) -> None:
+        with self.lock:
+            self.db.commit()
+            self.db.close()
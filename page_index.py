@@ -0,0 +1,251 @@
+"""
+Single pass data-hook index over a review page.
+
+Instead of one `find` per field, the document is walked once and every
+element the extraction needs is filed under its tag and `data-hook`, per
+review and for the whole page. The walk runs on whichever html backend is
+installed, fastest first: selectolax (lexbor), lxml, then BeautifulSoup's
+html.parser.
+"""
+
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Tuple
+
+from bs4 import BeautifulSoup, Tag
+
+try:
+    from selectolax.lexbor import LexborHTMLParser
+except ImportError:
+    LexborHTMLParser = None
+
+try:
+    import lxml.html
+except ImportError:
+    lxml = None
+
+
+class SoupBackend:
+    name = "html.parser"
+
+    def parse(self, html: str):
+        return BeautifulSoup(html, "html.parser")
+
+    def children(self, node) -> list:
+        return [child for child in node.children if isinstance(child, Tag)]
+
+    def tag(self, node) -> str:
+        return node.name
+
+    def attrs(self, node) -> dict:
+        return node.attrs
+
+    def text(self, node) -> str:
+        return node.get_text()
+
+    def parent(self, node):
+        parent = node.parent
+        return parent if isinstance(parent, Tag) else None
+
+    def has_text(self, root, text: str) -> bool:
+        return root.find(string=text) is not None
+
+
+class LxmlBackend:
+    name = "lxml"
+
+    def parse(self, html: str):
+        try:
+            return lxml.html.document_fromstring(html)
+        except ValueError:
+            # Strings with an xml encoding declaration have to go in as bytes
+            return lxml.html.document_fromstring(html.encode())
+
+    def children(self, node) -> list:
+        # Comments and processing instructions have a function as their tag
+        return [child for child in node if isinstance(child.tag, str)]
+
+    def tag(self, node) -> str:
+        return node.tag
+
+    def attrs(self, node) -> dict:
+        return node.attrib
+
+    def text(self, node) -> str:
+        return "".join(node.itertext())
+
+    def parent(self, node):
+        return node.getparent()
+
+    def has_text(self, root, text: str) -> bool:
+        return bool(root.xpath("//text()[. = $text]", text=text))
+
+
+class SelectolaxBackend:
+    name = "selectolax"
+
+    def parse(self, html: str):
+        return LexborHTMLParser(html).root
+
+    def children(self, node) -> list:
+        return [child for child in node.iter() if not child.tag.startswith("-")]
+
+    def tag(self, node) -> str:
+        return node.tag
+
+    def attrs(self, node) -> dict:
+        return node.attributes
+
+    def text(self, node) -> str:
+        return node.text(deep=True)
+
+    def parent(self, node):
+        parent = node.parent
+        if parent is None or parent.tag.startswith("-"):
+            return None
+        return parent
+
+    def has_text(self, root, text: str) -> bool:
+        return any(
+            node.tag == "-text" and node.text(deep=False) == text
+            for node in root.traverse(include_text=True)
+        )
+
+
+BACKENDS = {
+    "selectolax": (SelectolaxBackend, LexborHTMLParser is not None),
+    "lxml": (LxmlBackend, lxml is not None),
+    "html.parser": (SoupBackend, True),
+}
+
+
+def available_backends() -> List[str]:
+    return [name for name, (_, available) in BACKENDS.items() if available]
+
+
+def get_backend(name: Optional[str] = None):
+    """The named backend, or the fastest installed one for None"""
+    name = name or available_backends()[0]
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown parser backend: {name}")
+    backend_class, available = BACKENDS[name]
+    if not available:
+        raise ValueError(f"Parser backend {name} is not installed")
+    return backend_class()
+
+
+def class_list(value) -> List[str]:
+    if not value:
+        return []
+    # BeautifulSoup already splits the class attribute
+    return value if isinstance(value, list) else value.split()
+
+
+HookKey = Tuple[str, str]
+
+
+@dataclass
+class ReviewIndex:
+    node: object
+    id: Optional[str]
+    # Left out of the walk, the parser already knows this review
+    skipped: bool = False
+    hooks: Dict[HookKey, list] = field(default_factory=dict)
+    profile_names: list = field(default_factory=list)
+    # data-video-url of the video blocks inside the review body
+    video_urls: List[str] = field(default_factory=list)
+
+    def first(self, tag: str, hook: str):
+        elements = self.hooks.get((tag, hook))
+        return elements[0] if elements else None
+
+    def all(self, tag: str, hook: str) -> list:
+        return self.hooks.get((tag, hook), [])
+
+
+@dataclass
+class PageIndex:
+    hooks: Dict[HookKey, list] = field(default_factory=dict)
+    reviews: List[ReviewIndex] = field(default_factory=list)
+    histogram_labels: List[str] = field(default_factory=list)
+    has_sign_in: bool = False
+
+    def first(self, tag: str, hook: str):
+        elements = self.hooks.get((tag, hook))
+        return elements[0] if elements else None
+
+
+def build_index(
+    backend, root, skip_review: Optional[Callable[[str], bool]] = None
+) -> PageIndex:
+    """
+    Walk the document once, in document order, filing every element with a
+    data-hook under (tag, hook) for the page and for the review it sits in.
+    Reviews for which `skip_review` returns True are counted but not walked.
+    """
+    page = PageIndex()
+    # (node, review it belongs to, inside the review body, inside the histogram)
+    stack = [(root, None, False, False)]
+    while stack:
+        node, review, in_body, in_histogram = stack.pop()
+        tag = backend.tag(node)
+        attrs = backend.attrs(node)
+
+        hook = attrs.get("data-hook")
+        if hook:
+            key = (tag, hook)
+            page.hooks.setdefault(key, []).append(node)
+            if key == ("div", "review"):
+                review = ReviewIndex(node=node, id=attrs.get("id"))
+                page.reviews.append(review)
+                if review.id and skip_review and skip_review(review.id):
+                    review.skipped = True
+                    continue
+            elif review is not None:
+                review.hooks.setdefault(key, []).append(node)
+                if key == ("span", "review-body"):
+                    in_body = True
+
+        if review is not None:
+            if tag == "span" and "a-profile-name" in class_list(attrs.get("class")):
+                review.profile_names.append(node)
+            if (
+                in_body
+                and tag == "div"
+                and review.id
+                and attrs.get("data-review-id") == review.id
+            ):
+                video_url = attrs.get("data-video-url")
+                if video_url:
+                    review.video_urls.append(video_url)
+
+        if attrs.get("id") == "histogramTable":
+            in_histogram = True
+        elif in_histogram and attrs.get("aria-label"):
+            page.histogram_labels.append(attrs["aria-label"])
+
+        if attrs.get("name") == "signIn":
+            page.has_sign_in = True
+
+        # Reversed so the next pop is the first child, keeping document order
+        for child in reversed(backend.children(node)):
+            stack.append((child, review, in_body, in_histogram))
+    return page
+
+
+def find_descendants(backend, node, tag: str) -> list:
+    """Descendants with the given tag in document order, for small subtrees"""
+    found = []
+    stack = list(reversed(backend.children(node)))
+    while stack:
+        child = stack.pop()
+        if backend.tag(child) == tag:
+            found.append(child)
+        stack.extend(reversed(backend.children(child)))
+    return found
+
+
+def find_parent(backend, node, tag: str):
+    parent = backend.parent(node)
+    while parent is not None and backend.tag(parent) != tag:
+        parent = backend.parent(parent)
+    return parent
@@ -0,0 +1,266 @@
+import asyncio
+import time
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from enum import Enum
+from typing import Dict, List, Optional
+
+from amazon_review import AmazonReview
+from marketplace import DEFAULT_MARKETPLACE
+from metrics import METRICS
+from page_index import (
+    PageIndex,
+    ReviewIndex,
+    build_index,
+    find_descendants,
+    find_parent,
+    get_backend,
+)
+from review_store import SeenReviewStore
+from helpers import (
+    extract_float_from_phrase,
+    extract_integer,
+    parse_review_date_and_country,
+    parse_reviews_count,
+    parse_star_percentage,
+)
+from scraping_config import ScrapingConfig
+
+
+class PageOutcome(Enum):
+    OK = "ok"
+    NO_REVIEWS = "no_reviews"
+    CAPTCHA = "captcha"
+    LOGIN = "login"
+    NOT_FOUND = "not_found"
+    FAILED = "failed"
+
+
+@dataclass
+class ParsedPage:
+    """Everything the crawler needs from one review page"""
+
+    outcome: PageOutcome
+    product_name: str = ""
+    overall_rating: Optional[float] = None
+    total_rating_count: Optional[int] = None
+    total_reviews_count: Optional[int] = None
+    # Histogram percentage keyed by star count
+    star_percentages: Dict[int, int] = field(default_factory=dict)
+    reviews: List[AmazonReview] = field(default_factory=list)
+    # Number of review blocks on the page, including ones that failed to parse
+    review_count: int = 0
+    # CPU seconds the worker spent parsing the page
+    parse_seconds: float = 0.0
+
+
+# Reviews recorded by earlier runs per marketplace, loaded once per parser worker
+_seen_reviews: Dict[str, SeenReviewStore] = {}
+_backend = get_backend()
+
+CAPTCHA_TEXT = "Enter the characters you see below"
+NO_REVIEWS_TEXT = "Sorry, no reviews match your current selections."
+# Raw bytes that give a block page away before the body is complete
+BLOCK_MARKERS = {
+    PageOutcome.CAPTCHA: CAPTCHA_TEXT.encode(),
+    PageOutcome.LOGIN: b'name="signIn"',
+}
+
+
+def init_parser_worker(config: ScrapingConfig) -> None:
+    global _seen_reviews, _backend
+    _backend = get_backend(config.parser_backend)
+    if config.skip_seen_reviews:
+        _seen_reviews = {
+            marketplace: SeenReviewStore(config=config, marketplace=marketplace)
+            for marketplace in config.marketplaces
+        }
+
+
+def _is_seen(marketplace: str, review_id: str) -> bool:
+    seen_reviews = _seen_reviews.get(marketplace)
+    return seen_reviews is not None and review_id in seen_reviews
+
+
+def text_of(element) -> str:
+    return _backend.text(element) if element is not None else ""
+
+
+def parse_review(review_index: ReviewIndex) -> Optional[AmazonReview]:
+    """Fill a review from the elements indexed for it"""
+    try:
+        review = AmazonReview()
+
+        # Get review ID
+        review.id = review_index.id
+        if not review.id:
+            return None
+
+        # Get review title and rating
+        rating_element = review_index.first("i", "review-star-rating")
+        if rating_element is None:
+            rating_element = review_index.first("i", "cmps-review-star-rating")
+        if rating_element is not None:
+            review.rating = extract_float_from_phrase(text_of(rating_element))
+
+        # Get title
+        title_element = review_index.first("a", "review-title")
+        if title_element is None:
+            title_element = review_index.first("span", "review-title")
+        if title_element is not None:
+            review.href = _backend.attrs(title_element).get("href")
+            if review.href:
+                spans = find_descendants(_backend, title_element, "span")
+                if spans and len(spans) >= 3:
+                    review.title = text_of(spans[2]).strip()
+            else:
+                review.title = text_of(title_element).strip()
+
+        # Get review date and country
+        date_element = review_index.first("span", "review-date")
+        if date_element is not None:
+            date_info = parse_review_date_and_country(text_of(date_element))
+            if date_info:
+                review.country = date_info["country"]
+                review.date = date_info["date"]
+
+        # Get review body
+        body_element = review_index.first("span", "review-body")
+        if body_element is not None:
+            review.body = text_of(body_element).strip()
+
+        # Check if verified purchase
+        review.verified_purchase = review_index.first("span", "avp-badge") is not None
+
+        # Get helpful votes
+        helpful_element = review_index.first("span", "helpful-vote-statement")
+        if helpful_element is not None:
+            text = text_of(helpful_element)
+            if "One" in text:
+                review.found_helpful = 1
+            else:
+                review.found_helpful = extract_integer(text) or 0
+
+        # Get username
+        if review_index.profile_names:
+            username_element = review_index.profile_names[0]
+            review.username = text_of(username_element)
+            username_url = find_parent(_backend, username_element, "a")
+            if username_url is not None:
+                review.username_url = _backend.attrs(username_url).get("href")
+
+        # Get images, including the ones of reviews from other countries
+        for hook in ["review-image-tile", "cmps-review-image-tile"]:
+            for element in review_index.all("img", hook):
+                src = _backend.attrs(element).get("src")
+                if src:
+                    review.images.append(src)
+
+        # Get videos
+        review.videos.extend(review_index.video_urls)
+
+        return review
+
+    except Exception as e:
+        print(f"Error parsing review: {e}")
+        return None
+
+
+def classify_page(html: str, root, index: PageIndex) -> PageOutcome:
+    # The substring checks only decide whether the exact text search is needed
+    if CAPTCHA_TEXT in html and _backend.has_text(root, CAPTCHA_TEXT):
+        return PageOutcome.CAPTCHA
+    if index.has_sign_in:
+        return PageOutcome.LOGIN
+    if NO_REVIEWS_TEXT in html and _backend.has_text(root, NO_REVIEWS_TEXT):
+        return PageOutcome.NO_REVIEWS
+    return PageOutcome.OK
+
+
+def parse_page(html: str, marketplace: str = DEFAULT_MARKETPLACE) -> ParsedPage:
+    """
+    Classify and extract a review page from a single parse of the document.
+    Runs inside the parser worker processes, so it must stay a module level function.
+    """
+    start_time = time.process_time()
+    page = extract_page(html, marketplace)
+    page.parse_seconds = time.process_time() - start_time
+    return page
+
+
+def extract_page(html: str, marketplace: str = DEFAULT_MARKETPLACE) -> ParsedPage:
+    root = _backend.parse(html)
+    # Skip reviews we already recorded before doing the full parse
+    index = build_index(_backend, root, skip_review=partial(_is_seen, marketplace))
+
+    outcome = classify_page(html, root, index)
+    page = ParsedPage(outcome=outcome)
+    if outcome != PageOutcome.OK:
+        return page
+
+    product_element = index.first("a", "product-link")
+    if product_element is not None:
+        page.product_name = text_of(product_element).strip()
+
+    rating_element = index.first("span", "rating-out-of-text")
+    if rating_element is not None:
+        page.overall_rating = extract_float_from_phrase(text_of(rating_element))
+
+    rating_count_element = index.first("div", "total-review-count")
+    if rating_count_element is not None:
+        page.total_rating_count = extract_integer(text_of(rating_count_element))
+
+    total_reviews_count_element = index.first(
+        "div", "cr-filter-info-review-rating-count"
+    )
+    if total_reviews_count_element is not None:
+        page.total_reviews_count = parse_reviews_count(
+            text_of(total_reviews_count_element)
+        )
+
+    for label in index.histogram_labels:
+        star_percentage = parse_star_percentage(label)
+        if star_percentage:
+            star, percentage = star_percentage
+            page.star_percentages[star] = percentage
+
+    page.review_count = len(index.reviews)
+    for review_index in index.reviews:
+        if review_index.skipped:
+            continue
+        review = parse_review(review_index)
+        if review:
+            page.reviews.append(review)
+
+    return page
+
+
+class PageParser:
+    """
+    Parses pages in a pool of worker processes so the event loop only ever
+    waits on the network. Workers hand back small ParsedPage results.
+    """
+
+    def __init__(self, config: Optional[ScrapingConfig] = None):
+        self.config = config or ScrapingConfig()
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.config.max_workers,
+            initializer=init_parser_worker,
+            initargs=(self.config,),
+        )
+
+    async def parse(
+        self, html: str, marketplace: str = DEFAULT_MARKETPLACE
+    ) -> ParsedPage:
+        loop = asyncio.get_running_loop()
+        # Wall time includes waiting for a free worker, parse_seconds does not
+        async with METRICS.async_timer("parse_wall_seconds"):
+            page = await loop.run_in_executor(
+                self.executor, parse_page, html, marketplace
+            )
+        METRICS.observe("parse_cpu_seconds", page.parse_seconds)
+        return page
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=True, cancel_futures=True)
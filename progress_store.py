@@ -0,0 +1,259 @@
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+
+import pandas as pd
+
+from marketplace import DEFAULT_MARKETPLACE
+from scraping_config import ScrapingConfig
+
+STATUS_COMPLETE = "complete"
+STATUS_FAILED = "failed"
+
+PROGRESS_TABLE = """
+CREATE TABLE IF NOT EXISTS progress (
+    asin TEXT NOT NULL,
+    marketplace TEXT NOT NULL,
+    status TEXT NOT NULL,
+    review_count INTEGER NOT NULL,
+    failed_url_count INTEGER NOT NULL,
+    attempts INTEGER NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (asin, marketplace)
+)
+"""
+# Newest review kept by every most recent first branch crawled
+WATERMARK_TABLE = """
+CREATE TABLE IF NOT EXISTS watermarks (
+    asin TEXT NOT NULL,
+    marketplace TEXT NOT NULL,
+    branch TEXT NOT NULL,
+    review_id TEXT NOT NULL,
+    review_date TEXT,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (asin, marketplace, branch)
+)
+"""
+
+# Branch key -> (review id, review date)
+Watermarks = Dict[str, Tuple[str, Optional[datetime]]]
+
+
+class ProgressStore:
+    """
+    Crash safe per ASIN progress journal.
+
+    Every finished ASIN is a single upsert into an SQLite table in WAL mode,
+    instead of rewriting the whole extract_reviews DataFrame. The DataFrame
+    is only rebuilt from the journal when `compact_into` is called.
+    """
+
+    def __init__(self, config: Optional[ScrapingConfig] = None):
+        self.config = config or ScrapingConfig()
+        path = Path(self.config.progress_db_path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        # Updates come from the background writer thread
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.__migrate()
+        self.db.execute(PROGRESS_TABLE)
+        self.db.execute(WATERMARK_TABLE)
+        self.db.commit()
+
+    def __migrate(self) -> None:
+        """Journals from before marketplaces were keyed on the ASIN alone"""
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(progress)")]
+        if not columns or "marketplace" in columns:
+            return
+        with self.db:
+            self.db.execute("ALTER TABLE progress RENAME TO progress_asin")
+            self.db.execute(PROGRESS_TABLE)
+            self.db.execute(
+                """
+                INSERT INTO progress
+                SELECT asin, ?, status, review_count, failed_url_count, attempts,
+                    updated_at
+                FROM progress_asin
+                """,
+                (DEFAULT_MARKETPLACE,),
+            )
+            self.db.execute("DROP TABLE progress_asin")
+
+    def __record(
+        self,
+        asin: str,
+        marketplace: str,
+        status: str,
+        review_count: int,
+        failed_url_count: int,
+        add_reviews: bool = False,
+    ) -> None:
+        with self.lock:
+            self.db.execute(
+                """
+                INSERT INTO progress (asin, marketplace, status, review_count,
+                    failed_url_count, attempts, updated_at)
+                VALUES (?, ?, ?, ?, ?, 1, ?)
+                ON CONFLICT (asin, marketplace) DO UPDATE SET
+                    status = excluded.status,
+                    review_count = excluded.review_count
+                        + CASE WHEN ? THEN progress.review_count ELSE 0 END,
+                    failed_url_count = excluded.failed_url_count,
+                    attempts = progress.attempts + 1,
+                    updated_at = excluded.updated_at
+                """,
+                (
+                    asin,
+                    marketplace,
+                    status,
+                    review_count,
+                    failed_url_count,
+                    time.time(),
+                    add_reviews,
+                ),
+            )
+            self.db.commit()
+
+    def mark_complete(
+        self,
+        asin: str,
+        review_count: int,
+        failed_url_count: int = 0,
+        marketplace: str = DEFAULT_MARKETPLACE,
+    ) -> None:
+        self.__record(
+            asin, marketplace, STATUS_COMPLETE, review_count, failed_url_count
+        )
+
+    def mark_refreshed(
+        self,
+        asin: str,
+        new_review_count: int,
+        failed_url_count: int = 0,
+        marketplace: str = DEFAULT_MARKETPLACE,
+    ) -> None:
+        """Complete a refresh that only wrote the new reviews, on top of the earlier count"""
+        self.__record(
+            asin,
+            marketplace,
+            STATUS_COMPLETE,
+            new_review_count,
+            failed_url_count,
+            add_reviews=True,
+        )
+
+    def mark_failed(
+        self,
+        asin: str,
+        review_count: int = 0,
+        failed_url_count: int = 0,
+        marketplace: str = DEFAULT_MARKETPLACE,
+    ) -> None:
+        self.__record(asin, marketplace, STATUS_FAILED, review_count, failed_url_count)
+
+    def record_watermarks(
+        self, asin: str, marketplace: str, watermarks: Watermarks
+    ) -> None:
+        """Move the newest known review of the given branches forward"""
+        now = time.time()
+        with self.lock:
+            self.db.executemany(
+                """
+                INSERT INTO watermarks
+                    (asin, marketplace, branch, review_id, review_date, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (asin, marketplace, branch) DO UPDATE SET
+                    review_id = excluded.review_id,
+                    review_date = excluded.review_date,
+                    updated_at = excluded.updated_at
+                """,
+                [
+                    (
+                        asin,
+                        marketplace,
+                        branch,
+                        review_id,
+                        review_date.isoformat() if review_date else None,
+                        now,
+                    )
+                    for branch, (review_id, review_date) in watermarks.items()
+                ],
+            )
+            self.db.commit()
+
+    def watermarks(self, asin: str, marketplace: str) -> Watermarks:
+        with self.lock:
+            rows = self.db.execute(
+                """
+                SELECT branch, review_id, review_date FROM watermarks
+                WHERE asin = ? AND marketplace = ?
+                """,
+                (asin, marketplace),
+            ).fetchall()
+        return {
+            branch: (
+                review_id,
+                datetime.fromisoformat(review_date) if review_date else None,
+            )
+            for branch, review_id, review_date in rows
+        }
+
+    def review_count(self, asin: str, marketplace: str) -> Optional[int]:
+        """Reviews recorded for a completed ASIN, refreshes add theirs, if any"""
+        with self.lock:
+            row = self.db.execute(
+                """
+                SELECT review_count FROM progress
+                WHERE asin = ? AND marketplace = ? AND status = ?
+                """,
+                (asin, marketplace, STATUS_COMPLETE),
+            ).fetchone()
+        return row[0] if row else None
+
+    def completed_asins(self, marketplaces: Optional[List[str]] = None) -> Set[str]:
+        """ASINs that completed in every one of the marketplaces"""
+        marketplaces = marketplaces or [DEFAULT_MARKETPLACE]
+        placeholders = ", ".join("?" for _ in marketplaces)
+        with self.lock:
+            rows = self.db.execute(
+                f"""
+                SELECT asin FROM progress
+                WHERE status = ? AND marketplace IN ({placeholders})
+                GROUP BY asin HAVING COUNT(*) = ?
+                """,
+                (STATUS_COMPLETE, *marketplaces, len(set(marketplaces))),
+            ).fetchall()
+        return {asin for (asin,) in rows}
+
+    def compact_into(
+        self,
+        df: pd.DataFrame,
+        pickle_path: str = "./data/pfw/04_extract_reviews.pkl",
+        csv_path: str = "./data/pfw/04_extract_reviews.csv",
+        marketplaces: Optional[List[str]] = None,
+    ) -> pd.DataFrame:
+        """Mark ASINs completed in every marketplace in the DataFrame and save it atomically"""
+        completed = self.completed_asins(marketplaces)
+        df.loc[df["asin"].isin(completed), "review_complete"] = 1
+
+        # Write next to the target first so a crash never leaves half a file
+        for path, write in (
+            (pickle_path, df.to_pickle),
+            (csv_path, df.to_csv),
+        ):
+            tmp_path = f"{path}.tmp"
+            write(tmp_path)
+            os.replace(tmp_path, path)
+        print(f"Compacted {len(completed)} completed ASINs into {pickle_path}")
+        return df
+
+    def close(self) -> None:
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,204 @@
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Dict, Optional
+from urllib.parse import urlparse
+
+from metrics import METRICS
+from scraping_config import ScrapingConfig
+
+# Fields of HostGovernor.snapshot exported as governor_<field>{host=...} gauges
+GAUGE_FIELDS = ("concurrency_limit", "in_flight", "rate", "block_rate", "error_rate")
+
+
+class TokenBucket:
+    """Requests per second limit that allows short bursts"""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    async def acquire(self) -> None:
+        while True:
+            now = time.monotonic()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class AdaptiveLimiter:
+    """Semaphore whose limit can be moved while requests are in flight"""
+
+    def __init__(self, limit: float):
+        self.limit = limit
+        self.in_flight = 0
+        self.condition = asyncio.Condition()
+
+    async def acquire(self) -> None:
+        async with self.condition:
+            await self.condition.wait_for(
+                lambda: self.in_flight < max(1, int(self.limit))
+            )
+            self.in_flight += 1
+
+    async def release(self) -> None:
+        async with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+
+class HostGovernor:
+    """
+    Rate and concurrency limits for a single host, adjusted AIMD style.
+
+    Every clean response adds a little to the concurrency limit and the
+    request rate. Once blocks (captcha, login, 403) or server errors make up
+    more than `governor_block_threshold` of the recent responses, both limits
+    are cut by `governor_decrease_factor`, at most once per cooldown period.
+    """
+
+    def __init__(self, config: ScrapingConfig):
+        self.config = config
+        self.bucket = TokenBucket(
+            rate=config.governor_initial_rate, burst=config.governor_burst
+        )
+        self.limiter = AdaptiveLimiter(limit=config.governor_initial_concurrency)
+        # (blocked, server_error) of the most recent responses
+        self.outcomes = deque(maxlen=config.governor_window)
+        self.last_decrease = 0.0
+        self.last_trouble = 0.0
+        self.requests = 0
+        self.blocks = 0
+        self.server_errors = 0
+
+    @property
+    def block_rate(self) -> float:
+        if not self.outcomes:
+            return 0.0
+        return sum(blocked for blocked, _ in self.outcomes) / len(self.outcomes)
+
+    @property
+    def error_rate(self) -> float:
+        if not self.outcomes:
+            return 0.0
+        return sum(error for _, error in self.outcomes) / len(self.outcomes)
+
+    async def acquire(self) -> None:
+        await self.limiter.acquire()
+        await self.bucket.acquire()
+
+    async def release(self) -> None:
+        await self.limiter.release()
+
+    def record(self, blocked: bool = False, server_error: bool = False) -> None:
+        self.requests += 1
+        self.blocks += blocked
+        self.server_errors += server_error
+        self.outcomes.append((blocked, server_error))
+
+        if not blocked and not server_error:
+            self.__increase()
+            return
+
+        now = time.monotonic()
+        self.last_trouble = now
+        over_threshold = (
+            self.block_rate + self.error_rate >= self.config.governor_block_threshold
+        )
+        if over_threshold and now - self.last_decrease >= self.config.governor_cooldown:
+            self.last_decrease = now
+            self.__decrease()
+
+    def is_calm(self, quiet_period: float) -> bool:
+        """Whether blocks are back under the threshold or have stopped for a while"""
+        if self.block_rate + self.error_rate < self.config.governor_block_threshold:
+            return True
+        return time.monotonic() - self.last_trouble >= quiet_period
+
+    def __increase(self) -> None:
+        config = self.config
+        limit = self.limiter.limit
+        # Roughly one extra slot for every `limit` clean responses
+        self.limiter.limit = min(
+            config.max_concurrent_requests, limit + 1 / max(limit, 1)
+        )
+        self.bucket.rate = min(
+            config.governor_max_rate, self.bucket.rate + config.governor_rate_increase
+        )
+
+    def __decrease(self) -> None:
+        config = self.config
+        self.limiter.limit = max(
+            config.governor_min_concurrency,
+            self.limiter.limit * config.governor_decrease_factor,
+        )
+        self.bucket.rate = max(
+            config.governor_min_rate,
+            self.bucket.rate * config.governor_decrease_factor,
+        )
+        print(
+            f"Backing off: concurrency {self.limiter.limit:.1f}, "
+            f"rate {self.bucket.rate:.2f}/s, block rate {self.block_rate:.0%}, "
+            f"error rate {self.error_rate:.0%}"
+        )
+
+    def snapshot(self) -> Dict:
+        return {
+            "concurrency_limit": self.limiter.limit,
+            "in_flight": self.limiter.in_flight,
+            "rate": self.bucket.rate,
+            "block_rate": self.block_rate,
+            "error_rate": self.error_rate,
+            "requests": self.requests,
+            "blocks": self.blocks,
+            "server_errors": self.server_errors,
+        }
+
+
+class RequestGovernor:
+    """Hands out request slots per host and adapts their limits to block signals"""
+
+    def __init__(self, config: Optional[ScrapingConfig] = None):
+        self.config = config or ScrapingConfig()
+        self.hosts: Dict[str, HostGovernor] = {}
+
+    def for_host(self, url: str) -> HostGovernor:
+        host = urlparse(url).netloc
+        if host not in self.hosts:
+            self.hosts[host] = HostGovernor(self.config)
+        return self.hosts[host]
+
+    @asynccontextmanager
+    async def slot(self, url: str):
+        governor = self.for_host(url)
+        async with METRICS.async_timer("governor_wait_seconds"):
+            await governor.acquire()
+        self.__export(url)
+        try:
+            yield governor
+        finally:
+            await governor.release()
+            self.__export(url)
+
+    def record(self, url: str, blocked: bool = False, server_error: bool = False):
+        self.for_host(url).record(blocked=blocked, server_error=server_error)
+        self.__export(url)
+
+    def __export(self, url: str) -> None:
+        """Publish the limits of the url's host, for the metrics log and /metrics"""
+        host = urlparse(url).netloc
+        snapshot = self.for_host(url).snapshot()
+        for name in GAUGE_FIELDS:
+            METRICS.gauge(f"governor_{name}", snapshot[name], host=host)
+
+    def snapshot(self) -> Dict[str, Dict]:
+        """Current limits and recent block rate of every host"""
+        return {host: governor.snapshot() for host, governor in self.hosts.items()}
@@ -0,0 +1,211 @@
+import math
+from dataclasses import dataclass, replace
+from typing import Dict, List, Optional
+
+from helpers import (
+    ALL_STARS,
+    AMAZON_BASE_URL,
+    AmazonFilterFormatType,
+    AmazonFilterMediaType,
+    AmazonFilterSortBy,
+    AmazonFilterStarRating,
+    FOUND_UNDER_PAGE_SLOTS,
+    STAR_RATING_VALUES,
+    build_review_url,
+    encode_found_under,
+)
+from scraping_config import ScrapingConfig
+
+
+@dataclass(frozen=True)
+class FilterPlan:
+    sort_by: AmazonFilterSortBy
+    # None means the page is not filtered on the star rating
+    star_rating: Optional[AmazonFilterStarRating]
+    format_type: AmazonFilterFormatType
+    media_type: AmazonFilterMediaType
+    max_pages: int
+    base_url: str = AMAZON_BASE_URL
+
+    def url(self, asin: str, page_number: int) -> str:
+        return build_review_url(
+            asin,
+            self.sort_by,
+            self.star_rating,
+            self.format_type,
+            self.media_type,
+            page_number,
+            self.base_url,
+        )
+
+    def found_under_bit(self, page_number: int) -> int:
+        return encode_found_under(
+            self.sort_by,
+            self.star_rating,
+            self.format_type,
+            self.media_type,
+            page_number,
+        )
+
+    @property
+    def branch_key(self) -> str:
+        """Identifies the filter combination regardless of depth and store"""
+        star_rating = self.star_rating.value if self.star_rating else ALL_STARS
+        return ":".join(
+            [
+                self.sort_by.value,
+                star_rating,
+                self.format_type.value,
+                self.media_type.value,
+            ]
+        )
+
+    def same_filter(self, other: "FilterPlan") -> bool:
+        return (
+            self.sort_by == other.sort_by
+            and self.star_rating == other.star_rating
+            and self.format_type == other.format_type
+            and self.media_type == other.media_type
+        )
+
+
+class RequestPlanner:
+    """
+    Chooses which filter combinations and page depths to crawl for a product
+    based on the counts exposed on its first review page.
+
+    Amazon only serves `max_pages` pages per filter combination, so a filter
+    can expose at most `max_pages * reviews_per_page` reviews. Products that fit
+    inside that window need a single unfiltered branch. Larger products are
+    split per star rating, and only star ratings that still overflow the window
+    fall back to every sort order and format.
+    """
+
+    def __init__(
+        self, config: Optional[ScrapingConfig] = None, base_url: str = AMAZON_BASE_URL
+    ):
+        self.config = config or ScrapingConfig()
+        # Fail at startup rather than on the first review of a deep page
+        if not 1 <= self.config.max_pages <= FOUND_UNDER_PAGE_SLOTS:
+            raise ValueError(
+                f"max_pages must be between 1 and {FOUND_UNDER_PAGE_SLOTS}, "
+                f"got {self.config.max_pages}"
+            )
+        # Every plan points at the review pages of this marketplace
+        self.base_url = base_url
+
+    @property
+    def page_capacity(self) -> int:
+        return self.config.max_pages * self.config.reviews_per_page
+
+    def probe(self) -> FilterPlan:
+        """The filter combination used for the first page of every product"""
+        return FilterPlan(
+            sort_by=AmazonFilterSortBy.RECENT,
+            star_rating=None,
+            format_type=AmazonFilterFormatType.ALL_FORMATS,
+            media_type=AmazonFilterMediaType.ALL_CONTENTS,
+            max_pages=1,
+            base_url=self.base_url,
+        )
+
+    def full_matrix(self) -> List[FilterPlan]:
+        """Every filter combination at full depth"""
+        return [
+            FilterPlan(
+                sort_by=sort_by,
+                star_rating=star_rating,
+                format_type=format_type,
+                media_type=media_type,
+                max_pages=self.config.max_pages,
+                base_url=self.base_url,
+            )
+            for sort_by in AmazonFilterSortBy
+            for star_rating in AmazonFilterStarRating
+            for format_type in AmazonFilterFormatType
+            for media_type in AmazonFilterMediaType
+        ]
+
+    def refresh_branches(self) -> List[FilterPlan]:
+        """Every most recent first filter combination at full depth, unfiltered first"""
+        unfiltered = replace(self.probe(), max_pages=self.config.max_pages)
+        return [unfiltered] + [
+            plan
+            for plan in self.full_matrix()
+            if plan.sort_by == AmazonFilterSortBy.RECENT
+        ]
+
+    def __pages_for(self, review_count: int) -> int:
+        pages = math.ceil(review_count / self.config.reviews_per_page)
+        return max(1, min(pages, self.config.max_pages))
+
+    def plan(
+        self,
+        total_reviews_count: int,
+        star_percentages: Dict[int, int],
+    ) -> List[FilterPlan]:
+        """
+        Args:
+            total_reviews_count (int): Number of reviews with text on the probe page.
+            star_percentages (Dict[int, int]): Histogram percentage keyed by star count.
+
+        Returns:
+            List[FilterPlan]: The smallest set of branches that reaches every reachable review.
+        """
+        if total_reviews_count <= 0:
+            return []
+
+        probe = self.probe()
+        if total_reviews_count <= self.page_capacity:
+            return [
+                FilterPlan(
+                    sort_by=probe.sort_by,
+                    star_rating=None,
+                    format_type=probe.format_type,
+                    media_type=probe.media_type,
+                    max_pages=self.__pages_for(total_reviews_count),
+                    base_url=self.base_url,
+                )
+            ]
+
+        plans = []
+        for star_rating in AmazonFilterStarRating:
+            percentage = star_percentages.get(STAR_RATING_VALUES[star_rating])
+            if percentage is None:
+                # Without a histogram we have to assume the worst case
+                estimated_reviews = total_reviews_count
+            else:
+                # Histogram percentages are rounded and are based on ratings,
+                # not reviews, so take the upper end of the rounding range
+                estimated_reviews = math.ceil(
+                    total_reviews_count * (percentage + 0.5) / 100
+                )
+
+            if estimated_reviews <= self.page_capacity:
+                plans.append(
+                    FilterPlan(
+                        sort_by=probe.sort_by,
+                        star_rating=star_rating,
+                        format_type=probe.format_type,
+                        media_type=probe.media_type,
+                        max_pages=self.__pages_for(estimated_reviews),
+                        base_url=self.base_url,
+                    )
+                )
+                continue
+
+            # Overflowing star ratings need every view Amazon offers on them
+            for sort_by in AmazonFilterSortBy:
+                for format_type in AmazonFilterFormatType:
+                    for media_type in AmazonFilterMediaType:
+                        plans.append(
+                            FilterPlan(
+                                sort_by=sort_by,
+                                star_rating=star_rating,
+                                format_type=format_type,
+                                media_type=media_type,
+                                max_pages=self.config.max_pages,
+                                base_url=self.base_url,
+                            )
+                        )
+        return plans
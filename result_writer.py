@@ -0,0 +1,299 @@
+import asyncio
+import gzip
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from amazon_product import AmazonProduct
+from amazon_review import AmazonReview
+from marketplace import DEFAULT_MARKETPLACE
+from metrics import METRICS
+from scraping_config import ScrapingConfig
+
+# Awaited on the event loop with the products once they are safely on disk
+OnWritten = Callable[[List[AmazonProduct]], Awaitable[None]]
+
+
+class ResultWriter:
+    """Where finished products go. Subclasses decide the storage format."""
+
+    # Whether a write replaces everything stored for the product. Refreshed
+    # products are merged into the stored one first for these, the other sinks
+    # append or upsert, so they only get the new reviews
+    keeps_whole_products = False
+
+    def __init__(
+        self,
+        config: Optional[ScrapingConfig] = None,
+        on_written: Optional[OnWritten] = None,
+    ):
+        self.config = config or ScrapingConfig()
+        self.on_written = on_written
+        self.output_dir = Path(self.config.results_dir)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+
+    async def write(self, product: AmazonProduct) -> None:
+        raise NotImplementedError
+
+    def load(self, asin: str, marketplace: str) -> Optional[AmazonProduct]:
+        """The stored product, for sinks that keep whole products. Blocking."""
+        return None
+
+    async def drain(self) -> None:
+        """Wait until everything handed to `write` is on disk"""
+
+    async def close(self) -> None:
+        await self.drain()
+
+    async def _written(self, products: List[AmazonProduct]) -> None:
+        if self.on_written:
+            await self.on_written(products)
+
+
+class JsonFileResultWriter(ResultWriter):
+    """One pretty printed JSON file per ASIN, the original results layout"""
+
+    keeps_whole_products = True
+
+    def __file_path(self, asin: str, marketplace: str) -> str:
+        # Products of other stores than amazon.com sit next to theirs
+        name = asin
+        if marketplace != DEFAULT_MARKETPLACE:
+            name = f"{asin}.{marketplace}"
+        return os.path.join(self.output_dir, f"{name}.json")
+
+    def load(self, asin: str, marketplace: str) -> Optional[AmazonProduct]:
+        file_path = self.__file_path(asin, marketplace)
+        if not os.path.exists(file_path):
+            return None
+        with open(file_path, "r") as json_file:
+            product = AmazonProduct.from_json(json.load(json_file))
+        reviews = [AmazonReview.from_dict(review) for review in product.review_list]
+        product.review_list = []
+        product.merge_reviews(reviews)
+        return product
+
+    def __write_file(self, product: AmazonProduct) -> str:
+        file_path = self.__file_path(product.asin, product.marketplace)
+        with open(file_path, "w") as json_file:
+            json.dump(product.to_dict(), json_file, indent=4)
+        return file_path
+
+    async def write(self, product: AmazonProduct) -> None:
+        async with METRICS.async_timer("persist_seconds", writer="json"):
+            file_path = await asyncio.to_thread(self.__write_file, product)
+        METRICS.inc("products_written_total")
+        print(f"File successfully created: {file_path}")
+        await self._written([product])
+
+
+class BatchedResultWriter(ResultWriter):
+    """
+    Buffers finished products and writes them out in batches on a background
+    thread. At most two batches are in flight, after that `write` waits, which
+    keeps memory bounded when the disk falls behind.
+    """
+
+    def __init__(
+        self,
+        config: Optional[ScrapingConfig] = None,
+        on_written: Optional[OnWritten] = None,
+    ):
+        super().__init__(config, on_written)
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        # Keeps part files of separate runs and workers apart
+        self.run_id = datetime.now().strftime("%Y%m%d%H%M%S")
+        if self.config.worker_id:
+            self.run_id = f"{self.run_id}-{self.config.worker_id}"
+        self.batch_number = 0
+        self.batch: List[AmazonProduct] = []
+        self.pending: List[asyncio.Task] = []
+
+    def _write_batch(self, products: List[AmazonProduct], part_name: str) -> None:
+        raise NotImplementedError
+
+    async def _store_batch(self, products: List[AmazonProduct], part_name: str):
+        """Runs `_write_batch` on the writer thread, async sinks override this"""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(
+            self.executor, self._write_batch, products, part_name
+        )
+
+    async def __flush_batch(self, products: List[AmazonProduct], part_name: str):
+        start_time = time.time()
+        await self._store_batch(products, part_name)
+        seconds = time.time() - start_time
+        METRICS.observe("persist_seconds", seconds, writer=self.config.result_writer)
+        METRICS.inc("products_written_total", len(products))
+        print(f"Wrote {len(products)} products to {part_name} in {seconds:.2f}s")
+        await self._written(products)
+
+    async def flush(self) -> None:
+        if not self.batch:
+            return
+        products, self.batch = self.batch, []
+        part_name = f"part-{self.run_id}-{self.batch_number:05d}"
+        self.batch_number += 1
+        self.pending.append(
+            asyncio.create_task(self.__flush_batch(products, part_name))
+        )
+        # Backpressure, never keep more than two batches in memory
+        while len(self.pending) > 2:
+            await self.pending.pop(0)
+
+    async def write(self, product: AmazonProduct) -> None:
+        self.batch.append(product)
+        if len(self.batch) >= self.config.results_batch_size:
+            await self.flush()
+
+    async def drain(self) -> None:
+        await self.flush()
+        while self.pending:
+            await self.pending.pop(0)
+
+    async def close(self) -> None:
+        await self.drain()
+        self.executor.shutdown(wait=True)
+
+
+class JsonLinesResultWriter(BatchedResultWriter):
+    """Gzip compressed JSON Lines, one product per line and one file per batch"""
+
+    def _write_batch(self, products: List[AmazonProduct], part_name: str) -> None:
+        file_path = self.output_dir / f"{part_name}.jsonl.gz"
+        tmp_path = file_path.with_name(file_path.name + ".tmp")
+        with gzip.open(tmp_path, "wt", compresslevel=6) as f:
+            for product in products:
+                f.write(json.dumps(product.to_dict(), separators=(",", ":")))
+                f.write("\n")
+        tmp_path.replace(file_path)
+
+
+class ParquetResultWriter(BatchedResultWriter):
+    """
+    Products and reviews as two Parquet datasets, `products/` and `reviews/`,
+    partitioned into one file per batch.
+    """
+
+    def __init__(
+        self,
+        config: Optional[ScrapingConfig] = None,
+        on_written: Optional[OnWritten] = None,
+    ):
+        super().__init__(config, on_written)
+        # Only needed for this writer
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self.pa = pa
+        self.pq = pq
+        self.product_schema = pa.schema(
+            [
+                ("asin", pa.string()),
+                ("marketplace", pa.string()),
+                ("name", pa.string()),
+                ("overall_rating", pa.float32()),
+                ("total_rating_count", pa.int64()),
+                ("total_reviews_count", pa.int64()),
+                ("star_percentages", pa.map_(pa.int8(), pa.int8())),
+                ("failed_urls", pa.list_(pa.string())),
+            ]
+        )
+        self.review_schema = pa.schema(
+            [
+                ("asin", pa.string()),
+                ("marketplace", pa.string()),
+                ("id", pa.string()),
+                ("rating", pa.float32()),
+                ("title", pa.string()),
+                ("href", pa.string()),
+                ("country", pa.string()),
+                ("date", pa.timestamp("s")),
+                ("body", pa.string()),
+                ("verified_purchase", pa.bool_()),
+                ("found_helpful", pa.int32()),
+                ("username", pa.string()),
+                ("username_url", pa.string()),
+                ("images", pa.list_(pa.string())),
+                ("videos", pa.list_(pa.string())),
+                ("found_under", pa.list_(pa.string())),
+            ]
+        )
+        for dataset in ["products", "reviews"]:
+            (self.output_dir / dataset).mkdir(parents=True, exist_ok=True)
+
+    def __columns(self, schema) -> Dict[str, list]:
+        return {name: [] for name in schema.names}
+
+    def _write_batch(self, products: List[AmazonProduct], part_name: str) -> None:
+        product_columns = self.__columns(self.product_schema)
+        review_columns = self.__columns(self.review_schema)
+        for product in products:
+            product_columns["asin"].append(product.asin)
+            product_columns["marketplace"].append(product.marketplace)
+            product_columns["name"].append(product.name)
+            product_columns["overall_rating"].append(product.overall_rating)
+            product_columns["total_rating_count"].append(product.total_rating_count)
+            product_columns["total_reviews_count"].append(product.total_reviews_count)
+            product_columns["star_percentages"].append(
+                list(product.star_percentages.items())
+            )
+            product_columns["failed_urls"].append(product.failed_urls)
+
+            for review in product.review_list:
+                review_columns["asin"].append(product.asin)
+                review_columns["marketplace"].append(product.marketplace)
+                review_columns["id"].append(review.id)
+                review_columns["rating"].append(review.rating)
+                review_columns["title"].append(review.title)
+                review_columns["href"].append(review.href)
+                review_columns["country"].append(review.country)
+                review_columns["date"].append(review.date)
+                review_columns["body"].append(review.body)
+                review_columns["verified_purchase"].append(review.verified_purchase)
+                review_columns["found_helpful"].append(review.found_helpful)
+                review_columns["username"].append(review.username)
+                review_columns["username_url"].append(review.username_url)
+                review_columns["images"].append(review.images)
+                review_columns["videos"].append(review.videos)
+                review_columns["found_under"].append(
+                    review.found_under_urls(product.asin, product.base_url)
+                )
+
+        for dataset, columns, schema in [
+            ("products", product_columns, self.product_schema),
+            ("reviews", review_columns, self.review_schema),
+        ]:
+            file_path = self.output_dir / dataset / f"{part_name}.parquet"
+            tmp_path = file_path.with_name(file_path.name + ".tmp")
+            self.pq.write_table(
+                self.pa.Table.from_pydict(columns, schema=schema),
+                tmp_path,
+                compression="zstd",
+            )
+            tmp_path.replace(file_path)
+
+
+RESULT_WRITERS = {
+    "json": JsonFileResultWriter,
+    "jsonl": JsonLinesResultWriter,
+    "parquet": ParquetResultWriter,
+}
+
+
+def create_result_writer(
+    config: Optional[ScrapingConfig] = None, on_written: Optional[OnWritten] = None
+) -> ResultWriter:
+    config = config or ScrapingConfig()
+    if config.result_writer in ("postgres", "sqlite"):
+        # Imported here, the database writers build on the classes above
+        from database_writer import create_database_writer
+
+        return create_database_writer(config, on_written)
+    if config.result_writer not in RESULT_WRITERS:
+        raise ValueError(f"Unknown result writer: {config.result_writer}")
+    return RESULT_WRITERS[config.result_writer](config, on_written)
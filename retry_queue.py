@@ -0,0 +1,60 @@
+import asyncio
+import heapq
+import itertools
+import random
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+from marketplace import DEFAULT_MARKETPLACE
+from request_planner import FilterPlan
+from scraping_config import ScrapingConfig
+
+
+def backoff_delay(attempt: int, base: float, cap: float) -> float:
+    """Exponential backoff with equal jitter: half fixed, half random"""
+    delay = min(cap, base * 2**attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+@dataclass
+class RetryItem:
+    asin: str
+    url: str
+    plan: FilterPlan
+    page_number: int
+    attempts: int = 0
+    marketplace: str = DEFAULT_MARKETPLACE
+
+
+class RetryQueue:
+    """Delayed priority queue that hands out failed pages once their backoff has passed"""
+
+    def __init__(self, config: Optional[ScrapingConfig] = None):
+        self.config = config or ScrapingConfig()
+        self.__heap = []
+        # Tie breaker so items with the same ready time never get compared
+        self.__counter = itertools.count()
+
+    def __len__(self) -> int:
+        return len(self.__heap)
+
+    def push(self, item: RetryItem) -> None:
+        delay = backoff_delay(
+            item.attempts,
+            self.config.retry_stage_base_delay,
+            self.config.retry_stage_max_delay,
+        )
+        heapq.heappush(
+            self.__heap, (time.monotonic() + delay, next(self.__counter), item)
+        )
+
+    async def pop(self) -> RetryItem:
+        """Wait for the earliest item to become ready and return it"""
+        while True:
+            ready_at = self.__heap[0][0]
+            delay = ready_at - time.monotonic()
+            if delay <= 0:
+                return heapq.heappop(self.__heap)[2]
+            # Wake up regularly in case an earlier item was pushed meanwhile
+            await asyncio.sleep(min(delay, 1.0))
@@ -0,0 +1,75 @@
+import hashlib
+from array import array
+from bisect import bisect_left
+from pathlib import Path
+from typing import Iterable, Optional
+
+from marketplace import DEFAULT_MARKETPLACE
+from scraping_config import ScrapingConfig
+
+
+class SeenReviewStore:
+    """
+    On-disk set of every review id recorded by the crawl.
+
+    Ids are stored as 64 bit blake2b digests in an append-only file. Loading
+    sorts them into a compact array that is searched with bisect, which keeps
+    tens of millions of ids in a few hundred MB and makes a false match
+    vanishingly unlikely. Every marketplace keeps its own file, the same
+    review can show up in several stores.
+    """
+
+    def __init__(
+        self,
+        config: Optional[ScrapingConfig] = None,
+        marketplace: str = DEFAULT_MARKETPLACE,
+    ):
+        self.config = config or ScrapingConfig()
+        self.path = Path(self.config.seen_reviews_path)
+        if marketplace != DEFAULT_MARKETPLACE:
+            self.path = self.path.with_name(
+                f"{self.path.stem}.{marketplace}{self.path.suffix}"
+            )
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.__digests = array("Q")
+        # Ids added since loading, the sorted array is only rebuilt on load
+        self.__recent = set()
+        self.load()
+
+    @staticmethod
+    def digest(review_id: str) -> int:
+        return int.from_bytes(
+            hashlib.blake2b(review_id.encode(), digest_size=8).digest(), "little"
+        )
+
+    def load(self) -> None:
+        digests = array("Q")
+        if self.path.exists():
+            data = self.path.read_bytes()
+            # Ignore a partially written trailing digest
+            digests.frombytes(data[: len(data) - len(data) % digests.itemsize])
+        self.__digests = array("Q", sorted(digests))
+        self.__recent = set()
+
+    def __contains__(self, review_id: str) -> bool:
+        digest = self.digest(review_id)
+        if digest in self.__recent:
+            return True
+        index = bisect_left(self.__digests, digest)
+        return index < len(self.__digests) and self.__digests[index] == digest
+
+    def __len__(self) -> int:
+        return len(self.__digests) + len(self.__recent)
+
+    def add_many(self, review_ids: Iterable[str]) -> None:
+        new_digests = array("Q")
+        for review_id in review_ids:
+            if review_id in self:
+                continue
+            digest = self.digest(review_id)
+            self.__recent.add(digest)
+            new_digests.append(digest)
+
+        if new_digests:
+            with open(self.path, "ab") as f:
+                new_digests.tofile(f)
@@ -1,12 +1,129 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Dict, List, Optional
 
 
 @dataclass
 class ScrapingConfig:
+    # Stores crawled side by side, each with its own session, pool and limits.
+    # Base urls can be pointed elsewhere, e.g. at a local mock server
+    marketplaces: List[str] = field(default_factory=lambda: ["com"])
+    marketplace_base_urls: Dict[str, str] = field(default_factory=dict)
+    # Pages per filter branch, at most helpers.FOUND_UNDER_PAGE_SLOTS
     max_pages: int = 10
     max_workers: int = 5
     max_concurrent_requests: int = 50
+    # Products in flight at once, new ASINs start as soon as one finishes
+    max_concurrent_products: int = 10
     request_timeout: int = 30
+    # Bodies are streamed in chunks. A captcha or login marker within the first
+    # stream_sniff_bytes, or a body over max_body_bytes, ends the transfer early
+    stream_chunk_size: int = 16 * 1024
+    stream_sniff_bytes: int = 64 * 1024
+    max_body_bytes: int = 8 * 1024**2
     retry_attempts: int = 3
     retry_delay: int = 1
+    retry_max_delay: float = 30.0
+    # Only request page N+1 of a filter combination when page N came back full
+    adaptive_pagination: bool = True
+    reviews_per_page: int = 10
+    # Fetch one probe page per product and pick filter branches from its counts
+    plan_requests: bool = True
+    # Only keep reviews dated inside this window (inclusive), None leaves it open.
+    # Branches sorted by most recent stop once a page reaches past the start date
+    review_start_date: Optional[datetime] = None
+    review_end_date: Optional[datetime] = None
+    # Refresh products crawled before: only the newest pages of their most recent
+    # first branches are fetched, up to the newest review recorded per branch
+    incremental_refresh: bool = False
 
+    # Compressed page cache, compression is zstd when installed, else gzip
+    cache_dir: str = "./data/pfw/page_cache"
+    cache_compression: Optional[str] = None
+    cache_compression_level: int = 6
+    cache_max_bytes: int = 20 * 1024**3
+    # Pages cached before the compressed cache existed, only read from
+    legacy_pages_dir: str = "./data/pfw/pages"
+    # Seconds a page outcome without reviews is served from the cache, per class
+    negative_cache_ttls: Dict[str, float] = field(
+        default_factory=lambda: {
+            "no_reviews": 90 * 24 * 3600,
+            "not_found": 7 * 24 * 3600,
+            "captcha": 10 * 60,
+            "login": 10 * 60,
+        }
+    )
+    # Cache reads run on io_read_threads, cache and journal writes are queued
+    # on one writer thread and callers wait once io_write_queue_size are pending
+    io_read_threads: int = 4
+    io_write_queue_size: int = 256
+
+    # Every review id recorded so far. Skipped reviews are left out of the product
+    # they show up under again, e.g. variants sharing one review pool
+    seen_reviews_path: str = "./data/pfw/seen_reviews.bin"
+    skip_seen_reviews: bool = False
+
+    # Where finished products go: "json" (one file per ASIN), "jsonl" (gzip
+    # JSON Lines), "parquet" (products/ and reviews/ datasets), "postgres" or
+    # "sqlite". The batched sinks write `results_batch_size` products at a time
+    results_dir: str = "./data/pfw/results"
+    result_writer: str = "json"
+    results_batch_size: int = 100
+    # "postgres" falls back to the SQLite file without asyncpg or a database_url
+    database_url: Optional[str] = None
+    database_pool_size: int = 4
+    sqlite_results_path: str = "./data/pfw/results.sqlite"
+
+    # Per stage metrics, logged as JSON every interval (0 turns that off) and
+    # served in the Prometheus text format on metrics_port when set
+    metrics_log_interval: float = 30.0
+    metrics_log_path: Optional[str] = "./data/pfw/metrics.log"
+    metrics_host: str = "127.0.0.1"
+    metrics_port: Optional[int] = None
+
+    # Html backend of the parser workers: "selectolax", "lxml" or "html.parser",
+    # None picks the fastest one installed
+    parser_backend: Optional[str] = None
+
+    # Per ASIN completion journal, compacted into the DataFrame on request
+    progress_db_path: str = "./data/pfw/progress.sqlite"
+
+    # Lease queue shared by several crawler processes, e.g. on a shared volume.
+    # Leases run out after lease_seconds unless the worker renews them
+    work_queue_path: str = "./data/pfw/work_queue.sqlite"
+    lease_seconds: float = 600.0
+    lease_batch_size: int = 10
+    lease_max_attempts: int = 3
+    # Seconds between lease attempts while only other workers hold ASINs
+    lease_poll_interval: float = 30.0
+    # Defaults to host and pid, also keeps the result part files of workers apart
+    worker_id: Optional[str] = None
+    # Selects the AMAZON_SESSION_ID_<n> and AMAZON_TOKEN_<n> cookies of a worker
+    session_shard: Optional[int] = None
+
+    # Per host token bucket and AIMD concurrency, cut when blocks pile up
+    governor_initial_rate: float = 5.0
+    governor_min_rate: float = 0.2
+    governor_max_rate: float = 50.0
+    governor_rate_increase: float = 0.05
+    governor_burst: float = 10.0
+    governor_initial_concurrency: float = 10.0
+    governor_min_concurrency: float = 1.0
+    governor_decrease_factor: float = 0.5
+    governor_block_threshold: float = 0.05
+    governor_window: int = 100
+    governor_cooldown: float = 10.0
+
+    # Connection pool shared by the whole crawl
+    pool_limit: int = 100
+    pool_limit_per_host: int = 50
+    pool_keepalive_timeout: float = 60.0
+    pool_dns_cache_ttl: int = 300
+
+    # Pages that still failed are retried after the main crawl with backoff
+    retry_stage: bool = True
+    retry_stage_attempts: int = 5
+    retry_stage_base_delay: float = 30.0
+    retry_stage_max_delay: float = 600.0
+    # Retry once blocks fall under the governor threshold or stop for this long
+    retry_stage_quiet_period: float = 60.0
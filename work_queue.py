@@ -0,0 +1,327 @@
+import asyncio
+import os
+import socket
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import (
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
+
+from background_io import BackgroundIO
+from marketplace import DEFAULT_MARKETPLACE
+from metrics import METRICS
+from scraping_config import ScrapingConfig
+
+STATUS_PENDING = "pending"
+STATUS_LEASED = "leased"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+
+# (marketplace, asin), the unit of work
+WorkItem = Tuple[str, str]
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class WorkQueue:
+    """
+    ASINs shared by several crawler processes, handed out under time limited
+    leases, once per marketplace.
+
+    A worker leases a few ASINs at a time and keeps renewing them while it
+    works. Leases of a worker that crashed simply run out and the ASINs go
+    to the next worker asking. The store is an SQLite file that every worker
+    opens, which may sit on a shared volume, so it keeps the rollback journal
+    instead of WAL, and every lease is a single immediate transaction.
+    """
+
+    def __init__(self, config: Optional[ScrapingConfig] = None):
+        self.config = config or ScrapingConfig()
+        path = Path(self.config.work_queue_path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        # Used from the background I/O threads, every access holds the lock
+        self.lock = threading.Lock()
+        # Autocommit, transactions are opened explicitly where they matter
+        self.db = sqlite3.connect(
+            path, timeout=60, isolation_level=None, check_same_thread=False
+        )
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS work (
+                asin TEXT NOT NULL,
+                marketplace TEXT NOT NULL,
+                status TEXT NOT NULL,
+                worker_id TEXT,
+                lease_expires_at REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (asin, marketplace)
+            )
+            """)
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS work_status "
+            "ON work (marketplace, status, lease_expires_at)"
+        )
+
+    def enqueue(
+        self, asins: Iterable[str], marketplaces: Optional[List[str]] = None
+    ) -> int:
+        """Add ASINs that are not queued yet in each marketplace, returns how many were new"""
+        marketplaces = marketplaces or [DEFAULT_MARKETPLACE]
+        now = time.time()
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            cursor = self.db.executemany(
+                """
+                INSERT OR IGNORE INTO work (asin, marketplace, status, updated_at)
+                VALUES (?, ?, ?, ?)
+                """,
+                (
+                    (asin, marketplace, STATUS_PENDING, now)
+                    for asin in asins
+                    for marketplace in marketplaces
+                ),
+            )
+            self.db.execute("COMMIT")
+        return cursor.rowcount
+
+    def lease(self, worker_id: str, count: int, marketplace: str) -> List[str]:
+        """Lease up to `count` pending ASINs, reclaiming ones whose lease ran out"""
+        now = time.time()
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self.db.execute(
+                    """
+                    SELECT asin FROM work
+                    WHERE marketplace = ?
+                        AND (status = ? OR (status = ? AND lease_expires_at < ?))
+                        AND attempts < ?
+                    ORDER BY status DESC, asin
+                    LIMIT ?
+                    """,
+                    (
+                        marketplace,
+                        STATUS_PENDING,
+                        STATUS_LEASED,
+                        now,
+                        self.config.lease_max_attempts,
+                        count,
+                    ),
+                ).fetchall()
+                asins = [asin for (asin,) in rows]
+                self.db.executemany(
+                    """
+                    UPDATE work SET status = ?, worker_id = ?, lease_expires_at = ?,
+                        attempts = attempts + 1, updated_at = ?
+                    WHERE asin = ? AND marketplace = ?
+                    """,
+                    (
+                        (
+                            STATUS_LEASED,
+                            worker_id,
+                            now + self.config.lease_seconds,
+                            now,
+                            asin,
+                            marketplace,
+                        )
+                        for asin in asins
+                    ),
+                )
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+        return asins
+
+    def renew(self, worker_id: str, items: Iterable[WorkItem]) -> None:
+        """Push the leases of ASINs still being worked on into the future"""
+        now = time.time()
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            self.db.executemany(
+                """
+                UPDATE work SET lease_expires_at = ?, updated_at = ?
+                WHERE marketplace = ? AND asin = ? AND worker_id = ? AND status = ?
+                """,
+                (
+                    (
+                        now + self.config.lease_seconds,
+                        now,
+                        marketplace,
+                        asin,
+                        worker_id,
+                        STATUS_LEASED,
+                    )
+                    for marketplace, asin in items
+                ),
+            )
+            self.db.execute("COMMIT")
+
+    def finish(self, worker_id: str, items: Iterable[WorkItem], status: str) -> None:
+        """Record ASINs as done or failed, unless another worker took them over"""
+        now = time.time()
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            self.db.executemany(
+                """
+                UPDATE work SET status = ?, lease_expires_at = NULL, updated_at = ?
+                WHERE marketplace = ? AND asin = ? AND worker_id = ? AND status = ?
+                """,
+                (
+                    (status, now, marketplace, asin, worker_id, STATUS_LEASED)
+                    for marketplace, asin in items
+                ),
+            )
+            self.db.execute("COMMIT")
+
+    def release(self, worker_id: str, items: Iterable[WorkItem]) -> None:
+        """Give unfinished ASINs back without counting the attempt"""
+        now = time.time()
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            self.db.executemany(
+                """
+                UPDATE work SET status = ?, worker_id = NULL, lease_expires_at = NULL,
+                    attempts = MAX(attempts - 1, 0), updated_at = ?
+                WHERE marketplace = ? AND asin = ? AND worker_id = ? AND status = ?
+                """,
+                (
+                    (STATUS_PENDING, now, marketplace, asin, worker_id, STATUS_LEASED)
+                    for marketplace, asin in items
+                ),
+            )
+            self.db.execute("COMMIT")
+
+    def active_leases(
+        self, marketplace: str, exclude_worker: Optional[str] = None
+    ) -> int:
+        """Unexpired leases in a marketplace, optionally leaving out those of one worker"""
+        with self.lock:
+            (count,) = self.db.execute(
+                """
+                SELECT COUNT(*) FROM work
+                WHERE marketplace = ? AND status = ? AND lease_expires_at >= ?
+                    AND worker_id IS NOT ?
+                """,
+                (marketplace, STATUS_LEASED, time.time(), exclude_worker),
+            ).fetchone()
+        return count
+
+    def counts(self, marketplace: Optional[str] = None) -> Dict[str, int]:
+        """ASINs per status, in one marketplace or all of them"""
+        with self.lock:
+            rows = self.db.execute(
+                """
+                SELECT status, COUNT(*) FROM work
+                WHERE ? IS NULL OR marketplace = ?
+                GROUP BY status
+                """,
+                (marketplace, marketplace),
+            ).fetchall()
+        return dict(rows)
+
+    def close(self) -> None:
+        with self.lock:
+            self.db.close()
+
+
+class WorkerLeases:
+    """
+    One worker's side of the WorkQueue: leases the ASINs of a marketplace in
+    batches as its scheduler asks for them and renews the leases it holds
+    until they are finished. Iterating ends once nothing is pending and no
+    other worker holds a live lease that could still run out and need
+    reclaiming.
+    """
+
+    def __init__(
+        self,
+        work_queue: WorkQueue,
+        io: BackgroundIO,
+        config: Optional[ScrapingConfig] = None,
+    ):
+        self.config = config or ScrapingConfig()
+        self.work_queue = work_queue
+        self.io = io
+        self.worker_id = self.config.worker_id or default_worker_id()
+        self.held: Set[WorkItem] = set()
+        self.heartbeat: Optional[asyncio.Task] = None
+
+    async def __renew_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.config.lease_seconds / 3)
+            if self.held:
+                await self.io.write(
+                    self.work_queue.renew, self.worker_id, list(self.held)
+                )
+
+    async def asins(
+        self,
+        marketplace: str,
+        on_idle: Optional[Callable[[], Awaitable[None]]] = None,
+    ) -> AsyncIterator[str]:
+        """
+        Leased ASINs of a marketplace. `on_idle` is awaited whenever nothing is
+        left to lease, before waiting on the leases of other workers.
+        """
+        if self.heartbeat is None:
+            self.heartbeat = asyncio.create_task(self.__renew_periodically())
+        while True:
+            asins = await self.io.write(
+                self.work_queue.lease,
+                self.worker_id,
+                self.config.lease_batch_size,
+                marketplace,
+                wait=True,
+            )
+            if not asins:
+                if on_idle:
+                    # Finish our own held ASINs first, e.g. the ones waiting on
+                    # retries. Other workers may be waiting for them as we do
+                    await on_idle()
+                others = await self.io.read(
+                    self.work_queue.active_leases, marketplace, self.worker_id
+                )
+                counts = await self.io.read(self.work_queue.counts, marketplace)
+                if not others and not counts.get(STATUS_PENDING):
+                    return
+                # Another worker may still crash and leave its leases behind
+                await asyncio.sleep(self.config.lease_poll_interval)
+                continue
+
+            METRICS.inc("asins_leased_total", len(asins), marketplace=marketplace)
+            self.held.update((marketplace, asin) for asin in asins)
+            for asin in asins:
+                yield asin
+
+    async def finish(self, items: List[WorkItem], status: str = STATUS_DONE) -> None:
+        items = [item for item in items if item in self.held]
+        if not items:
+            return
+        self.held.difference_update(items)
+        await self.io.write(self.work_queue.finish, self.worker_id, items, status)
+
+    async def close(self) -> None:
+        if self.heartbeat:
+            self.heartbeat.cancel()
+            self.heartbeat = None
+        # Whatever did not make it to the result writer goes back to the queue
+        if self.held:
+            print(f"Releasing {len(self.held)} unfinished leases")
+            await self.io.write(
+                self.work_queue.release, self.worker_id, list(self.held), wait=True
+            )
+            self.held.clear()